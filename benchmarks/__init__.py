@@ -0,0 +1 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
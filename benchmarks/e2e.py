@@ -0,0 +1,216 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+"""End-to-end benchmarks of mcom03-flash against the flasher emulator.
+
+Every scenario runs mcom03-flash in a subprocess connected to the emulator pty and reports
+throughput (MiB/s of the whole command), host CPU time per MiB and round trips per MiB.
+Results are saved to JSON file, two result files can be compared::
+
+    python -m benchmarks.e2e run --sizes 256K 1M --output before.json
+    python -m benchmarks.e2e run --sizes 256K 1M --output after.json
+    python -m benchmarks.e2e compare before.json after.json
+
+With ``--latency`` the tool is connected to the emulator through TCP proxy with given one-way
+latency (as network serial server) by ``--port socket://...``.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from benchmarks.emulator import (
+    FlasherEmulator,
+    LatencyProxy,
+    add_config_arguments,
+    config_from_args,
+)
+from mcom03_flash_tools.mcom03_flash import int_size
+
+MiB = 1024 * 1024
+SCENARIOS = ["flash", "read", "erase", "flash-tl-image"]
+DEFAULT_SIZES = ["256K", "1M", "4M"]
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def make_image(path: str, size: int, seed: int):
+    with open(path, "wb") as f:
+        f.write(random.Random(seed).randbytes(size))
+
+
+def make_package(path: str, image: str, size: int):
+    """Create tl-image package with one flash action of `image`"""
+    with open(image, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    description = (
+        '[info]\nformat_version = "0.0.2"\n\n'
+        + '[profile.default.image]\ncommand = "flash"\nname = "image.bin"\noffset = 0\n'
+        + f'size = {size}\nsha256 = "{digest}"\n'
+    ).encode()
+    with tarfile.open(path, "w") as tar:
+        info = tarfile.TarInfo("package.toml")
+        info.size = len(description)
+        tar.addfile(info, io.BytesIO(description))
+        tar.add(image, "image.bin")
+
+
+def scenario_args(scenario: str, size: int, workdir: str) -> list:
+    image = os.path.join(workdir, f"image-{size}.bin")
+    if scenario in ["flash", "flash-tl-image"] and not os.path.exists(image):
+        make_image(image, size, size)
+    if scenario == "flash":
+        return ["flash", "qspi0", image]
+    if scenario == "read":
+        return ["read", "qspi0", os.path.join(workdir, "read.bin"), str(size)]
+    if scenario == "erase":
+        return ["erase", "qspi0", str(size)]
+    package = os.path.join(workdir, f"image-{size}.tl-image")
+    make_package(package, image, size)
+    return ["flash-tl-image", "qspi0", package]
+
+
+def run_tool(emulator: FlasherEmulator, port: str, args: list, baudrate: int, workdir: str) -> dict:
+    """Run mcom03-flash connected to `port` of `emulator` with `args`. Return wall time, CPU
+    time, emulator counters and phases."""
+    metrics = os.path.join(workdir, "metrics.jsonl")
+    if os.path.exists(metrics):
+        os.remove(metrics)
+    cmd = [sys.executable, "-m", "mcom03_flash_tools.mcom03_flash", "--port", port]
+    cmd += ["--baudrate", str(baudrate), "--hide-progress-bar", "--metrics", metrics] + args
+    env = dict(os.environ, MCOM03_FLASH_CACHE=os.path.join(workdir, "cache"))
+
+    emulator.reset()
+    usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    time_start = time.monotonic()
+    proc = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, check=False
+    )
+    wall = time.monotonic() - time_start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if proc.returncode:
+        raise Exception(f"{' '.join(cmd)} failed:\n{proc.stdout.decode(errors='ignore')}")
+
+    with open(metrics) as f:
+        record = json.loads(f.readlines()[-1])
+    cpu = usage.ru_utime + usage.ru_stime - usage_start.ru_utime - usage_start.ru_stime
+    return {**record, "wall": wall, "cpu": cpu, "emulator": dict(emulator.counters)}
+
+
+def run_suite(args) -> dict:
+    config = config_from_args(args)
+    results = []
+    with contextlib.ExitStack() as stack:
+        workdir = stack.enter_context(tempfile.TemporaryDirectory())
+        emulator = stack.enter_context(FlasherEmulator(config))
+        port = emulator.port
+        if args.latency:
+            port = stack.enter_context(LatencyProxy(emulator.port, args.latency)).url
+        for scenario in args.scenarios:
+            for size_text in args.sizes:
+                size = int_size(size_text)
+                measured = run_tool(
+                    emulator, port, scenario_args(scenario, size, workdir), args.baudrate, workdir
+                )
+                mib = size / MiB
+                result = {
+                    "scenario": scenario,
+                    "size": size,
+                    "wall": round(measured["wall"], 3),
+                    "mib_per_s": round(mib / measured["wall"], 4),
+                    "cpu_per_mib": round(measured["cpu"] / mib, 4),
+                    "round_trips_per_mib": round(measured["emulator"]["round_trips"] / mib, 1),
+                    "counters": measured["emulator"],
+                    "phases": measured["phases"],
+                }
+                print(format_result(result))
+                results.append(result)
+
+    commit = subprocess.run(
+        ["git", "describe", "--always", "--dirty"],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=False,
+    ).stdout.strip()
+    return {
+        "time": time.time(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "baudrate": args.baudrate,
+        "latency": args.latency,
+        "emulator": config._asdict(),
+        "results": results,
+    }
+
+
+def format_result(result: dict) -> str:
+    return (
+        f"{result['scenario']:15} {result['size'] // 1024:8} KiB {result['wall']:8.2f} s "
+        + f"{result['mib_per_s']:8.3f} MiB/s {result['cpu_per_mib']:7.3f} CPU s/MiB "
+        + f"{result['round_trips_per_mib']:8.1f} RT/MiB"
+    )
+
+
+def compare(old: dict, new: dict):
+    """Print change of metrics of scenarios present in both results"""
+    old_results = {(x["scenario"], x["size"]): x for x in old["results"]}
+    print(f"{old['commit']} -> {new['commit']}")
+    for result in new["results"]:
+        base = old_results.get((result["scenario"], result["size"]))
+        if base is None:
+            continue
+        changes = []
+        for key in ["mib_per_s", "cpu_per_mib", "round_trips_per_mib"]:
+            change = (result[key] / base[key] - 1) * 100 if base[key] else 0.0
+            changes.append(f"{key} {base[key]} -> {result[key]} ({change:+.1f}%)")
+        print(f"{result['scenario']:15} {result['size'] // 1024:8} KiB  " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks of mcom03-flash")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_run = subparsers.add_parser("run", help="run benchmarks and save results")
+    parser_run.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser_run.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="image sizes")
+    parser_run.add_argument("--baudrate", type=int, default=921600, help="UART baudrate")
+    parser_run.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="one-way latency of TCP connection to emulator in seconds (0: connect to pty)",
+    )
+    parser_run.add_argument(
+        "--output", help="file to save results (default: results/<date>-<time>.json)"
+    )
+    add_config_arguments(parser_run)
+    parser_compare = subparsers.add_parser("compare", help="compare two result files")
+    parser_compare.add_argument("old")
+    parser_compare.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old) as f_old, open(args.new) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+        return 0
+
+    report = run_suite(args)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results are saved to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
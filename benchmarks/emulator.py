@@ -0,0 +1,389 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+"""Emulator of MCom-03 BootROM and QSPI flasher on a pseudo-terminal.
+
+The emulator serves the flasher protocol (write/erase/read/readcrc/custom/baudrate/qspi and
+ihex upload to BootROM) on the slave side of a pty, so the tools can be started with
+``--port <pty>`` without a board. Serial link and device are simulated: every byte takes
+10 bits at current baudrate plus `byte_latency`, every response is delayed by
+`response_latency` (latency timer of USB-UART adapter), erase and page program take
+`erase_time` and `program_time`, CRC is calculated with `crc_rate` bytes/s.
+`crc_error_rate` is probability to reject a data frame with CRC error, `loss_rate` is
+probability to lose one byte of response to read command. Errors and losses happen only at
+baudrates above `error_baudrate` (at any baudrate if it is 0).
+
+LatencyProxy is a stand-in for network serial server: it relays TCP connection to the pty and
+adds one-way latency in both directions, so the tools can be started with
+``--port socket://127.0.0.1:<port>``.
+
+Standalone usage (prints name of pty and serves it until Ctrl+C)::
+
+    python -m benchmarks.emulator --erase-time 0.05 --crc-error-rate 0.01
+    python -m benchmarks.emulator --latency 0.02  # serve also on TCP port with 20 ms latency
+"""
+
+import argparse
+import binascii
+import contextlib
+import os
+import random
+import select
+import socket
+import termios
+import threading
+import time
+import tty
+from collections import deque, namedtuple
+from typing import Optional
+
+EmulatorConfig = namedtuple(
+    "EmulatorConfig",
+    [
+        "flash_size",
+        "sector",
+        "page",
+        "jedec_id",
+        "byte_latency",
+        "response_latency",
+        "erase_time",
+        "program_time",
+        "crc_rate",
+        "crc_error_rate",
+        "loss_rate",
+        "error_baudrate",
+        "bootrom",
+        "seed",
+    ],
+    defaults=[
+        16 * 1024 * 1024,
+        64 * 1024,
+        256,
+        (0xEF, 0x40, 0x18),
+        0.0,
+        0.001,
+        0.3,
+        0.0007,
+        4 * 1024 * 1024,
+        0.0,
+        0.0,
+        0,
+        False,
+        0,
+    ],
+)
+
+PROMPT = b"#"
+FLASHER_MSG = b"QSPI Flasher (emulator)\n"
+IHEX_EOF = b":00000001FF"
+
+
+class FlasherEmulator:
+    """Emulator of the flasher served in a background thread. Use as context manager::
+
+    with FlasherEmulator(EmulatorConfig(erase_time=0.01)) as emulator:
+        subprocess.run(["mcom03-flash", "--port", emulator.port, "erase", "qspi0", "64K"])
+        print(emulator.counters)
+    """
+
+    def __init__(self, config: Optional[EmulatorConfig] = None):
+        self.config = config = config or EmulatorConfig()
+        self.mem = bytearray(b"\xff" * config.flash_size)
+        self.random = random.Random(config.seed)
+        self.baudrate = 115200
+        self.mode = "bootrom" if config.bootrom else "flasher"
+        self.inbuf = bytearray()
+        self.write_pos = 0
+        self.rx_clock = 0.0
+        self.tx_clock = 0.0
+        self.counters = {
+            "round_trips": 0,
+            "rx_bytes": 0,
+            "tx_bytes": 0,
+            "crc_errors": 0,
+            "lost_bytes": 0,
+        }
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def reset(self):
+        """Return link to initial state (as after board reset with flasher executing) and clear
+        counters. Contents of flash memory are kept."""
+        self.baudrate = 115200
+        self.mode = "bootrom" if self.config.bootrom else "flasher"
+        self.inbuf.clear()
+        self.counters = dict.fromkeys(self.counters, 0)
+
+    def _byte_time(self) -> float:
+        return 10 / self.baudrate + self.config.byte_latency
+
+    def _serve(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                continue
+            # Data written by host is received by device at line rate
+            now = time.monotonic()
+            self.rx_clock = max(now, self.rx_clock) + len(data) * self._byte_time()
+            self._sleep_until(self.rx_clock)
+            self.counters["rx_bytes"] += len(data)
+            self.inbuf += data
+            self._process()
+
+    @staticmethod
+    def _sleep_until(moment: float):
+        delay = moment - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send(self, data: bytes, latency: bool = True):
+        """Send data at line rate. Response latency is added before the first byte."""
+        start = time.monotonic() + (self.config.response_latency if latency else 0)
+        self.tx_clock = max(start, self.tx_clock)
+        chunk = max(16, self.baudrate // 10 // 100)  # data sent in ~10 ms
+        for pos in range(0, len(data), chunk):
+            part = data[pos : pos + chunk]
+            self.tx_clock += len(part) * self._byte_time()
+            self._sleep_until(self.tx_clock)
+            os.write(self.master, part)
+        self.counters["tx_bytes"] += len(data)
+
+    def _process(self):
+        while True:
+            if self.mode == "write":
+                if not self._process_frame():
+                    return
+                continue
+
+            i = min([x for x in [self.inbuf.find(b"\r"), self.inbuf.find(b"\n")] if x >= 0] or [-1])
+            if i < 0:
+                return
+            separator = self.inbuf[i : i + 1]
+            line = bytes(self.inbuf[:i])
+            del self.inbuf[: i + 1]
+            if self.mode == "bootrom" and line.startswith(b":"):
+                if line.strip() == IHEX_EOF:
+                    # BootROM sends prompt twice after ihex file
+                    self._send(PROMPT + PROMPT)
+                continue
+            if separator == b"\n" and not line:
+                continue
+            self.counters["round_trips"] += 1
+            self._send(line + b"\r\n", latency=False)
+            self._command(line.decode(errors="ignore").split())
+
+    def _error(self, rate: float) -> bool:
+        if self.config.error_baudrate and self.baudrate <= self.config.error_baudrate:
+            return False
+        return self.random.random() < rate
+
+    def _process_frame(self) -> bool:
+        if len(self.inbuf) < 4:
+            return False
+        size = int.from_bytes(self.inbuf[:2], "little")
+        crc = int.from_bytes(self.inbuf[2:4], "little")
+        if size == 0:
+            del self.inbuf[:4]
+            # Only the end frame with CRC of empty data finishes write session
+            if crc != binascii.crc_hqx(b"", 0xFFFF):
+                self.counters["crc_errors"] += 1
+                self._send(b"C")
+                return True
+            self.mode = "flasher"
+            self._send(PROMPT)
+            return True
+        if len(self.inbuf) < 4 + size:
+            return False
+
+        data = bytes(self.inbuf[4 : 4 + size])
+        del self.inbuf[: 4 + size]
+        self.counters["round_trips"] += 1
+        error = self._error(self.config.crc_error_rate)
+        if error or binascii.crc_hqx(data, 0xFFFF) != crc:
+            self.counters["crc_errors"] += 1
+            self._send(b"C")
+            return True
+
+        pages = (size + self.config.page - 1) // self.config.page
+        time.sleep(pages * self.config.program_time)
+        # NOR flash can only clear bits
+        end = self.write_pos + size
+        old = int.from_bytes(self.mem[self.write_pos : end], "little")
+        new = old & int.from_bytes(data, "little")
+        self.mem[self.write_pos : end] = new.to_bytes(size, "little")
+        self.write_pos = end
+        self._send(b"R")
+        return True
+
+    def _command(self, args: list):
+        config = self.config
+        if self.mode == "bootrom":
+            if args == ["run"]:
+                self.mode = "flasher"
+                self._send(FLASHER_MSG + PROMPT)
+            else:
+                self._send(PROMPT)
+            return
+
+        if not args:
+            self._send(FLASHER_MSG + PROMPT)
+        elif args[0] == "write":
+            self.write_pos = int(args[1], 0)
+            self.mode = "write"
+            self._send(b"Ready for data\n" + PROMPT)
+        elif args[0] == "erase":
+            offset = int(args[1], 0) & ~(config.sector - 1)
+            time.sleep(config.erase_time)
+            self.mem[offset : offset + config.sector] = b"\xff" * config.sector
+            self._send(PROMPT)
+        elif args[0] == "readcrc":
+            offset, size = int(args[1], 0), int(args[2], 0)
+            time.sleep(size / config.crc_rate)
+            crc = binascii.crc_hqx(self.mem[offset : offset + size], 0xFFFF)
+            self._send(f"{crc:#x}\n".encode() + PROMPT)
+        elif args[0] == "read":
+            offset, size = int(args[1], 0), int(args[2], 0)
+            data = self.mem[offset : offset + size]
+            if size and self._error(self.config.loss_rate):
+                del data[self.random.randrange(size)]
+                self.counters["lost_bytes"] += 1
+            self._send(PROMPT + bytes(data) + b"\n" + PROMPT)
+        elif args[0] == "custom":
+            count = int(args[2], 0)
+            ids = (list(config.jedec_id) if int(args[1], 0) == 0x9F else []) + [0] * count
+            self._send(" ".join(f"{x:02x}" for x in ids[:count]).encode() + b"\n" + PROMPT)
+        elif args[0] == "qspi":
+            self._send(f"Selected QSPI{args[1]}, padcfg v18 = {args[2]}\n".encode() + PROMPT)
+        elif args[0] == "baudrate":
+            # Prompt is sent at both old and new baudrate
+            self._send(f"Baudrate changed to {args[1]}\n".encode() + PROMPT)
+            self.baudrate = int(args[1])
+            self._send(PROMPT)
+        else:
+            self._send(b"Error: Unknown command\n" + PROMPT)
+
+
+class LatencyProxy:
+    """TCP server relaying connections to serial `port` with `latency` seconds added to every
+    chunk of data in both directions. Use as context manager, `url` is port for the tools."""
+
+    def __init__(self, port: str, latency: float):
+        self.port = port
+        self.latency = latency
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.url = f"socket://127.0.0.1:{self.server.getsockname()[1]}"
+        self.running = False
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+
+    def __enter__(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.server.close()
+
+    def _serve(self):
+        while self.running:
+            ready, _, _ = select.select([self.server], [], [], 0.1)
+            if ready:
+                conn, _ = self.server.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._relay(conn)
+
+    def _relay(self, conn: socket.socket):
+        fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY)
+        # Drop responses to the previous connection
+        termios.tcflush(fd, termios.TCIFLUSH)
+        # Data to deliver to socket and to pty: deques of (delivery time, data)
+        pending: dict = {conn: deque(), fd: deque()}
+        try:
+            while self.running:
+                now = time.monotonic()
+                for dest, queue in pending.items():
+                    while queue and queue[0][0] <= now:
+                        data = queue.popleft()[1]
+                        if dest is conn:
+                            conn.sendall(data)
+                        else:
+                            while data:
+                                data = data[os.write(fd, data) :]
+                deadlines = [queue[0][0] for queue in pending.values() if queue]
+                timeout = max(min(deadlines) - now, 0) if deadlines else 0.1
+                ready, _, _ = select.select([conn.fileno(), fd], [], [], timeout)
+                if conn.fileno() in ready:
+                    data = conn.recv(65536)
+                    if not data:
+                        return
+                    pending[fd].append((time.monotonic() + self.latency, data))
+                if fd in ready:
+                    pending[conn].append((time.monotonic() + self.latency, os.read(fd, 65536)))
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+            conn.close()
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """Add options for fields of EmulatorConfig (except JEDEC ID)"""
+    for field, default in EmulatorConfig._field_defaults.items():
+        if field == "jedec_id":
+            continue
+        option = "--" + field.replace("_", "-")
+        if isinstance(default, bool):
+            parser.add_argument(option, action="store_true")
+        else:
+            parser.add_argument(option, type=type(default), default=default)
+
+
+def config_from_args(args: argparse.Namespace) -> EmulatorConfig:
+    return EmulatorConfig(
+        **{k: getattr(args, k) for k in EmulatorConfig._fields if k != "jedec_id"}
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulator of MCom-03 QSPI flasher on pty")
+    add_config_arguments(parser)
+    parser.add_argument("--latency", type=float, help="serve also on TCP port with latency")
+    args = parser.parse_args()
+    with contextlib.ExitStack() as stack:
+        emulator = stack.enter_context(FlasherEmulator(config_from_args(args)))
+        print(f"Serving flasher on {emulator.port}")
+        if args.latency is not None:
+            proxy = stack.enter_context(LatencyProxy(emulator.port, args.latency))
+            print(f"Serving flasher on {proxy.url} with latency {args.latency} s")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(emulator.counters)
+
+
+if __name__ == "__main__":
+    main()
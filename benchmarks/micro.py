@@ -0,0 +1,289 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+"""Microbenchmarks of host hot loops.
+
+Every benchmark processes synthetic input sized like a real session (32 MiB image written by
+256-byte pages, 128 OTP words). Time of one run (minimum of several repeats) is divided by time
+of reference loop of plain Python code measured just before it, so the ratio depends on the
+code rather than on speed of the host. Ratios are compared with stored baseline, benchmarks
+which are slower than baseline by more than threshold percent are reported::
+
+    python -m benchmarks.micro                     # compare with baseline, threshold 20%
+    python -m benchmarks.micro --threshold 10 flash_pages
+    python -m benchmarks.micro --strict            # fail if any benchmark is slower
+    python -m benchmarks.micro --update-baseline   # save current ratios as baseline
+
+Ratios are still not exactly portable (hosts differ in speed of C code relative to interpreter,
+timing of a shared host is noisy), so the comparison is advisory by default. Baseline is
+regenerated by --update-baseline after changes which make a benchmark slower or faster on
+purpose and committed together with them.
+"""
+
+import argparse
+import binascii
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import timeit
+from collections.abc import Callable
+from typing import Optional
+
+from mcom03_flash_tools import UART, print_progress_bar
+from mcom03_flash_tools.mcom03_flash import flash
+from mcom03_flash_tools.mcom03_otp import OTP_WORDS_COUNT, OTP_Data, read_otp
+from mcom03_flash_tools.progress import ProgressReporter, TerminalSink
+
+MiB = 1024 * 1024
+IMAGE_SIZE = 32 * MiB
+PAGE_SIZE = 256
+BASELINE = os.path.join(os.path.dirname(__file__), "micro_baseline.json")
+DEFAULT_THRESHOLD = 20.0
+WARMUP_TIME = 0.5
+
+OTP_RESPONSE = "".join(
+    f"[{i}] Data: {i * 0x01010101:#010x}, ECC: {i & 0x7F:#04x} (ok)\n"
+    for i in range(OTP_WORDS_COUNT)
+)
+
+
+class ScriptedSerial:
+    """Serial port which answers every command line with `response` and emulates data frames
+    of the write command (replies R to every page)"""
+
+    def __init__(self, response: bytes):
+        self.response = response
+        self.out = io.BytesIO()
+        self.frame_state: Optional[str] = None
+        self.baudrate = 115200
+
+    def _reply(self, data: bytes):
+        pos = self.out.tell()
+        self.out.seek(0, io.SEEK_END)
+        self.out.write(data)
+        self.out.seek(pos)
+
+    def reset_input_buffer(self):
+        self.out = io.BytesIO()
+
+    def write(self, data) -> int:
+        if self.frame_state == "frame":
+            # Frame is written at once: size, CRC and data
+            if int.from_bytes(data[:2], "little"):
+                self._reply(b"R")
+            else:
+                self.frame_state = None
+                self._reply(b"#")
+        else:
+            if bytes(data).startswith(b"write "):
+                self.frame_state = "frame"
+            self._reply(bytes(data).rstrip(b"\r") + b"\r\n" + self.response + b"#")
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        return self.out.read(size)
+
+
+def make_uart(tty: ScriptedSerial) -> UART:
+    uart = UART.__new__(UART)
+    uart.prompt = "#"
+    uart.newline = b"\r"
+    uart.verbose = False
+    uart.tty = tty  # type: ignore
+    return uart
+
+
+def bench_reference():
+    """Reference loop of plain Python code (arithmetic, indexing and calls)"""
+    data = list(range(100000))
+
+    def run():
+        total = 0
+        for x in data:
+            total += abs(x & 0xFF)
+        return total
+
+    return run
+
+
+def bench_wait_for_string():
+    """Matching of prompt in response of 128 OTP words (~5 KiB)"""
+    tty = ScriptedSerial(b"")
+    uart = make_uart(tty)
+    data = OTP_RESPONSE.encode() + b"#"
+
+    def run():
+        tty.out = io.BytesIO(data)
+        uart.wait_for_string("#")
+
+    return run
+
+
+def bench_print_progress_bar():
+    """Progress bar updated after every page of 32 MiB image"""
+    pages = IMAGE_SIZE // PAGE_SIZE
+    null = open(os.devnull, "w")
+
+    def run():
+        with contextlib.redirect_stdout(null):
+            for i in range(pages):
+                print_progress_bar(i / pages * 100)
+
+    return run
+
+
+def bench_progress_update():
+    """Throttled progress bar updated after every page of 32 MiB image"""
+    pages = IMAGE_SIZE // PAGE_SIZE
+    reporter = ProgressReporter(TerminalSink(open(os.devnull, "w")))
+
+    def run():
+        with reporter.bar("Write", IMAGE_SIZE) as bar:
+            for i in range(pages):
+                bar.update(i * PAGE_SIZE)
+
+    return run
+
+
+def bench_page_crc():
+    """Slicing of 32 MiB image to pages and CRC16 of every page"""
+    image = memoryview(os.urandom(IMAGE_SIZE))
+
+    def run():
+        for pos in range(0, IMAGE_SIZE, PAGE_SIZE):
+            binascii.crc_hqx(image[pos : pos + PAGE_SIZE], 0xFFFF)
+
+    return run
+
+
+def bench_flash_pages():
+    """Host side of flash() for 32 MiB image (device replies immediately)"""
+    uart = make_uart(ScriptedSerial(b"Ready for data\n"))
+    image = os.urandom(IMAGE_SIZE)
+
+    def run():
+        flash(uart, 0, io.BytesIO(image), IMAGE_SIZE, True, PAGE_SIZE)
+
+    return run
+
+
+def bench_read_otp():
+    """Parsing of response to read of 128 OTP words"""
+    uart = make_uart(ScriptedSerial(OTP_RESPONSE.encode()))
+
+    def run():
+        read_otp(uart, 0, OTP_WORDS_COUNT, 0)
+
+    return run
+
+
+def bench_otp_data():
+    """Construction of OTP_Data from 128 words and conversion back to bytes"""
+    data = os.urandom(OTP_WORDS_COUNT * 4)
+
+    def run():
+        OTP_Data(data, 0).to_bytes()
+
+    return run
+
+
+# Benchmark name: (setup function, count of runs in one repeat)
+BENCHMARKS = {
+    "wait_for_string": (bench_wait_for_string, 100),
+    "print_progress_bar": (bench_print_progress_bar, 1),
+    "progress_update": (bench_progress_update, 1),
+    "page_crc": (bench_page_crc, 1),
+    "flash_pages": (bench_flash_pages, 1),
+    "read_otp": (bench_read_otp, 100),
+    "otp_data": (bench_otp_data, 1000),
+}
+
+
+# Setup function and count of runs of the reference loop
+REFERENCE = (bench_reference, 10)
+
+
+def measure(setup: Callable, number: int, repeat: int) -> float:
+    """Return minimal time of one run of benchmark in seconds"""
+    run = setup()
+    # Warm up caches and let CPU frequency rise, otherwise short benchmarks are unstable
+    deadline = time.perf_counter() + WARMUP_TIME
+    while time.perf_counter() < deadline:
+        run()
+    timer = timeit.Timer(run)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def check(results: dict, baseline: dict, threshold: float) -> list:
+    """Return names of benchmarks which ratios to the reference loop are greater than ratios in
+    baseline by more than `threshold` %
+
+    >>> check({"a": 1.3, "b": 1.1, "c": 5.0}, {"a": 1.0, "b": 1.0}, 20)
+    ['a']
+    """
+    return [
+        name
+        for name, value in results.items()
+        if name in baseline and value > baseline[name] * (1 + threshold / 100)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of host hot loops")
+    parser.add_argument(
+        "names", nargs="*", help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="count of repeats")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="allowed slowdown relative to baseline in percent",
+    )
+    parser.add_argument(
+        "--strict", action="store_true", help="exit with error if any benchmark is slower"
+    )
+    parser.add_argument("--update-baseline", action="store_true", help="save results as baseline")
+    args = parser.parse_args()
+    unknown = [x for x in args.names if x not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        # Reference is measured next to every benchmark, so load of the host changing during
+        # the run affects both of them
+        reference = measure(*REFERENCE, args.repeat)
+        duration = measure(*BENCHMARKS[name], args.repeat)
+        results[name] = duration / reference
+        line = f"{name:20} {duration * 1000:10.3f} ms {results[name]:10.3f} x reference"
+        if name in baseline:
+            change = (results[name] / baseline[name] - 1) * 100
+            line += f"  baseline {baseline[name]:10.3f} ({change:+.1f}%)"
+        print(line)
+
+    if args.update_baseline:
+        baseline.update({k: round(v, 4) for k, v in results.items()})
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"Baseline is saved to {args.baseline}")
+        return 0
+
+    regressions = check(results, baseline, args.threshold)
+    if regressions:
+        print(f"Slower than baseline by more than {args.threshold}%: {', '.join(regressions)}")
+        if args.strict:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
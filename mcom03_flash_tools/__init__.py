@@ -1,19 +1,57 @@
 # Copyright 2021 RnD Center "ELVEES", JSC
 
 import abc
+import binascii
+import contextlib
+import functools
 import importlib.metadata
 import importlib.resources
+import mmap
+import os
+import queue
 import sys
+import threading
 import time
 from collections import namedtuple
+from collections.abc import Callable
 from typing import Optional
 
 import serial
 
+from mcom03_flash_tools.adaptive import AdaptiveBaudrate
+from mcom03_flash_tools.calibration import Calibration, calibrated_timeout, observe_rate
+from mcom03_flash_tools.line import (
+    binary_input,
+    check_flow_control,
+    disable_nagle,
+    find_usb_port,
+    serial_flow_control,
+    usb_port_id,
+)
+from mcom03_flash_tools.metrics import Metrics, count, measure
+from mcom03_flash_tools.profiler import Profiler
+from mcom03_flash_tools.progress import format_bar, progress_bar
+from mcom03_flash_tools.trace import REPLAY_PREFIX, ReplaySerial
+
 FlashType = namedtuple("FlashType", "name size sector page id_bytes")
 
 KiB = 1024
 MiB = 1024 * KiB
+# Pool of buffers for data passed from UART to a worker thread
+SINK_BUFFERS = 8
+SINK_BUFFER_SIZE = 256 * KiB
+# Read is stalled if no data is received for this time in seconds
+READ_STALL_TIMEOUT = 2.0
+# Granularity of verification of data received before stall
+VERIFY_BLOCK = 4 * KiB
+# Interval of polling of serial ports while waiting for disconnected USB-UART adapter
+RECONNECT_POLL_INTERVAL = 0.2
+# After reconnect the rest of interrupted response is skipped until the line is silent for this
+# time in seconds, then flasher prompt is requested up to RESYNC_ATTEMPTS times
+RESYNC_QUIET = 0.5
+RESYNC_ATTEMPTS = 3
+# Notice is printed if the rest of interrupted response is received longer than this (seconds)
+RESYNC_NOTICE = 2.0
 FLASH_LIST = [
     FlashType("FM25W128", 16 * MiB, 64 * KiB, 256, [0xA1, 0x28, 0x18]),
     FlashType("M25P32", 4 * MiB, 64 * KiB, 256, [0x20, 0x20, 0x16, 0x10]),
@@ -43,13 +81,41 @@ except importlib.metadata.PackageNotFoundError:
 class UART:
     """Class for work with UART console."""
 
-    def __init__(self, prompt, port, newline=b"\r", verbose=False, baudrate=115200, timeout=0.5):
+    # Collector of performance metrics
+    metrics: Optional[Metrics] = None
+    # Profiler of UART exchange (see profiler.enable_profiling())
+    profiler: Optional[Profiler] = None
+    # Store of measured timings used to derive timeouts of flash operations
+    calibration: Optional[Calibration] = None
+    # Selector of baudrate on errors (baudrate is not changed by errors if None)
+    adaptive: Optional[AdaptiveBaudrate] = None
+    # Round trip time of the link (measured by upload_flasher()), it is added to all timeouts
+    latency = 0.0
+    # Time in seconds to wait for USB-UART adapter after disconnect (0: do not reconnect)
+    reconnect_timeout = 0.0
+    # Banner of flasher (set by upload_flasher()) to check that flasher is alive after reconnect
+    flasher_msg: Optional[str] = None
+    # Receiver of status messages of operations (they are printed to stdout if None)
+    on_message: Optional[Callable[[str], None]] = None
+
+    def __init__(
+        self,
+        prompt,
+        port,
+        newline=b"\r",
+        verbose=False,
+        baudrate=115200,
+        timeout=0.5,
+        flow_control="none",
+    ):
         """Parameters
         ----------
         prompt : str
             expected command line prompt
         port : str
-            serial port for use (example: /dev/ttyUSB0)
+            serial port for use (example: /dev/ttyUSB0), pyserial URL (example:
+            rfc2217://host:2217, socket://host:3001) or trace file to replay
+            (example: replay://session.trace?speed=2, see trace.ReplaySerial)
         newline : str
             new line delimiter
         verbose : bool
@@ -58,11 +124,30 @@ class UART:
             UART speed in bit/sec
         timeout : float
             timeout for read() operations and affects the accuracy of the command execution time
+        flow_control : str
+            flow control of serial port: none, rtscts or xonxoff (disabled while binary data is
+            received, see line.binary_input())
         """
         self.prompt = prompt
         self.newline = newline
         self.verbose = verbose
-        self.tty = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+        # USB serial number and interface of adapter to find it after disconnect
+        self.port_id: Optional[tuple] = None
+        if port.startswith(REPLAY_PREFIX):
+            self.tty = ReplaySerial.from_url(port, timeout=timeout)
+        else:
+            self.port_id = usb_port_id(port)
+            # Port is locked, so other instances of the tools (e.g. discover command) do not
+            # interfere with the session
+            self.tty = serial.serial_for_url(
+                port,
+                baudrate=baudrate,
+                timeout=timeout,
+                exclusive=True,
+                **serial_flow_control(flow_control),
+            )
+            check_flow_control(self.tty, flow_control)
+            disable_nagle(self.tty)
 
     def wait_for_string(self, expected, timeout=1):
         """Method to wait for pattern `expected` to be received from UART.
@@ -90,7 +175,7 @@ class UART:
             return any(map(resp.endswith, expected))
 
         if timeout is not None:
-            time_end = time.monotonic() + timeout
+            time_end = time.monotonic() + timeout + self.latency
         else:
             time_end = sys.float_info.max
         resp = ""
@@ -100,6 +185,8 @@ class UART:
                 continue
             resp += ch.decode("utf-8", errors="ignore")
 
+        if self.profiler is not None:
+            self.profiler.finish()
         result = resp.replace("\r", "")
         if self.verbose and result:
             print(result, end="")
@@ -125,26 +212,101 @@ class UART:
         str
             response string
         """
+        time_start = time.monotonic()
         self.tty.reset_input_buffer()
-        self.tty.write(cmd.encode("utf-8") + self.newline)
-        success, resp = self.wait_for_string(self.prompt, timeout)
+        if self.profiler is not None:
+            self.profiler.start(cmd.split(" ")[0] or "(empty)")
+        try:
+            self.tty.write(cmd.encode("utf-8") + self.newline)
+            success, resp = self.wait_for_string(self.prompt, timeout)
+        except serial.SerialException as e:
+            # Command is repeated after reconnect of USB-UART adapter
+            self.reconnect(e)
+            self.tty.write(cmd.encode("utf-8") + self.newline)
+            success, resp = self.wait_for_string(self.prompt, timeout)
+        if self.metrics is not None and self.metrics.record is not None:
+            self.metrics.command(cmd.split(" ")[0] or "(empty)", time.monotonic() - time_start)
         if not success:
             return None
 
         # Return only output of command (without cmd + "\n" and command prompt)
         return resp[len(cmd) + 1 : -len(self.prompt)] if strip_echo else resp
 
+    def skip_input(self, quiet: float = RESYNC_QUIET):
+        """Drop received data until nothing is received for `quiet` seconds"""
+        time_start = time.monotonic()
+        time_quiet = time_start + quiet
+        notice = False
+        while time.monotonic() < time_quiet:
+            if self.tty.read(max(self.tty.in_waiting, 1)):
+                time_quiet = time.monotonic() + quiet
+                if not notice and time.monotonic() - time_start > RESYNC_NOTICE:
+                    self.message(
+                        "Waiting for flasher to finish sending data of interrupted command..."
+                    )
+                    notice = True
+
+    def message(self, text: str):
+        """Report status message to on_message callback or print it"""
+        if self.on_message is not None:
+            self.on_message(text.strip())
+        else:
+            print(text)
+
+    def reconnect(self, error: Exception, resync: Optional[Callable[[], None]] = None):
+        """Reopen serial port after disconnect of USB-UART adapter and restore command line of
+        flasher (it keeps running on the board). The adapter is found by USB serial number, so
+        its device name may change. Port is opened with the same settings (baudrate changed
+        by flasher, flow control). The rest of interrupted response is skipped. Flasher can not
+        be stopped while it sends data of read command, so after disconnect during read this
+        waits till all requested data is sent (remaining size / (baudrate / 10) seconds).
+        `resync` is called then to finish interrupted operation which waits for input (write
+        session). `error` is raised if reconnect is disabled or the adapter does not appear in
+        reconnect_timeout seconds."""
+        if not self.reconnect_timeout or self.port_id is None:
+            raise error
+        self.message(f"\nSerial port {self.tty.port} is lost ({error}), waiting for the adapter...")
+        with contextlib.suppress(OSError, serial.SerialException):
+            self.tty.close()
+        time_end = time.monotonic() + self.reconnect_timeout
+        while True:
+            port = find_usb_port(self.port_id)
+            if port is not None:
+                try:
+                    self.tty.port = port
+                    self.tty.open()  # type: ignore  # ports found by USB ID are serial.Serial
+                    break
+                except serial.SerialException:
+                    pass  # device node is not accessible yet
+            if time.monotonic() > time_end:
+                raise error
+            time.sleep(RECONNECT_POLL_INTERVAL)
+
+        # Skip the rest of interrupted response (data of read, prompt after erase)
+        self.skip_input()
+        if resync is not None:
+            resync()
+        for _ in range(RESYNC_ATTEMPTS):
+            response = self.run("")
+            if response is not None and (self.flasher_msg or "") in response:
+                break
+        else:
+            raise Exception(f"Flasher does not respond after reconnect to {port}") from error
+        count(self, "reconnects")
+        self.message(f"Serial port is reconnected as {port}")
+
 
 def print_progress_bar(percentage: float, width: int = 20):
-    """Update progress bar"""
-    PROGRESS_SYMBOLS = [""] + [chr(0x258F - x) for x in range(7)]
-    count = min(width * percentage / 100, width)
-    count_full = int(count)
-    bar = chr(0x2588) * count_full
-    rest_char_id = int((count - count_full) * 8)
-    bar += PROGRESS_SYMBOLS[rest_char_id]
-    bar += " " * (width - len(bar))
-    print(f"\r[{bar}] {percentage:5.1f}%", end="")
+    """Update progress bar (see progress.progress_bar() for throttled progress bars with rate
+    and ETA)"""
+    print(f"\r[{format_bar(percentage, width)}] {percentage:5.1f}%", end="")
+    sys.stdout.flush()
+
+
+def print_progress_bytes(complete: int, duration: float):
+    """Show progress for data of unknown size"""
+    rate = complete / duration / 1024 if duration else 0
+    print(f"\r{complete / 1024:10.2f} KiB {rate:7.1f} KiB/s", end="")
     sys.stdout.flush()
 
 
@@ -153,56 +315,306 @@ def clear_progress_bar(width: int = 20):
     print("\r" + " " * (width + 10) + "\r", end="")
 
 
+def default_cache_dir() -> str:
+    """Return directory for on-disk caches of the tools. MCOM03_FLASH_CACHE environment variable
+    has priority over XDG_CACHE_HOME."""
+    path = os.environ.get("MCOM03_FLASH_CACHE")
+    if path:
+        return path
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(xdg_cache, "mcom03-flash-tools")
+
+
+@functools.lru_cache(maxsize=32)
+def blank_crc(size: int) -> int:
+    """Return CRC16 of erased flash region of `size` bytes
+
+    >>> blank_crc(4) == binascii.crc_hqx(b"\\xff" * 4, 0xFFFF)
+    True
+    >>> blank_crc(0)
+    65535
+    """
+    chunk = b"\xff" * min(size, 64 * KiB)
+    crc = 0xFFFF
+    for _ in range(size // len(chunk) if chunk else 0):
+        crc = binascii.crc_hqx(chunk, crc)
+    return binascii.crc_hqx(chunk[: size % len(chunk)] if chunk else b"", crc)
+
+
+def read_crc(uart: UART, offset: int, size: int) -> int:
+    """Return CRC16 of flash region calculated by flasher. Callers measure it by their own phase
+    (verify, fingerprint, ...)."""
+    timeout = calibrated_timeout(uart, "crc_rate", size, size / 10000 + 5)
+    time_start = time.monotonic()
+    response = uart.run(f"readcrc {offset} {size}", timeout=timeout)
+    if response is None:
+        raise Exception(f"No response to readcrc command (offset {offset:#x}, size {size})")
+    observe_rate(uart, "crc_rate", size, time.monotonic() - time_start)
+    return int(response, 0)
+
+
+def read_chunk_size(baudrate: int) -> int:
+    """Return size of chunk to request from serial port: data received in ~50 ms
+
+    >>> read_chunk_size(115200), read_chunk_size(921600), read_chunk_size(300)
+    (576, 4608, 256)
+    """
+    return max(256, min(64 * KiB, baudrate // 10 // 20))
+
+
+def verified_prefix(uart: UART, offset: int, data, block: int = VERIFY_BLOCK) -> int:
+    """Return size of the longest prefix of `data` (multiple of `block`) which CRC16 is equal to
+    CRC16 of flash at `offset` (binary search by readcrc commands)"""
+    low, high = 0, len(data) // block
+    while low < high:
+        mid = (low + high + 1) // 2
+        if binascii.crc_hqx(data[: mid * block], 0xFFFF) == read_crc(uart, offset, mid * block):
+            low = mid
+        else:
+            high = mid - 1
+    return low * block
+
+
+def _receive(uart: UART, offset: int, view: memoryview, complete: int, bar, progress) -> int:
+    """Receive data of read command to `view` starting from `complete` bytes. Return count of
+    received bytes when all data is received or no data is received for READ_STALL_TIMEOUT.
+    After reconnect of USB-UART adapter the rest of data is requested again."""
+    size = len(view)
+    chunk = read_chunk_size(uart.tty.baudrate)
+    time_data = time.monotonic()
+    while complete < size:
+        try:
+            received = uart.tty.readinto(view[complete : complete + chunk]) or 0
+        except serial.SerialException as e:
+            uart.reconnect(e)
+            uart.run(f"read {offset + complete} {size - complete} bin")
+            time_data = time.monotonic()
+            continue
+        if not received:
+            if time.monotonic() - time_data > READ_STALL_TIMEOUT:
+                break
+            continue
+        time_data = time.monotonic()
+        complete += received
+        bar.update(complete)
+        if progress is not None:
+            progress(complete, size)
+    return complete
+
+
+def _resume_read(uart: UART, offset: int, view: memoryview, received: int) -> int:
+    """Recover from stall of read: restore command line, step baudrate down and read again
+    after the longest received prefix which matches flash. Return size of the prefix."""
+    count(uart, "read_stalls")
+    baudrate = uart.adaptive.stall() if uart.adaptive is not None else None
+    if baudrate is None:
+        raise Exception(f"Read stalled: {received} of {len(view)} bytes are received")
+    # Flasher has sent all data, so it responds to empty command with prompt
+    if uart.run("") is None:
+        raise Exception("Flasher does not respond after stall of read")
+    switch_baudrate(uart, baudrate)
+    with measure(uart, "resume", received):
+        complete = verified_prefix(uart, offset, view[:received])
+    uart.message(
+        f"Read is interrupted at {offset + received:#x}, resuming from {offset + complete:#x}"
+    )
+    uart.run(f"read {offset + complete} {len(view) - complete} bin")
+    return complete
+
+
+def read_into(
+    uart: UART,
+    offset: int,
+    buf,
+    hide_progress_bar: bool,
+    progress: Optional[Callable[[int, int], None]] = None,
+):
+    """Read flash region of len(buf) bytes directly into writable buffer `buf` (bytearray, mmap)
+    without intermediate copies. `progress` is called with count of read and total bytes after
+    every received chunk. If uart.adaptive is set then read is resumed at lower baudrate after
+    stall of data, otherwise Exception is raised."""
+    time_start = time.monotonic()
+    with measure(uart, "read", len(buf)), binary_input(uart.tty):
+        view = memoryview(buf).cast("B")
+        size = len(view)
+        uart.run(f"read {offset} {size} bin")
+        complete = 0
+        with progress_bar("Read", size, hide_progress_bar) as bar:
+            while True:
+                complete = _receive(uart, offset, view, complete, bar, progress)
+                # Data is followed by newline and prompt, if they are not received as expected
+                # then some bytes are lost
+                if complete == size and (uart.wait_for_string("\n#")[0] or uart.adaptive is None):
+                    break
+                complete = _resume_read(uart, offset, view, complete)
+
+        view.release()
+    observe_rate(uart, "link_rate", size, time.monotonic() - time_start)
+
+
+def read_to_sink(
+    uart: UART,
+    offset: int,
+    size: int,
+    sink,
+    hide_progress_bar: bool,
+    buffers: int = SINK_BUFFERS,
+    buffer_size: int = SINK_BUFFER_SIZE,
+):
+    """Read flash region and pass data to `sink(memoryview)` in a worker thread. Data is read into
+    a pool of preallocated buffers, so slow sink (compression, pipe) does not stall reading from
+    UART until all buffers are in use. The memoryview is valid only during the `sink` call."""
+    with measure(uart, "read", size), binary_input(uart.tty):
+        free: queue.Queue = queue.Queue()
+        ready: queue.Queue = queue.Queue()
+        for _ in range(buffers):
+            free.put(bytearray(buffer_size))
+        errors: list[Exception] = []
+
+        def worker():
+            while True:
+                item = ready.get()
+                if item is None:
+                    return
+                buf, length = item
+                try:
+                    if not errors:
+                        with memoryview(buf) as view:
+                            sink(view[:length])
+                except Exception as e:
+                    errors.append(e)
+                free.put(buf)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        chunk = read_chunk_size(uart.tty.baudrate)
+        uart.run(f"read {offset} {size} bin")
+        complete = 0
+        bar = progress_bar("Read", size, hide_progress_bar)
+        try:
+            while complete < size:
+                buf = free.get()
+                length = min(buffer_size, size - complete)
+                filled = 0
+                time_data = time.monotonic()
+                with memoryview(buf) as view:
+                    while filled < length:
+                        end = min(filled + chunk, length)
+                        try:
+                            received = uart.tty.readinto(view[filled:end]) or 0
+                        except serial.SerialException as e:
+                            # Data received before disconnect is kept, the rest is read again
+                            uart.reconnect(e)
+                            done = complete + filled
+                            uart.run(f"read {offset + done} {size - done} bin")
+                            time_data = time.monotonic()
+                            continue
+                        if received:
+                            time_data = time.monotonic()
+                        elif time.monotonic() - time_data > READ_STALL_TIMEOUT:
+                            # Data is already passed to sink, so read can not be resumed
+                            count(uart, "read_stalls")
+                            raise Exception(
+                                f"Read stalled: {complete + filled} of {size} bytes are received"
+                            )
+                        filled += received
+                        bar.update(complete + filled)
+                complete += filled
+                ready.put((buf, filled))
+        finally:
+            bar.close()
+            ready.put(None)
+            thread.join()
+
+        uart.wait_for_string("#")
+        if errors:
+            raise errors[0]
+
+
+def read_to_file(uart: UART, offset: int, size: int, f, hide_progress_bar: bool):
+    """Read flash region and write it to binary file object `f` at its current position"""
+    buf = bytearray(size)
+    read_into(uart, offset, buf, hide_progress_bar)
+    f.write(buf)
+
+
 def read_image(uart: UART, offset: int, size: int, fname: str, hide_progress_bar: bool):
-    uart.run(f"read {offset} {size} bin")
-    complete = 0
-    with open(fname, "wb") as f:
-        while complete < size:
-            if not hide_progress_bar:
-                print_progress_bar(complete / size * 100)
-            block_size = size - complete if size - complete < 256 else 256
-            data = uart.tty.read(block_size)
-            complete += len(data)
-            f.write(data)
-
-    uart.wait_for_string("#")
-    if not hide_progress_bar:
-        clear_progress_bar()
+    with open(fname, "wb+") as f:
+        if not size:
+            return
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as buf:
+            read_into(uart, offset, buf, hide_progress_bar)
 
 
 def upload_flasher(
     uart: UART, default_flasher_name: str, flasher_msg: str, flasher: Optional[str] = None
 ):
     """Communicate with BootROM to upload"""
+    with measure(uart, "upload"):
+        uart.message("Uploading flasher to on-chip RAM...")
+
+        # recognize if flasher is already executing. Upload only if BootROM terminal is found
+        time_start = time.monotonic()
+        response = uart.run("")
+        if response is None:
+            raise RuntimeError("BootROM UART terminal prompt not found")
+        # Round trip of network serial servers can be comparable with timeouts of responses
+        uart.latency = time.monotonic() - time_start
+        if flasher_msg in response:
+            uart.message("Flasher is already executing")
+            uart.flasher_msg = flasher_msg
+            return
+
+        if flasher is None:
+            ref = importlib.resources.files(__package__) / default_flasher_name
+            with ref.open("rb") as file_:
+                # BootROM doesn't have command, just send ihex file
+                uart.tty.write(file_.read())
+        else:
+            with open(flasher, "rb") as file_:
+                uart.tty.write(file_.read())
 
-    print("Uploading flasher to on-chip RAM...")
+        # BUG: After uploading ihex file BootROM sends prompt twice
+        uart.wait_for_string(uart.prompt, timeout=1)
+        uart.wait_for_string(uart.prompt, timeout=1)
 
-    # recognize if flasher is already executing. Upload only if BootROM terminal is found
-    response = uart.run("")
-    if response is None:
-        raise RuntimeError("BootROM UART terminal prompt not found")
-    if flasher_msg in response:
-        print("Flasher is already executing")
-        return
+        response = uart.run("run")  # BootROM command to execute flasher
+        if response is None or flasher_msg not in response:
+            raise Exception(f"{flasher_msg} does not respond, response {response}")
+        uart.flasher_msg = flasher_msg
+
+        time.sleep(0.1)  # Delay for flasher startup
 
-    if flasher is None:
-        ref = importlib.resources.files(__package__) / default_flasher_name
-        with ref.open("rb") as file_:
-            # BootROM doesn't have command, just send ihex file
-            uart.tty.write(file_.read())
-    else:
-        with open(flasher, "rb") as file_:
-            uart.tty.write(file_.read())
 
-    # BUG: After uploading ihex file BootROM sends prompt twice
-    uart.wait_for_string(uart.prompt, timeout=1)
-    uart.wait_for_string(uart.prompt, timeout=1)
+def change_baudrate(uart: UART, baudrate: int):
+    with measure(uart, "baudrate"):
+        response = uart.run(f"baudrate {baudrate}")
+        if "Error" in response:
+            raise Exception(response)
 
-    response = uart.run("run")  # BootROM command to execute flasher
-    if response is None or flasher_msg not in response:
-        raise Exception(f"{flasher_msg} does not respond, response {response}")
+        uart.tty.baudrate = baudrate
+        ok, _ = uart.wait_for_string(uart.prompt, timeout=1)
+        if not ok:
+            # Flasher will change baudrate and output command line prompt immediately.
+            # We need to recheck command line if host took too long to adjust speed and missed
+            # previous prompt.
+            response = uart.run("")
+            if response is None:
+                raise Exception("Failed to change baudrate")
 
-    time.sleep(0.1)  # Delay for flasher startup
+        # Try to wait for prompt for case if early when changing speed was received broken
+        # symbol '#'
+        uart.wait_for_string(uart.prompt, timeout=0.1)
+
+
+def switch_baudrate(uart: UART, baudrate: int):
+    """Change baudrate selected by uart.adaptive and report the change"""
+    old = uart.tty.baudrate
+    direction = "down" if baudrate < old else "up"
+    uart.message(f"\nUART baudrate is changed from {old} to {baudrate} ({direction} by error rate)")
+    count(uart, f"baudrate_{direction}")
+    change_baudrate(uart, baudrate)
 
 
 def _get_flash_type(uart: UART):
@@ -214,11 +626,17 @@ def _get_flash_type(uart: UART):
     return FlashType(None, None, None, None, ids)
 
 
-def get_flash_type(uart: UART, flash_size: int, flash_sector: int, flash_page: int):
+def get_flash_type(
+    uart: UART,
+    flash_size: Optional[int],
+    flash_sector: Optional[int],
+    flash_page: Optional[int],
+):
     """Read device ID bytes and detect SPI flash type. Replace flash parameters with custom
     values (if value is not None). Return FlashType with name is None for unknown SPI flash.
     """
-    flash = _get_flash_type(uart)
+    with measure(uart, "detect"):
+        flash = _get_flash_type(uart)
 
     # Create custom flash type if any of parameters is not None
     if [x for x in [flash_size, flash_sector, flash_page] if x is not None]:
@@ -0,0 +1,77 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+from collections import deque
+from typing import Optional
+
+# Baudrates to step down to on bursts of errors
+BAUDRATE_LADDER = [3000000, 2000000, 1500000, 1000000, 921600, 460800, 230400, 115200]
+# Baudrate is stepped down if WINDOW_ERRORS of the last WINDOW frames are rejected
+WINDOW = 64
+WINDOW_ERRORS = 3
+# Baudrate is stepped up after this count of frames accepted without errors. The count is
+# doubled after every step down, so unstable baudrate is retried more and more rarely.
+CLEAN_FRAMES = 4096
+
+
+def baudrate_ladder(baudrate: int) -> list[int]:
+    """Return baudrates from `baudrate` down to 115200
+
+    >>> baudrate_ladder(921600)
+    [921600, 460800, 230400, 115200]
+    >>> baudrate_ladder(1200000)
+    [1200000, 1000000, 921600, 460800, 230400, 115200]
+    >>> baudrate_ladder(115200)
+    [115200]
+    """
+    return [baudrate] + [x for x in BAUDRATE_LADDER if x < baudrate]
+
+
+class AdaptiveBaudrate:
+    """Selector of UART baudrate by rate of errors in sliding window of frames. frame() is called
+    with result of every data frame, stall() after stall of data stream. They return new baudrate
+    if it has to be changed.
+
+    >>> adaptive = AdaptiveBaudrate(921600)
+    >>> [adaptive.frame(error) for error in [True, False, True, False, True]]
+    [None, None, None, None, 460800]
+    >>> adaptive.clean_frames = 2
+    >>> [adaptive.frame(False) for _ in range(2)]
+    [None, 921600]
+    >>> adaptive.stall(), adaptive.stall(), adaptive.stall(), adaptive.stall()
+    (460800, 230400, 115200, None)
+    """
+
+    def __init__(self, baudrate: int):
+        self.ladder = baudrate_ladder(baudrate)
+        self.level = 0
+        self.window: deque[bool] = deque(maxlen=WINDOW)
+        self.clean = 0
+        self.clean_frames = CLEAN_FRAMES
+
+    @property
+    def baudrate(self) -> int:
+        return self.ladder[self.level]
+
+    def _step(self, direction: int) -> Optional[int]:
+        level = self.level + direction
+        if not 0 <= level < len(self.ladder):
+            return None
+        if direction > 0:
+            self.clean_frames *= 2
+        self.level = level
+        self.window.clear()
+        self.clean = 0
+        return self.baudrate
+
+    def frame(self, error: bool) -> Optional[int]:
+        self.window.append(error)
+        if error:
+            self.clean = 0
+            return self._step(1) if sum(self.window) >= WINDOW_ERRORS else None
+        self.clean += 1
+        if self.level > 0 and self.clean >= self.clean_frames:
+            return self._step(-1)
+        return None
+
+    def stall(self) -> Optional[int]:
+        return self._step(1)
@@ -0,0 +1,265 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import json
+import os
+import tempfile
+import time
+from collections import namedtuple
+from typing import Optional
+
+from mcom03_flash_tools.metrics import file_lock
+
+# Timings of flash operations and throughput of UART link. erase_sector and page_program are
+# durations of one round trip in seconds (including response latency), crc_rate and link_rate
+# are bytes per second.
+Timings = namedtuple("Timings", "erase_sector page_program crc_rate link_rate")
+RATES = ["crc_rate", "link_rate"]
+# Name of calibration store in cache directory
+CALIBRATION_FILE = "calibration.json"
+
+# Rough timings used until they are measured
+ERASE_SECTOR_TIME = 0.3
+PAGE_PROGRAM_TIME = 0.001
+CRC_RATE = 4 * 1024 * 1024
+
+# Weight of new observation in moving average
+SMOOTHING = 0.3
+# Timeout is the worst observed duration multiplied by SAFETY_FACTOR plus TIMEOUT_MARGIN
+SAFETY_FACTOR = 5
+TIMEOUT_MARGIN = 1.0
+# Lower bounds of derived timeouts, so a few fast observations do not make timeouts too short:
+# maximum sector erase time of supported flash types by datasheets (2.6 s for S25FL128S and
+# S25FL256S, 2 s for W25Q) and fixed part of the default readcrc timeout
+MIN_TIMEOUTS = {"erase_sector": 3.0, "crc_rate": 5.0}
+# Observations of shorter operations are dominated by command latency and are ignored
+MIN_RATE_SIZES = {"crc_rate": 64 * 1024, "link_rate": 16 * 1024}
+MIN_WRITE_PAGES = 16
+
+
+def default_timings(baudrate: int) -> Timings:
+    """
+    >>> default_timings(115200)
+    Timings(erase_sector=0.3, page_program=0.001, crc_rate=4194304, link_rate=11520.0)
+    """
+    return Timings(ERASE_SECTOR_TIME, PAGE_PROGRAM_TIME, CRC_RATE, baudrate / 10)
+
+
+def _merge(theirs: Optional[dict], ours: dict, rate: bool) -> dict:
+    """Return timing updated by this session merged with timing saved by other session meanwhile:
+    average of this session and the worst value of both
+
+    >>> theirs = {'mean': 1.0, 'worst': 3.0, 'count': 5}
+    >>> _merge(theirs, {'mean': 1.5, 'worst': 2.0, 'count': 3}, False)
+    {'mean': 1.5, 'worst': 3.0, 'count': 5}
+    """
+    if theirs is None:
+        return ours
+    worst = min(theirs["worst"], ours["worst"]) if rate else max(theirs["worst"], ours["worst"])
+    return {**ours, "worst": worst, "count": max(theirs["count"], ours["count"])}
+
+
+def _smooth(timing: Optional[dict], value: float, rate: bool) -> dict:
+    """Return timing updated by observed value: moving average and the worst value
+
+    >>> _smooth(None, 2.0, False)
+    {'mean': 2.0, 'worst': 2.0, 'count': 1}
+    >>> _smooth({'mean': 2.0, 'worst': 2.0, 'count': 1}, 1.0, False)
+    {'mean': 1.7, 'worst': 2.0, 'count': 2}
+    >>> _smooth({'mean': 100.0, 'worst': 100.0, 'count': 1}, 50.0, True)['worst']
+    50.0
+    """
+    if timing is None:
+        return {"mean": round(value, 9), "worst": round(value, 9), "count": 1}
+    worst = min(timing["worst"], value) if rate else max(timing["worst"], value)
+    return {
+        "mean": round(timing["mean"] + (value - timing["mean"]) * SMOOTHING, 9),
+        "worst": round(worst, 9),
+        "count": timing["count"] + 1,
+    }
+
+
+class Calibration:
+    """Store of timings measured during previous sessions. Flash timings are keyed by flash type
+    name, link throughput by baudrate. Every timing keeps moving average of observed values
+    (used for estimates) and the worst value (used for timeouts). Only fields changed by this
+    session are saved, so concurrent sessions do not overwrite timings of each other."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = self._load()
+        self.flash_name: Optional[str] = None
+        # Changed fields: (section, key, field)
+        self.changed: set[tuple[str, str, str]] = set()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data.setdefault("flash", {})
+        data.setdefault("link", {})
+        return data
+
+    def select(self, flash_type, remember: bool = True):
+        """Select flash type which timings are observed and used. If `remember` is True then
+        flash type is saved as the last used one."""
+        self.flash_name = flash_type.name or "unknown"
+        if not remember:
+            return
+        entry = self.data["flash"].setdefault(self.flash_name, {})
+        entry["geometry"] = [flash_type.size, flash_type.sector, flash_type.page]
+        entry["used"] = time.time()
+        self.changed.update(
+            {("flash", self.flash_name, "geometry"), ("flash", self.flash_name, "used")}
+        )
+
+    def last_flash(self) -> Optional[tuple]:
+        """Return name, size, sector and page of the last used flash type"""
+        if not self.data["flash"]:
+            return None
+        name, entry = max(self.data["flash"].items(), key=lambda x: x[1].get("used", 0))
+        return (name, *entry["geometry"])
+
+    def _key(self, name: str, baudrate: int) -> Optional[tuple[str, str]]:
+        """Return section and key of entry which keeps timing `name`"""
+        if name == "link_rate":
+            return "link", str(baudrate)
+        if self.flash_name is not None:
+            return "flash", self.flash_name
+        return None
+
+    def _entry(self, name: str, baudrate: int) -> Optional[dict]:
+        key = self._key(name, baudrate)
+        return self.data[key[0]].get(key[1]) if key is not None else None
+
+    def observe(self, name: str, value: float, baudrate: int):
+        key = self._key(name, baudrate)
+        if key is None or value <= 0:
+            return
+        entry = self.data[key[0]].setdefault(key[1], {})
+        entry[name] = _smooth(entry.get(name), value, name in RATES)
+        self.changed.add((*key, name))
+
+    def timing(self, name: str, baudrate: int) -> Optional[dict]:
+        entry = self._entry(name, baudrate)
+        return entry.get(name) if entry is not None else None
+
+    def timings(self, baudrate: int) -> Timings:
+        """Return average timings (default values for not measured ones)"""
+        values = default_timings(baudrate)._asdict()
+        for name in values:
+            timing = self.timing(name, baudrate)
+            if timing is not None:
+                values[name] = timing["mean"]
+        return Timings(**values)
+
+    def timeout(self, name: str, baudrate: int, amount: float) -> Optional[float]:
+        """Return timeout of operation on `amount` of units (sectors, pages or bytes for rates)
+        derived from the worst observed timing, but not shorter than MIN_TIMEOUTS. None if the
+        timing is not measured yet."""
+        timing = self.timing(name, baudrate)
+        if timing is None:
+            return None
+        duration = amount / timing["worst"] if name in RATES else amount * timing["worst"]
+        return max(duration * SAFETY_FACTOR + TIMEOUT_MARGIN, MIN_TIMEOUTS.get(name, 0.0))
+
+    def save(self):
+        """Save changed fields merged with the file re-read under lock"""
+        if not self.changed:
+            return
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        with file_lock(self.path):
+            data = self._load()
+            for section, key, field in self.changed:
+                value = self.data[section][key][field]
+                entry = data[section].setdefault(key, {})
+                if field in Timings._fields:
+                    value = _merge(entry.get(field), value, field in RATES)
+                entry[field] = value
+
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".calibration-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_path, self.path)
+        self.data = data
+        self.changed.clear()
+
+
+def observe(uart, name: str, value: float):
+    """Save observed timing to calibration attached to `uart`"""
+    if uart is not None and uart.calibration is not None:
+        uart.calibration.observe(name, value, uart.tty.baudrate)
+
+
+def observe_rate(uart, name: str, size: int, duration: float):
+    """Save rate of operation on `size` bytes which took `duration` seconds"""
+    if size >= MIN_RATE_SIZES[name] and duration > 0:
+        observe(uart, name, size / duration)
+
+
+def calibrated_timeout(uart, name: str, amount: float, default: float) -> float:
+    """Return timeout derived from calibration attached to `uart` or `default`"""
+    if uart is None or uart.calibration is None:
+        return default
+    timeout = uart.calibration.timeout(name, uart.tty.baudrate, amount)
+    return default if timeout is None else timeout
+
+
+def current_timings(uart) -> Timings:
+    """Return timings for flash type and baudrate of `uart`"""
+    if uart.calibration is None:
+        return default_timings(uart.tty.baudrate)
+    return uart.calibration.timings(uart.tty.baudrate)
+
+
+def observe_write(uart, duration: float, size: int, page: int):
+    """Derive program time of page from duration of write of `size` bytes: time of sending
+    frames (4 bytes of header per page) is subtracted from round trip of every page"""
+    pages = size / page
+    if uart is None or uart.calibration is None or pages < MIN_WRITE_PAGES:
+        return
+    link_rate = current_timings(uart).link_rate
+    observe(uart, "page_program", duration / pages - (page + 4) / link_rate)
+
+
+class Estimate:
+    """Predicted duration of operations accumulated by phases (as phases of metrics)
+
+    >>> estimate = Estimate(default_timings(115200), 256)
+    >>> estimate.erase(1)
+    >>> estimate.write(115200)
+    >>> estimate.verify(65536)
+    >>> {k: round(v, 2) for k, v in estimate.phases.items()}
+    {'erase': 0.3, 'write': 10.61, 'verify': 0.02}
+    >>> round(estimate.total, 1)
+    10.9
+    """
+
+    def __init__(self, timings: Timings, page: int):
+        self.timings = timings
+        self.page = page
+        self.phases: dict[str, float] = {}
+
+    def add(self, phase: str, duration: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+    def erase(self, sectors: int):
+        self.add("erase", sectors * self.timings.erase_sector)
+
+    def write(self, size: int):
+        pages = size / self.page
+        # Every page is sent with 4 bytes of header
+        link_time = (size + 4 * pages) / self.timings.link_rate
+        self.add("write", link_time + pages * self.timings.page_program)
+
+    def verify(self, size: int):
+        self.add("verify", size / self.timings.crc_rate)
+
+    def read(self, size: int):
+        self.add("read", size / self.timings.link_rate)
+
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
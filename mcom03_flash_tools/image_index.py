@@ -0,0 +1,309 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import array
+import binascii
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from typing import BinaryIO, Optional
+
+from mcom03_flash_tools import default_cache_dir
+from mcom03_flash_tools.metrics import file_lock
+
+# CRC16 of whole image, CRC16 of every page (as sent by flash()), CRC16 of every sector padded by
+# 0xFF and bitmap of pages filled by 0xFF
+ImageTables = namedtuple("ImageTables", "crc page_crcs sector_crcs blank_pages")
+
+CHUNK_SIZE = 1024 * 1024
+# Least recently used objects are removed when total size of objects exceeds this number of bytes
+MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def _to_le(table: array.array) -> bytes:
+    if sys.byteorder == "big":
+        table = array.array(table.typecode, table)
+        table.byteswap()
+    return table.tobytes()
+
+
+def _from_le(data: bytes) -> array.array:
+    table = array.array("H", data)
+    if sys.byteorder == "big":
+        table.byteswap()
+    return table
+
+
+def is_blank_page(tables: ImageTables, page_idx: int) -> bool:
+    return bool(tables.blank_pages[page_idx // 8] & (1 << (page_idx % 8)))
+
+
+def calc_tables(f_obj: BinaryIO, page: int, sector: int) -> ImageTables:
+    """Calculate CRC tables for image starting from sector aligned offset
+
+    >>> import io
+    >>> tables = calc_tables(io.BytesIO(b"\\xff" * 4 + b"\\x00" * 3), 4, 8)
+    >>> tables.crc == binascii.crc_hqx(b"\\xff" * 4 + b"\\x00" * 3, 0xFFFF)
+    True
+    >>> tables.page_crcs[1] == binascii.crc_hqx(b"\\x00" * 3, 0xFFFF)
+    True
+    >>> tables.sector_crcs[0] == binascii.crc_hqx(b"\\xff" * 4 + b"\\x00" * 3 + b"\\xff", 0xFFFF)
+    True
+    >>> [is_blank_page(tables, x) for x in range(2)]
+    [True, False]
+    """
+    crc = 0xFFFF
+    page_crcs = array.array("H")
+    sector_crcs = array.array("H")
+    blank_pages = bytearray()
+    blank_page = b"\xff" * page
+    page_idx = 0
+    chunk_size = max(CHUNK_SIZE // sector, 1) * sector
+    while True:
+        chunk = f_obj.read(chunk_size)
+        if not chunk:
+            break
+        crc = binascii.crc_hqx(chunk, crc)
+        view = memoryview(chunk)
+        for pos in range(0, len(chunk), page):
+            data = view[pos : pos + page]
+            page_crcs.append(binascii.crc_hqx(data, 0xFFFF))
+            if page_idx % 8 == 0:
+                blank_pages.append(0)
+            if data == blank_page[: len(data)]:
+                blank_pages[-1] |= 1 << (page_idx % 8)
+            page_idx += 1
+        for pos in range(0, len(chunk), sector):
+            data = view[pos : pos + sector]
+            sector_crc = binascii.crc_hqx(data, 0xFFFF)
+            sector_crcs.append(binascii.crc_hqx(b"\xff" * (sector - len(data)), sector_crc))
+
+    return ImageTables(crc, page_crcs, sector_crcs, bytes(blank_pages))
+
+
+def nonblank_extents(
+    tables: ImageTables, page: int, start: int, size: int, min_gap: int
+) -> list[tuple[int, int]]:
+    """Return list of (offset, size) of non-blank parts of image range [start, start + size).
+    `start` must be aligned to page size. Blank gaps shorter than `min_gap` pages are included
+    into extents.
+
+    >>> import io
+    >>> tables = calc_tables(io.BytesIO(b"\\x00" * 4 + b"\\xff" * 12 + b"\\x00" * 2), 4, 8)
+    >>> nonblank_extents(tables, 4, 0, 18, 2)
+    [(0, 4), (16, 2)]
+    >>> nonblank_extents(tables, 4, 0, 18, 4)
+    [(0, 18)]
+    >>> nonblank_extents(tables, 4, 4, 14, 2)
+    [(16, 2)]
+    """
+    extents: list[tuple[int, int]] = []
+    gap = 0
+    end = start + size
+    for page_idx in range(start // page, (end + page - 1) // page):
+        if is_blank_page(tables, page_idx):
+            gap += 1
+            continue
+        page_start = page_idx * page
+        page_end = min(page_start + page, end)
+        if extents and gap < min_gap:
+            extents[-1] = (extents[-1][0], page_end - extents[-1][0])
+        else:
+            extents.append((page_start, page_end - page_start))
+        gap = 0
+
+    return extents
+
+
+class IndexedImage:
+    """Image stored in the index. `path` is a path to the image content"""
+
+    def __init__(self, index: "ImageIndex", sha256: str, size: int, path: str):
+        self.index = index
+        self.sha256 = sha256
+        self.size = size
+        self.path = path
+
+    def tables(self, page: int, sector: int) -> ImageTables:
+        """Return CRC tables, calculate and store them if they are not in the index yet"""
+        obj_dir = self.index.object_dir(self.sha256)
+        self.index.touch(obj_dir)
+        names = ["crc", f"pages.{page}", f"sectors.{sector}", f"blank.{page}"]
+        try:
+            with open(os.path.join(obj_dir, names[0])) as f:
+                crc = int(f.read(), 16)
+            with open(os.path.join(obj_dir, names[1]), "rb") as f:
+                page_crcs = _from_le(f.read())
+            with open(os.path.join(obj_dir, names[2]), "rb") as f:
+                sector_crcs = _from_le(f.read())
+            with open(os.path.join(obj_dir, names[3]), "rb") as f:
+                blank_pages = f.read()
+            return ImageTables(crc, page_crcs, sector_crcs, blank_pages)
+        except (OSError, ValueError):
+            pass
+
+        with open(self.path, "rb") as f:
+            tables = calc_tables(f, page, sector)
+        if self.index.writable:
+            self.index.store(obj_dir, names[0], f"{tables.crc:04x}".encode())
+            self.index.store(obj_dir, names[1], _to_le(tables.page_crcs))
+            self.index.store(obj_dir, names[2], _to_le(tables.sector_crcs))
+            self.index.store(obj_dir, names[3], tables.blank_pages)
+        return tables
+
+
+class ImageIndex:
+    """Content-addressed store of images and their CRC tables.
+
+    Objects are stored in `objects/<sha256>` directories, references from file paths and tar
+    members to objects are stored in `refs`. All files are written atomically, so the index can be
+    shared between concurrent processes. If the index directory is not writable then the index is
+    used read-only and missing data is calculated in memory. Modification time of object directory
+    is its last use time, least recently used objects are removed when total size of objects
+    exceeds `max_size` bytes.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_size: int = MAX_SIZE):
+        self.root = root or os.path.join(default_cache_dir(), "images")
+        self.max_size = max_size
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except OSError:
+            pass
+        self.writable = os.access(self.root, os.W_OK)
+
+    def object_dir(self, sha256: str) -> str:
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    def store(self, dirname: str, name: str, data: bytes):
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(dirname, name))
+
+    def touch(self, dirname: str):
+        """Mark object as recently used"""
+        if self.writable:
+            try:
+                os.utime(dirname)
+            except OSError:
+                pass
+
+    def prune(self, keep: Optional[str] = None):
+        """Remove least recently used objects and references to them while total size of
+        objects exceeds `max_size`. Object `keep` (SHA-256) is never removed."""
+        if not self.writable:
+            return
+        with file_lock(os.path.join(self.root, "objects")):
+            objects = []
+            total = 0
+            objects_dir = os.path.join(self.root, "objects")
+            for prefix in os.listdir(objects_dir):
+                for sha in os.listdir(os.path.join(objects_dir, prefix)):
+                    obj_dir = os.path.join(objects_dir, prefix, sha)
+                    try:
+                        size = sum(entry.stat().st_size for entry in os.scandir(obj_dir))
+                        objects.append((os.stat(obj_dir).st_mtime_ns, sha, obj_dir, size))
+                    except OSError:
+                        continue
+                    total += size
+            removed = set()
+            for _, sha, obj_dir, size in sorted(objects):
+                if total <= self.max_size:
+                    break
+                if sha == keep:
+                    continue
+                shutil.rmtree(obj_dir, ignore_errors=True)
+                try:
+                    os.rmdir(os.path.dirname(obj_dir))
+                except OSError:
+                    pass
+                removed.add(sha)
+                total -= size
+            if not removed:
+                return
+
+            refs_dir = os.path.join(self.root, "refs")
+            for name in os.listdir(refs_dir):
+                path = os.path.join(refs_dir, name)
+                try:
+                    with open(path) as f:
+                        if json.load(f)["sha256"] in removed:
+                            os.remove(path)
+                except (OSError, ValueError, KeyError):
+                    continue
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.root, "refs", hashlib.sha256(key.encode()).hexdigest())
+
+    def _lookup(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._ref_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _add_ref(self, key: str, ref: dict):
+        if self.writable:
+            path = self._ref_path(key)
+            self.store(os.path.dirname(path), os.path.basename(path), json.dumps(ref).encode())
+
+    def add_file(self, path: str) -> IndexedImage:
+        """Return indexed image for regular file. The file is hashed only if it is not indexed
+        yet or was modified since indexing."""
+        st = os.stat(path)
+        key = f"file:{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+        ref = self._lookup(key)
+        if ref is None:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    sha.update(chunk)
+            ref = {"sha256": sha.hexdigest(), "size": st.st_size}
+            self._add_ref(key, ref)
+
+        return IndexedImage(self, ref["sha256"], ref["size"], path)
+
+    def add_tar_member(self, tar_path: str, name: str, package) -> Optional[IndexedImage]:
+        """Return indexed image for tar member. Payload of the member is extracted to the index,
+        so later runs do not need to decompress the package. Return None if there is no such
+        member or the member is not indexed yet and the index is read-only. `package` is
+        PackageReader used to extract the member if it is not indexed yet. SHA-256 of already
+        indexed member is taken from the index, the payload is not rehashed."""
+        st = os.stat(tar_path)
+        key = f"tar:{os.path.realpath(tar_path)}:{st.st_size}:{st.st_mtime_ns}:{name}"
+        ref = self._lookup(key)
+        if ref is not None:
+            payload = os.path.join(self.object_dir(ref["sha256"]), "payload")
+            if os.path.exists(payload):
+                self.touch(os.path.dirname(payload))
+                return IndexedImage(self, ref["sha256"], ref["size"], payload)
+
+        if not self.writable:
+            return None
+
+        _, file = package.get(name)
+        if file is None:
+            return None
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".payload-")
+        sha = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+
+        ref = {"sha256": sha.hexdigest(), "size": size}
+        obj_dir = self.object_dir(ref["sha256"])
+        os.makedirs(obj_dir, exist_ok=True)
+        payload = os.path.join(obj_dir, "payload")
+        os.replace(tmp_path, payload)
+        self._add_ref(key, ref)
+        self.prune(keep=ref["sha256"])
+        return IndexedImage(self, ref["sha256"], size, payload)
@@ -0,0 +1,188 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import contextlib
+import glob
+import os
+import socket
+import struct
+import sys
+from typing import Optional
+
+from serial.tools import list_ports
+
+from mcom03_flash_tools.metrics import count
+
+try:
+    import fcntl
+    import termios
+except ModuleNotFoundError:  # not available on Windows
+    fcntl = None  # type: ignore
+    termios = None  # type: ignore
+
+FLOW_CONTROLS = ["none", "rtscts", "xonxoff"]
+# struct serial_icounter_struct from linux/serial.h (11 counters and 9 reserved ints)
+ICOUNT = struct.Struct("20i")
+ICOUNT_FIELDS = [
+    "cts",
+    "dsr",
+    "rng",
+    "dcd",
+    "rx",
+    "tx",
+    "frame",
+    "overrun",
+    "parity",
+    "brk",
+    "buf_overrun",
+]
+# Counters of lost or damaged received characters
+LINE_ERRORS = ["overrun", "buf_overrun", "frame", "parity"]
+
+
+def serial_flow_control(mode: str) -> dict:
+    """Return arguments of serial.Serial for flow control `mode`
+
+    >>> serial_flow_control("rtscts")
+    {'rtscts': True, 'xonxoff': False}
+    """
+    if mode not in FLOW_CONTROLS:
+        raise ValueError(f"Unsupported flow control '{mode}'")
+    return {"rtscts": mode == "rtscts", "xonxoff": mode == "xonxoff"}
+
+
+def check_flow_control(tty, mode: str):
+    """Check that the line is ready for flow control `mode`. With RTS/CTS host does not transmit
+    while CTS is not asserted, so the session would hang without connected CTS line."""
+    if mode != "rtscts":
+        return
+    try:
+        cts = tty.cts
+    except OSError:  # modem lines are not supported by port (e.g. pseudo-terminal)
+        print("State of CTS line is unknown, RTS/CTS flow control is not checked", file=sys.stderr)
+        return
+    if not cts:
+        raise Exception("CTS is not asserted by the board, RTS/CTS flow control can not be used")
+
+
+def disable_nagle(tty):
+    """Send small writes (commands, frames) immediately on network ports (socket://,
+    rfc2217://) instead of waiting for acknowledgement of previous segment. pyserial does not
+    provide the socket, so its private attribute is used."""
+    sock = getattr(tty, "_socket", None)
+    if isinstance(sock, socket.socket):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+@contextlib.contextmanager
+def binary_input(tty):
+    """Disable XON/XOFF flow control while binary data is received, otherwise XON and XOFF
+    bytes of data are consumed by serial driver"""
+    if not getattr(tty, "xonxoff", False):
+        yield
+        return
+
+    tty.xonxoff = False
+    try:
+        yield
+    finally:
+        tty.xonxoff = True
+
+
+def read_icount(tty) -> Optional[dict]:
+    """Return counters of serial driver (None if they are not supported)"""
+    request = getattr(termios, "TIOCGICOUNT", None)
+    if fcntl is None or request is None:
+        return None
+    buf = bytearray(ICOUNT.size)
+    try:
+        fcntl.ioctl(tty.fileno(), request, buf)
+    except (AttributeError, OSError):
+        return None
+    return dict(zip(ICOUNT_FIELDS, ICOUNT.unpack(buf)))
+
+
+def line_errors(start: dict, end: dict) -> dict:
+    """Return nonzero increments of error counters. Counters are started from zero after
+    reconnect of USB-UART adapter.
+
+    >>> start = dict.fromkeys(ICOUNT_FIELDS, 0)
+    >>> line_errors(start, dict(start, rx=100, overrun=2))
+    {'overrun': 2}
+    >>> line_errors(dict(start, frame=5), dict(start, frame=1))
+    {'frame': 1}
+    """
+    increments = {x: end[x] - start[x] if end[x] >= start[x] else end[x] for x in LINE_ERRORS}
+    return {k: v for k, v in increments.items() if v}
+
+
+def usb_interface(location: Optional[str]) -> Optional[str]:
+    """Return USB interface from location of port in USB tree (adapters with several ports have
+    the same serial number)
+
+    >>> usb_interface("1-1.2:1.0"), usb_interface(None)
+    ('1.0', None)
+    """
+    if not location or ":" not in location:
+        return None
+    return location.rpartition(":")[2]
+
+
+def usb_port_id(port: str) -> Optional[tuple]:
+    """Return USB serial number and interface of adapter of serial `port`. None if port is not
+    USB-UART adapter with serial number (pseudo-terminal, URL)."""
+    path = os.path.realpath(port)
+    for info in list_ports.comports():
+        if info.serial_number and os.path.realpath(info.device) == path:
+            return info.serial_number, usb_interface(info.location)
+    return None
+
+
+def usb_serial_ports(patterns: list) -> dict:
+    """Return USB serial numbers (None for other ports) of serial ports matching glob `patterns`.
+    If there are no patterns then all USB serial ports are returned."""
+    usb = {
+        os.path.realpath(info.device): info.serial_number
+        for info in list_ports.comports()
+        if info.vid is not None
+    }
+    if not patterns:
+        return dict(sorted(usb.items()))
+    ports = sorted({port for pattern in patterns for port in glob.glob(pattern)})
+    return {port: usb.get(os.path.realpath(port)) for port in ports}
+
+
+def find_usb_port(port_id: tuple) -> Optional[str]:
+    """Return device of USB-UART adapter with `port_id` (see usb_port_id()) if it is connected"""
+    for info in list_ports.comports():
+        if (info.serial_number, usb_interface(info.location)) == port_id:
+            return info.device
+    return None
+
+
+class LineMonitor:
+    """Monitor of errors counted by serial driver (overruns of UART FIFO and driver buffer,
+    framing and parity errors). update() adds errors since the previous call to metrics of
+    `uart`."""
+
+    def __init__(self, uart):
+        self.uart = uart
+        self.icount = read_icount(uart.tty)
+        self.total: dict[str, int] = {}
+
+    def update(self):
+        if self.icount is None:
+            return
+        icount = read_icount(self.uart.tty)
+        if icount is None:
+            return
+        for name, value in line_errors(self.icount, icount).items():
+            self.total[name] = self.total.get(name, 0) + value
+            count(self.uart, f"uart_{name}", value)
+        self.icount = icount
+
+    def report(self):
+        """Update counters and print errors of the session (called at exit)"""
+        self.update()
+        if self.total:
+            errors = ", ".join(f"{k}: {v}" for k, v in self.total.items())
+            print(f"UART errors counted by serial driver: {errors}")
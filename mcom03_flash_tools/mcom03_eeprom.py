@@ -6,6 +6,8 @@ import argparse
 import sys
 
 from mcom03_flash_tools import UART, __version__, upload_flasher
+from mcom03_flash_tools.metrics import create_metrics, measure
+from mcom03_flash_tools.trace import enable_trace
 
 
 def cmd_write(uart: UART, data: str):
@@ -100,6 +102,23 @@ def main() -> int:
         help="i2c speed (0 - slow, 1 - fast)",
     )
     parser.add_argument("-v", "--verbose", action="store_true", help="Show UART traffic")
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="append JSON record with performance metrics of the operation to FILE",
+    )
+    parser.add_argument(
+        "--prom-file",
+        metavar="FILE",
+        help="update file FILE in Prometheus text format (node_exporter textfile collector) with "
+        + "counters and histograms of the operation",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record transmitted and received data of UART session with timestamps to FILE "
+        + "(can be replayed by --port replay://FILE)",
+    )
     parser.add_argument("--version", action="version", version=__version__)
 
     args = parser.parse_args()
@@ -113,27 +132,40 @@ def main() -> int:
         return 1
 
     uart = UART(prompt="#", port=args.port, baudrate=115200, verbose=args.verbose)
+    if args.trace:
+        enable_trace(uart, args.trace)
+    uart.metrics = create_metrics(
+        args.metrics, args.prom_file, "mcom03-eeprom", args.command, port=args.port, baudrate=115200
+    )
     upload_flasher(uart, "spi-flasher-mips-ram.hex", "QSPI Flasher", args.flasher)
 
     if args.command == "flasher":
+        if uart.metrics is not None:
+            uart.metrics.finish()
         return 0
 
     uart.run(f"i2c_dev {args.bus} {args.speed}")
 
     if args.command == "read":
-        response = uart.run(
-            f"i2c_read {args.addr} {args.regaddr} {args.length} {args.datasize} {args.mode}"
-        )
+        with measure(uart, "read", args.datasize):
+            response = uart.run(
+                f"i2c_read {args.addr} {args.regaddr} {args.length} {args.datasize} {args.mode}"
+            )
         print(response)
 
     if args.command == "write":
         if args.datasize == 0:
             args.datasize = len(args.name) + 1
 
-        response = uart.run(f"i2c_write {args.addr} {args.regaddr} {args.length} {args.datasize}")
-        print(response)
-        cmd_write(uart, args.name)
+        with measure(uart, "write", args.datasize):
+            response = uart.run(
+                f"i2c_write {args.addr} {args.regaddr} {args.length} {args.datasize}"
+            )
+            print(response)
+            cmd_write(uart, args.name)
 
+    if uart.metrics is not None:
+        uart.metrics.finish()
     return 0
 
 
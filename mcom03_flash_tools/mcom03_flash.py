@@ -3,86 +3,210 @@
 # Copyright 2021 RnD Center "ELVEES", JSC
 
 import argparse
+import atexit
 import binascii
+import concurrent.futures
+import copy
 import glob
+import hashlib
+import importlib.resources
 import io
+import json
+import lzma
 import math
 import os
 import sys
 import tarfile
 import time
-from typing import Any
+import zlib
+from collections import namedtuple
+from collections.abc import Callable, Sequence
+from typing import Any, BinaryIO, Optional
+
+import serial
 
 try:
     import tomllib
 except ModuleNotFoundError:  # Python < 3.11
     import tomli as tomllib  # type: ignore
 
+try:
+    import zstandard
+except ModuleNotFoundError:  # zstd compression is optional
+    zstandard = None
+
 from mcom03_flash_tools import (
     UART,
+    FlashType,
+    KiB,
+    MiB,
     __version__,
-    clear_progress_bar,
+    blank_crc,
+    change_baudrate,
+    default_cache_dir,
     get_flash_protector,
     get_flash_type,
-    print_progress_bar,
+    read_crc,
     read_image,
+    read_into,
+    read_to_sink,
+    switch_baudrate,
     upload_flasher,
 )
+from mcom03_flash_tools.adaptive import AdaptiveBaudrate
+from mcom03_flash_tools.calibration import (
+    CALIBRATION_FILE,
+    Calibration,
+    Estimate,
+    Timings,
+    calibrated_timeout,
+    current_timings,
+    observe,
+    observe_write,
+)
+from mcom03_flash_tools.image_index import (
+    ImageIndex,
+    ImageTables,
+    nonblank_extents,
+)
+from mcom03_flash_tools.line import FLOW_CONTROLS, LineMonitor, usb_serial_ports
+from mcom03_flash_tools.metrics import count, create_metrics, measure
+from mcom03_flash_tools.package import PackageReader, read_member
+from mcom03_flash_tools.plan import FlashPlan, PlanReader
+from mcom03_flash_tools.profiler import enable_profiling
+from mcom03_flash_tools.progress import format_rate, progress_bar
+from mcom03_flash_tools.state_cache import BoardState, StateCache, image_sector_crcs, sector_runs
+from mcom03_flash_tools.trace import REPLAY_PREFIX, enable_trace
+
+# Blank gaps shorter than this count of pages are written to avoid extra write commands
+BLANK_GAP_PAGES = 16
+# Granularity of search for non-blank regions in sparse read
+SPARSE_BLOCK = 4 * KiB
+
+
+def start_write(uart: UART, offset: int, page_size: int):
+    response = uart.run(f"write {offset} {page_size}")
+    if "Ready" not in response:
+        raise Exception(f"Flash error: {response}")
+
+
+def end_write(uart: UART):
+    """Finish write session by block of zero size"""
+    uart.tty.write((0).to_bytes(2, "little") + blank_crc(0).to_bytes(2, "little"))
+    uart.wait_for_string(uart.prompt)
+
+
+def abort_write(uart: UART, page_size: int):
+    """Finish write session interrupted in the middle of frame. Zero bytes complete the frame and
+    flasher rejects it by CRC, the rest of them are rejected as zero-size frames with wrong CRC.
+    Then zero bytes are sent one by one till flasher responds, so the end frame is sent at frame
+    boundary."""
+    uart.tty.write(bytes(page_size + 4))
+    uart.skip_input()
+    for _ in range(4):
+        uart.tty.write(bytes(1))
+        response = uart.tty.read(1)
+        if response == b"C":
+            end_write(uart)
+            return
+        if response:
+            return  # not in write session
 
 
 def flash(
     uart: UART,
     offset: int,
-    f_obj: io.BufferedReader,
+    f_obj: BinaryIO,
     f_size: int,
     hide_progress_bar: bool,
     page_size: int,
+    page_crcs: Optional[Sequence[int]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
 ):
-    response = uart.run(f"write {offset} {page_size}")
-    if "Ready" not in response:
-        raise Exception(f"Flash error: {response}")
-
-    page_offset = offset & (page_size - 1)
-    complete = 0
-    while True:
-        if not hide_progress_bar:
-            print_progress_bar(complete / f_size * 100)
+    """Write `f_size` bytes from `f_obj` to flash. `page_crcs` are precomputed CRC16 of pages
+    (used only if `offset` is aligned to page size). `progress` is called with count of written
+    and total bytes after every page."""
+    count(uart, "retransmissions", 0)
+    time_start = time.monotonic()
+    bar = progress_bar("Write", f_size, hide_progress_bar)
+    with measure(uart, "write", f_size), bar:
+        start_write(uart, offset, page_size)
+
+        page_offset = offset & (page_size - 1)
+        if page_offset:
+            page_crcs = None
+        complete = 0
+        page_idx = 0
+        while True:
+            bar.update(complete)
+            if not complete and page_offset:
+                data = f_obj.read(min(page_size - page_offset, f_size))
+            else:
+                data = f_obj.read(min(page_size, f_size - complete))
 
-        if not complete and page_offset:
-            data = f_obj.read(page_size - page_offset)
-        else:
-            data = f_obj.read(page_size)
+            size = len(data)
+            complete += size
+            if page_crcs is not None and data:
+                crc = page_crcs[page_idx]
+            else:
+                crc = binascii.crc_hqx(data, 0xFFFF)
+            page_idx += 1
+            errors = 0
+            frame = size.to_bytes(2, "little") + crc.to_bytes(2, "little") + data
+            while True:
+                try:
+                    # Frame is sent by one write, so network serial servers send it in one packet
+                    uart.tty.write(frame)
+                    if not data:
+                        uart.wait_for_string(uart.prompt)
+                        break
+                    success, response = uart.wait_for_string(["R", "C"])
+                except serial.SerialException as e:
+                    # Write session is finished, then the frame is sent again in new session
+                    # (it is harmless if flasher has programmed it before disconnect)
+                    uart.reconnect(e, lambda: abort_write(uart, page_size))
+                    if not data:
+                        break
+                    start_write(uart, offset + complete - size, page_size)
+                    continue
+                if not success:
+                    raise Exception(f"Wrong response while flashing: {response}")
+
+                accepted = response.strip() == "R"  # Ready for next block
+                if uart.adaptive is not None:
+                    baudrate = uart.adaptive.frame(not accepted)
+                    if baudrate is not None:
+                        # Continue from the next block or resend rejected one at new baudrate
+                        end_write(uart)
+                        switch_baudrate(uart, baudrate)
+                        start_write(uart, offset + complete - (0 if accepted else size), page_size)
+                        errors = 0
+                if accepted:
+                    break
+                count(uart, "retransmissions")
+                errors += 1
+                if errors == 3:
+                    raise Exception("CRC errors threshold exceeded 3 times")
 
-        size = len(data)
-        complete += size
-        crc = binascii.crc_hqx(data, 0xFFFF)
-        for _ in range(3):
-            uart.tty.write(size.to_bytes(2, "little"))
-            uart.tty.write(crc.to_bytes(2, "little"))
             if not data:
-                if not hide_progress_bar:
-                    clear_progress_bar()
-                uart.wait_for_string(uart.prompt)
+                bar.close()
+                observe_write(uart, time.monotonic() - time_start, f_size, page_size)
                 return
-
-            uart.tty.write(data)
-            success, response = uart.wait_for_string(["R", "C"])
-            if not success:
-                raise Exception(f"Wrong response while flashing: {response}")
-
-            if response.strip() == "R":  # Ready for next block
-                break
-        else:
-            raise Exception("CRC errors threshold exceeded 3 times")
+            if progress is not None:
+                progress(complete, f_size)
 
 
 def erase_sector(uart: UART, offset: int):
-    response = uart.run(f"erase {offset}", timeout=10)
+    timeout = calibrated_timeout(uart, "erase_sector", 1, 10)
+    time_start = time.monotonic()
+    with measure(uart, "erase", sample="erase_sector"):
+        response = uart.run(f"erase {offset}", timeout=timeout)
     if response is None:
         raise Exception("Erase error: flash is not ready for write/erase")
 
     if "Error" in response:
         raise Exception(f"Erase error: {response}")
+    observe(uart, "erase_sector", time.monotonic() - time_start)
 
 
 def erase(uart: UART, offset: int, size: int, hide_progress_bar: bool, flash_type):
@@ -101,26 +225,125 @@ def erase(uart: UART, offset: int, size: int, hide_progress_bar: bool, flash_typ
         else ""
     )
     print(f"Erasing {size} bytes{rounded_str} ({sectors} sectors, starting from {first_sector})...")
-    for i in range(first_sector, last_sector + 1):
-        if not hide_progress_bar:
-            print_progress_bar((i - first_sector) / sectors * 100)
-        erase_sector(uart, i * flash_type.sector)
-
-    if not hide_progress_bar:
-        clear_progress_bar()
+    with progress_bar("Erase", sectors * flash_type.sector, hide_progress_bar) as bar:
+        for i in range(first_sector, last_sector + 1):
+            erase_sector(uart, i * flash_type.sector)
+            bar.update((i - first_sector + 1) * flash_type.sector)
 
 
-def verify(uart: UART, offset: int, f_obj: io.BufferedReader, f_size: int):
+def image_crc(f_obj: io.BufferedReader, crc: Optional[int] = None) -> int:
+    """Return CRC16 of the whole image (`crc` if it is precomputed)"""
+    if crc is not None:
+        return crc
     if not f_obj.seekable():
         raise Exception(f"The file object {f_obj.name} is not seekable")
 
     f_obj.seek(0)
-    crc = binascii.crc_hqx(f_obj.read(), 0xFFFF)
+    return binascii.crc_hqx(f_obj.read(), 0xFFFF)
+
+
+class VerificationError(Exception):
+    """Written data does not match expected data"""
+
+
+def check_flash(uart: UART, offset: int, size: int, crc: int, state: Optional[BoardState] = None):
+    """Compare CRC16 of flash region with `crc`, raise VerificationError on mismatch. Cached
+    layout of the board is dropped on mismatch: only several sectors are checked against it, so
+    otherwise the next run would trust it again."""
+    with measure(uart, "verify", size):
+        actual_crc = read_crc(uart, offset, size)
+    if actual_crc != crc:
+        count(uart, "verify_failures")
+        if state is not None:
+            state.invalidate()
+        raise VerificationError(
+            f"Verification of {offset:#x}-{offset + size:#x} failed. Expected CRC {crc:#x}, "
+            + f"but read {actual_crc:#x}"
+        )
+
+
+def verify(
+    uart: UART,
+    offset: int,
+    f_obj: io.BufferedReader,
+    f_size: int,
+    crc: Optional[int] = None,
+    state: Optional[BoardState] = None,
+):
+    check_flash(uart, offset, f_size, image_crc(f_obj, crc), state)
+
+
+def write_range(
+    uart: UART,
+    offset: int,
+    f_obj: io.BufferedReader,
+    start: int,
+    size: int,
+    hide_progress_bar: bool,
+    flash_type,
+    tables: Optional[ImageTables] = None,
+):
+    """Write `size` bytes of image starting from `start` byte of image. Image is located at
+    `offset` of flash. If image CRC tables are provided then blank pages are skipped."""
+    page = flash_type.page
+    extents = [(start, size)]
+    page_crcs = None
+    if tables is not None and not (offset | start) & (page - 1):
+        page_crcs = memoryview(tables.page_crcs)
+        extents = nonblank_extents(tables, page, start, size, BLANK_GAP_PAGES)
+        skipped = size - sum(x[1] for x in extents)
+        if skipped:
+            print(f"Skip writing of {skipped / 1024:.2f} KB of blank pages")
+
+    for extent_start, extent_size in extents:
+        f_obj.seek(extent_start)
+        flash(
+            uart,
+            offset + extent_start,
+            f_obj,
+            extent_size,
+            hide_progress_bar,
+            page,
+            page_crcs[extent_start // page :] if page_crcs is not None else None,
+        )
 
-    response = uart.run(f"readcrc {offset} {f_size}", timeout=f_size / 10000 + 5)
-    read_crc = int(response, 0)
-    if read_crc != crc:
-        raise Exception(f"Verification failed. Expected CRC {crc:#x}, but read {read_crc:#x}")
+
+def flash_changed_sectors(
+    uart: UART,
+    offset: int,
+    f_obj: io.BufferedReader,
+    f_size: int,
+    hide_progress_bar: bool,
+    flash_type,
+    unchanged: set[int],
+    tables: Optional[ImageTables] = None,
+):
+    """Erase and write only sectors of image which are not in `unchanged`"""
+    first_sector = offset // flash_type.sector
+    last_sector = (offset + f_size - 1) // flash_type.sector
+    changed = [x for x in range(first_sector, last_sector + 1) if x not in unchanged]
+    print(f"{last_sector - first_sector + 1 - len(changed)} sectors are already up to date")
+    for run_start, run_count in sector_runs(changed):
+        run_offset = max(run_start * flash_type.sector, offset)
+        run_end = min((run_start + run_count) * flash_type.sector, offset + f_size)
+        erase(
+            uart,
+            run_start * flash_type.sector,
+            run_count * flash_type.sector,
+            hide_progress_bar,
+            flash_type,
+        )
+        print(f"Writing to flash {(run_end - run_offset) / 1024:.2f} KB at {run_offset:#x}...")
+        write_range(
+            uart,
+            offset,
+            f_obj,
+            run_offset - offset,
+            run_end - run_offset,
+            hide_progress_bar,
+            flash_type,
+            tables,
+        )
 
 
 def cmd_flash_file(
@@ -130,6 +353,8 @@ def cmd_flash_file(
     f_size: int,
     hide_progress_bar: bool,
     flash_type,
+    state: Optional[BoardState] = None,
+    tables: Optional[ImageTables] = None,
 ):
     if offset < 0:
         offset = flash_type.size + offset
@@ -138,31 +363,264 @@ def cmd_flash_file(
         print("Image doesn't fit to flash memory", file=sys.stderr)
         sys.exit(1)
 
+    if not f_obj.seekable():
+        cmd_flash_stream(uart, offset, f_obj, hide_progress_bar, flash_type)
+        return
+
+    crc = tables.crc if tables is not None else None
+    sectors = None
+    if state is not None and f_obj.seekable() and f_size:
+        if tables is not None and not offset & (flash_type.sector - 1):
+            first_sector = offset // flash_type.sector
+            sectors = {first_sector + i: x for i, x in enumerate(tables.sector_crcs)}
+        else:
+            sectors = image_sector_crcs(f_obj, f_size, offset, flash_type.sector)
+        unchanged = state.unchanged_sectors(sectors)
+        if unchanged:
+            time_start = time.monotonic()
+            flash_changed_sectors(
+                uart, offset, f_obj, f_size, hide_progress_bar, flash_type, unchanged, tables
+            )
+            print("Checking...")
+            try:
+                verify(uart, offset, f_obj, f_size, crc, state)
+            except VerificationError:
+                print("Verification failed, cached flash layout is dropped, image is written again")
+            else:
+                state.record(sectors)
+                print(f"Total: {time.monotonic() - time_start:0.1f} s")
+                return
+
     time_start = time.monotonic()
     erase(uart, offset, f_size, hide_progress_bar, flash_type)
     duration_erase = time.monotonic() - time_start
     print(f"Erase: {duration_erase:0.1f} s ({f_size / duration_erase / 1024:0.0f} KiB/s)")
 
     print(f"Writing to flash {f_size / 1024:.2f} KB...")
-    flash(uart, offset, f_obj, f_size, hide_progress_bar, flash_type.page)
+    write_range(uart, offset, f_obj, 0, f_size, hide_progress_bar, flash_type, tables)
     duration_write = time.monotonic() - time_start - duration_erase
     print(f"Write: {duration_write:0.1f} s ({f_size / duration_write / 1024:0.0f} KiB/s)")
 
     print("Checking...")
-    verify(uart, offset, f_obj, f_size)
+    verify(uart, offset, f_obj, f_size, crc, state)
     duration_check = time.monotonic() - time_start - duration_erase - duration_write
     print(f"Check: {duration_check:0.1f} s ({f_size / duration_check / 1024:0.0f} KiB/s)")
     duration_total = duration_erase + duration_write + duration_check
     print(f"Total: {duration_total:0.1f} s")
+    if state is not None and sectors is not None:
+        state.record(sectors)
+
+
+def cmd_flash_stream(uart: UART, offset: int, f_obj: Any, hide_progress_bar: bool, flash_type):
+    """Flash data of unknown size from non-seekable stream (pipe, stdin). Every sector is erased
+    just before it is written, CRC for verification is calculated while data is sent."""
+    if offset < 0:
+        offset = flash_type.size + offset
+    if offset & (flash_type.sector - 1):
+        print(
+            f"Offset must be aligned with erase sector size ({flash_type.sector})", file=sys.stderr
+        )
+        sys.exit(1)
+
+    print("Writing to flash from stream...")
+    buf = bytearray(flash_type.sector)
+    view = memoryview(buf)
+    crc = 0xFFFF
+    complete = 0
+    time_start = time.monotonic()
+    bar = progress_bar("Write", None, hide_progress_bar)
+    while True:
+        size = 0
+        while size < len(buf):
+            n = f_obj.readinto(view[size:])
+            if not n:
+                break
+            size += n
+        if not size:
+            break
+        if offset + complete + size > flash_type.size:
+            bar.close()
+            print("Image doesn't fit to flash memory", file=sys.stderr)
+            sys.exit(1)
+
+        erase_sector(uart, offset + complete)
+        flash(uart, offset + complete, io.BytesIO(view[:size]), size, True, flash_type.page)
+        crc = binascii.crc_hqx(view[:size], crc)
+        complete += size
+        bar.update(complete)
+
+    bar.close()
+    duration_write = time.monotonic() - time_start
+    print(
+        f"Erase and write: {complete / 1024:.2f} KB in {duration_write:0.1f} s "
+        + f"({complete / duration_write / 1024:0.0f} KiB/s)"
+    )
+
+    print("Checking...")
+    check_flash(uart, offset, complete, crc)
+    print(f"Total: {time.monotonic() - time_start:0.1f} s")
+
 
+def cmd_flash(
+    uart: UART,
+    image: str,
+    offset: int,
+    hide_progress_bar: bool,
+    flash_type,
+    state: Optional[BoardState] = None,
+    index: Optional[ImageIndex] = None,
+):
+    if image == "-":
+        cmd_flash_stream(uart, offset, sys.stdin.buffer, hide_progress_bar, flash_type)
+        return
 
-def cmd_flash(uart: UART, image: str, offset: int, hide_progress_bar: bool, flash_type):
+    tables = None
+    if index is not None:
+        indexed = index.add_file(image)
+        tables = indexed.tables(flash_type.page, flash_type.sector)
     f_size = os.stat(image).st_size
     with io.open(image, "rb") as f_obj:  # noqa: UP020 Use builtin `open`
-        cmd_flash_file(uart, offset, f_obj, f_size, hide_progress_bar, flash_type)
+        cmd_flash_file(uart, offset, f_obj, f_size, hide_progress_bar, flash_type, state, tables)
+
+
+def find_populated_extents(uart: UART, offset: int, size: int, block: int) -> list:
+    """Return list of (offset, size) of non-blank flash regions. Ranges which CRC16 differs from
+    CRC16 of erased range are recursively split in halves down to `block` bytes."""
+    extents: list[tuple[int, int]] = []
+
+    def scan(start: int, length: int):
+        if read_crc(uart, start, length) == blank_crc(length):
+            return
+
+        if length <= block:
+            if extents and sum(extents[-1]) == start:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((start, length))
+            return
+
+        half = (length + block - 1) // block // 2 * block
+        scan(start, half)
+        scan(start + half, length - half)
+
+    with measure(uart, "scan", size):
+        scan(offset, size)
+    return extents
+
+
+def write_bmap(fname: str, image_size: int, block: int, ranges: list):
+    """Write bmap file (bmaptool format 2.0). `ranges` is list of (first block, last block,
+    sha256 of range data)"""
+    mapped = sum(last - first + 1 for first, last, _ in ranges)
+    lines = [
+        '<?xml version="1.0" ?>',
+        '<bmap version="2.0">',
+        f"    <ImageSize> {image_size} </ImageSize>",
+        f"    <BlockSize> {block} </BlockSize>",
+        f"    <BlocksCount> {(image_size + block - 1) // block} </BlocksCount>",
+        f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+        "    <ChecksumType> sha256 </ChecksumType>",
+        f"    <BmapFileChecksum> {'0' * 64} </BmapFileChecksum>",
+        "    <BlockMap>",
+    ]
+    for first, last, digest in ranges:
+        blocks = f"{first}-{last}" if first != last else f"{first}"
+        lines.append(f'        <Range chksum="{digest}"> {blocks} </Range>')
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    text = "\n".join(lines)
+    # Checksum of bmap file is calculated with zeroes in place of the checksum
+    text = text.replace("0" * 64, hashlib.sha256(text.encode()).hexdigest(), 1)
+    with open(fname, "w") as f:
+        f.write(text)
+
+
+def read_sparse(
+    uart: UART,
+    offset: int,
+    size: int,
+    sink,
+    hide_progress_bar: bool,
+    block: int,
+    bmap: Optional[str] = None,
+):
+    """Read only non-blank regions of flash and pass data to `sink(memoryview)`. Blank regions
+    are passed as 0xFF. Layout of non-blank regions is saved to `bmap` file if it is specified."""
+    print("Searching for non-blank regions...")
+    extents = find_populated_extents(uart, offset, size, block)
+    populated = sum(x[1] for x in extents)
+    print(f"Non-blank: {populated / 1024:.2f} KiB in {len(extents)} region(s):")
+    for start, length in extents:
+        print(f"  {start:#010x}-{start + length - 1:#010x} ({length / 1024:.2f} KiB)")
+
+    ranges = []
+    blank = memoryview(b"\xff" * block)
+    pos = offset
+    for start, length in extents + [(offset + size, 0)]:
+        while pos < start:
+            sink(blank[: min(block, start - pos)])
+            pos += min(block, start - pos)
+        if not length:
+            break
+
+        digest = hashlib.sha256()
+
+        def range_sink(view, digest=digest):
+            digest.update(view)
+            sink(view)
+
+        read_to_sink(uart, start, length, range_sink, hide_progress_bar)
+        pos += length
+        first_block = (start - offset) // block
+        last_block = first_block + (length + block - 1) // block - 1
+        ranges.append((first_block, last_block, digest.hexdigest()))
+
+    if bmap is not None:
+        write_bmap(bmap, size, block, ranges)
+
+
+class ReadSink:
+    """Output of read data: optionally compresses data and calculates SHA-256 of read data"""
+
+    def __init__(self, f_obj, compress: Optional[str] = None, sha256: bool = False):
+        self.f_obj = f_obj
+        self.sha256 = hashlib.sha256() if sha256 else None
+        self.compressor: Any = None
+        if compress == "gzip":
+            self.compressor = zlib.compressobj(wbits=31)
+        elif compress == "xz":
+            self.compressor = lzma.LZMACompressor()
+        elif compress == "zstd":
+            if zstandard is None:
+                raise Exception("zstd compression requires 'zstandard' package")
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+
+    def __call__(self, view: memoryview):
+        if self.sha256 is not None:
+            self.sha256.update(view)
+        if self.compressor is not None:
+            self.f_obj.write(self.compressor.compress(view))
+        else:
+            self.f_obj.write(view)
+
+    def close(self):
+        if self.compressor is not None:
+            self.f_obj.write(self.compressor.flush())
+        self.f_obj.flush()
 
 
-def cmd_read(uart: UART, fname: str, offset: int, size: int, hide_progress_bar: bool, flash_type):
+def cmd_read(
+    uart: UART,
+    fname: str,
+    offset: int,
+    size: int,
+    hide_progress_bar: bool,
+    flash_type,
+    sparse: bool = False,
+    compress: Optional[str] = None,
+    sha256: bool = False,
+    stdout: Optional[BinaryIO] = None,
+):
+    """Read flash to file `fname`. If `fname` is "-" then data is written to `stdout`."""
     if offset < 0:
         offset = flash_type.size + offset
     read_size = size if size is not None else flash_type.size - offset
@@ -173,12 +631,136 @@ def cmd_read(uart: UART, fname: str, offset: int, size: int, hide_progress_bar:
 
     print(f"Reading {read_size / 1024:.2f} KiB...")
     time_start = time.monotonic()
-    read_image(uart, offset, read_size, fname, hide_progress_bar)
+    if fname != "-" and not sparse and compress is None and not sha256:
+        read_image(uart, offset, read_size, fname, hide_progress_bar)
+    else:
+        f_obj = stdout or sys.stdout.buffer if fname == "-" else open(fname, "wb")
+        try:
+            sink = ReadSink(f_obj, compress, sha256)
+            if sparse:
+                bmap = f"{fname}.bmap" if fname != "-" else None
+                read_sparse(uart, offset, read_size, sink, hide_progress_bar, SPARSE_BLOCK, bmap)
+            else:
+                read_to_sink(uart, offset, read_size, sink, hide_progress_bar)
+            sink.close()
+        finally:
+            if fname != "-":
+                f_obj.close()
+        if sink.sha256 is not None:
+            print(f"SHA-256: {sink.sha256.hexdigest()}")
     duration = time.monotonic() - time_start
     print(f"Read done in {duration:0.3f} seconds ({read_size / duration / 1024:0.0f} KiB/s)")
 
 
-def cmd_erase(uart: UART, offset: int, size: int, hide_progress_bar: bool, flash_type):
+ReadRange = namedtuple("ReadRange", "offset size fname")
+
+
+def parse_read_range(value: str) -> ReadRange:
+    """
+    >>> parse_read_range("0x200000:128K:sbl.bin")
+    ReadRange(offset=2097152, size=131072, fname='sbl.bin')
+    >>> parse_read_range("-128K:64K:out:1.bin")
+    ReadRange(offset=-131072, size=65536, fname='out:1.bin')
+    """
+    try:
+        offset, size, fname = value.split(":", 2)
+        return ReadRange(int_size(offset), int_size(size), fname)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not OFFSET:SIZE:FILE") from None
+
+
+def load_read_regions(fname: str, profile_name: Optional[str] = None) -> list:
+    """Load read ranges from TOML file with [region.<name>] tables. Each table contains offset,
+    size, optional negative_offset and optional file (default is <name>.bin).
+
+    If the file is a package description (it has [profile.*] tables) or a package containing
+    package.toml, then ranges are the actions of the profile `profile_name` (the first one by
+    default). Output file is the package member name of flash action or <action>.bin."""
+    if tarfile.is_tarfile(fname):
+        package_toml = read_member(fname, "package.toml")
+        if package_toml is None:
+            print(f"There is no 'package.toml' file in {fname}")
+            sys.exit(1)
+        toml_dict = tomllib.loads(package_toml.decode())
+    else:
+        with open(fname, "rb") as f:
+            toml_dict = tomllib.load(f)
+
+    if "profile" in toml_dict:
+        _, regions = select_profile(toml_dict, profile_name, "all")
+        regions = {
+            name: dict(properties, file=properties.get("name", f"{name}.bin"))
+            for name, properties in regions.items()
+        }
+    else:
+        regions = toml_dict.get("region", {})
+    ranges = []
+    for name, properties in regions.items():
+        if "size" not in properties:
+            print(f"Size of region '{name}' isn't provided in {fname}")
+            sys.exit(1)
+        offset = properties.get("offset", 0)
+        if properties.get("negative_offset", False):
+            offset = -offset
+        ranges.append(ReadRange(offset, properties["size"], properties.get("file", f"{name}.bin")))
+    return ranges
+
+
+def merge_read_ranges(ranges: list) -> list:
+    """Merge adjacent and overlapping ranges. Return list of (offset, size, ranges).
+
+    >>> merge_read_ranges([ReadRange(0x100, 0x100, "b"), ReadRange(0, 0x100, "a"),
+    ...                    ReadRange(0x1000, 0x10, "c"), ReadRange(0x180, 0x10, "d")])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(0, 512, [ReadRange(offset=0, size=256, fname='a'), ReadRange(offset=256, size=256, fname='b'),
+               ReadRange(offset=384, size=16, fname='d')]),
+     (4096, 16, [ReadRange(offset=4096, size=16, fname='c')])]
+    """
+    merged: list = []
+    for r in sorted(ranges, key=lambda x: x.offset):
+        if merged and r.offset <= merged[-1][0] + merged[-1][1]:
+            start, size, members = merged[-1]
+            merged[-1] = (start, max(size, r.offset + r.size - start), members + [r])
+        else:
+            merged.append((r.offset, r.size, [r]))
+    return merged
+
+
+def cmd_read_ranges(uart: UART, ranges: list, hide_progress_bar: bool, flash_type):
+    """Read several flash ranges in one session. Adjacent and overlapping ranges are read by one
+    read command."""
+    resolved = []
+    for r in ranges:
+        offset = flash_type.size + r.offset if r.offset < 0 else r.offset
+        if offset + r.size > flash_type.size:
+            print(f"Out of flash memory read requested for {r.fname}", file=sys.stderr)
+            sys.exit(1)
+        resolved.append(r._replace(offset=offset))
+
+    time_start = time.monotonic()
+    total = 0
+    for start, size, members in merge_read_ranges(resolved):
+        print(f"Reading {size / 1024:.2f} KiB from {start:#x}...")
+        buf = bytearray(size)
+        read_into(uart, start, buf, hide_progress_bar)
+        data = memoryview(buf)
+        for r in members:
+            with open(r.fname, "wb") as f:
+                f.write(data[r.offset - start : r.offset - start + r.size])
+            print(f"  {r.fname}: {r.size / 1024:.2f} KiB from {r.offset:#x}")
+        total += size
+    duration = time.monotonic() - time_start
+    print(f"Read done in {duration:0.3f} seconds ({total / duration / 1024:0.0f} KiB/s)")
+
+
+def cmd_erase(
+    uart: UART,
+    offset: int,
+    size: int,
+    hide_progress_bar: bool,
+    flash_type,
+    state: Optional[BoardState] = None,
+):
     if offset < 0:
         offset = flash_type.size + offset
     erase_size = size if size is not None else flash_type.size - offset
@@ -191,25 +773,71 @@ def cmd_erase(uart: UART, offset: int, size: int, hide_progress_bar: bool, flash
     erase(uart, offset, erase_size, hide_progress_bar, flash_type)
     duration_erase = time.monotonic() - time_start
     print(f"Erase: {duration_erase:0.1f} s ({erase_size / duration_erase / 1024:0.0f} KiB/s)")
+    if state is not None:
+        first_sector = offset // flash_type.sector
+        last_sector = int(math.ceil((offset + erase_size) / flash_type.sector)) - 1
+        state.record_erase(first_sector, last_sector - first_sector + 1)
 
 
-def change_baudrate(uart: UART, baudrate: int):
-    response = uart.run(f"baudrate {baudrate}")
-    if "Error" in response:
-        raise Exception(response)
+def print_plan(plan: FlashPlan, uart: UART, flash_type):
+    print("Plan:")
+    sector = flash_type.sector
+    for run_start, run_count in sector_runs(list(plan.sectors)):
+        print(f"  erase {run_start * sector:#010x}-{(run_start + run_count) * sector:#010x}")
+    for session in plan.write_sessions():
+        names = ", ".join(dict.fromkeys(x.name for x in session))
+        print(f"  write {session[0].start:#010x}-{session[-1].end:#010x} ({names})")
+    estimate = plan.estimate(current_timings(uart), flash_type.page)
+    print(f"Estimated time: {estimate.total:0.1f} s")
 
-    uart.tty.baudrate = baudrate
-    ok, _ = uart.wait_for_string(uart.prompt, timeout=1)
-    if not ok:
-        # Flasher will change baudrate and output command line prompt immediately.
-        # We need to recheck command line if host took too long to adjust speed and missed
-        # previous prompt.
-        response = uart.run("")
-        if response is None:
-            raise Exception("Failed to change baudrate")
 
-    # Try to wait for prompt for case if early when changing speed was received broken symbol '#'
-    uart.wait_for_string(uart.prompt, timeout=0.1)
+def cmd_flash_plan(
+    uart: UART,
+    plan: FlashPlan,
+    files: dict,
+    hide_progress_bar: bool,
+    flash_type,
+    state: Optional[BoardState] = None,
+):
+    """Erase and write flash according to the plan, then verify all touched sectors. Sectors
+    which are up to date according to cached board layout are skipped. If verification fails
+    after skipping them, the cached layout is dropped and the whole plan is run again."""
+    time_start = time.monotonic()
+    sector = flash_type.sector
+    runs = sector_runs(list(plan.sectors))
+    sector_crcs, run_crcs = plan.crcs(files)
+    todo = plan
+    if state is not None and sector_crcs:
+        unchanged = state.unchanged_sectors(sector_crcs)
+        if unchanged:
+            print(f"{len(unchanged)} sectors are already up to date")
+            todo = copy.deepcopy(plan)
+            todo.keep_sectors(unchanged)
+
+    def run(plan: FlashPlan):
+        print_plan(plan, uart, flash_type)
+        for run_start, run_count in sector_runs(list(plan.sectors)):
+            erase(uart, run_start * sector, run_count * sector, hide_progress_bar, flash_type)
+        for session in plan.write_sessions():
+            size = session[-1].end - session[0].start
+            print(f"Writing to flash {size / 1024:.2f} KB at {session[0].start:#x}...")
+            reader = io.BufferedReader(PlanReader(plan, session, files))
+            flash(uart, session[0].start, reader, size, hide_progress_bar, flash_type.page)
+
+        print("Checking...")
+        for (run_start, run_count), crc in zip(runs, run_crcs):
+            check_flash(uart, run_start * sector, run_count * sector, crc, state)
+
+    try:
+        run(todo)
+    except VerificationError:
+        if todo is plan:
+            raise
+        print("Verification failed, cached flash layout is dropped, the plan is run again")
+        run(plan)
+    if state is not None and sector_crcs:
+        state.record(sector_crcs)
+    print(f"Total: {time.monotonic() - time_start:0.1f} s")
 
 
 def int_size(size):
@@ -233,6 +861,410 @@ def int_size(size):
     return int(size, 0)
 
 
+def to_size(value):
+    """
+    >>> to_size(65536), to_size(16 * 1024 * 1024), to_size(100)
+    ('64 KiB', '16 MiB', '100 B')
+    """
+    units = ["B", "KiB", "MiB", "GiB"]
+    unit_idx = 0
+    while (value // 1024) * 1024 == value and unit_idx < len(units) - 1:
+        unit_idx += 1
+        value //= 1024
+
+    return f"{value} {units[unit_idx]}"
+
+
+def select_qspi(uart: UART, qspi: str, voltage18: bool):
+    with measure(uart, "select"):
+        response = uart.run(f"qspi {qspi[-1:]} {int(voltage18)}")
+    if response is None or "Selected" not in response:
+        raise Exception(f"Failed to select QSPI controller: {response}")
+
+
+def print_flash_type(flash_type, qspi: str) -> bool:
+    """Print detected flash parameters. Return False if flash is unknown."""
+    if flash_type.name is not None:
+        print(f"Found {flash_type.name} memory on {qspi.upper()}")
+        print(
+            f"Flash size: {to_size(flash_type.size)}, erase sector: {to_size(flash_type.sector)}, "
+            + f"page: {to_size(flash_type.page)}"
+        )
+        return True
+
+    ids = ", ".join([hex(x) for x in flash_type.id_bytes])
+    print(f"Unknown SPI flash on {qspi.upper()} (ID: {ids})")
+    print("Use --flash-size, --flash-sector and --flash-page options to specify flash parameters")
+    return False
+
+
+def cmd_protect(uart: UART, flash_type, protect: bool):
+    protector = get_flash_protector(flash_type, uart)
+    if protect and protector.is_protected:
+        print("Flash is protected already")
+    elif protect:
+        protector.protect()
+        print("Flash is protected successfully")
+    elif protector.is_protected:
+        protector.unprotect()
+        print("Flash is unprotected successfully")
+    else:
+        print("Flash is unprotected already")
+
+
+# Result of probing of serial port by discover command. `baudrate` is baudrate of the response,
+# `flash` is name (or ID bytes) of flash if it is requested and QSPI flasher is executing.
+BoardProbe = namedtuple("BoardProbe", "port usb_serial state baudrate flash")
+# Banners of flashers in response to empty command
+FLASHER_MSG = "QSPI Flasher"
+OTP_FLASHER_MSG = "OTP Flasher"
+# Timeout of response to empty command while boards are discovered
+PROBE_TIMEOUT = 0.3
+
+
+def probe_board(
+    port: str, usb_serial: Optional[str], baudrates: list, qspi: Optional[str], voltage18: bool
+) -> BoardProbe:
+    """Detect state of board on serial `port` by response to empty command at `baudrates` (as
+    upload_flasher() does): bootrom, flasher, otp-flasher, unresponsive or unavailable (port
+    can not be opened or is used by other instance of the tools). Flash on `qspi` is detected
+    if QSPI flasher is executing (the controller is selected with `voltage18` setting), state
+    is error if flasher fails to detect it."""
+    try:
+        uart = UART(prompt="#", port=port, baudrate=baudrates[0], timeout=PROBE_TIMEOUT / 10)
+    except (OSError, serial.SerialException):
+        return BoardProbe(port, usb_serial, "unavailable", None, None)
+
+    try:
+        for baudrate in baudrates:
+            uart.tty.baudrate = baudrate
+            response = uart.run("", timeout=PROBE_TIMEOUT)
+            if response is None:
+                continue
+            if OTP_FLASHER_MSG in response:
+                return BoardProbe(port, usb_serial, "otp-flasher", baudrate, None)
+            if FLASHER_MSG not in response:
+                return BoardProbe(port, usb_serial, "bootrom", baudrate, None)
+            flash = None
+            if qspi is not None:
+                try:
+                    select_qspi(uart, qspi, voltage18)
+                    flash_type = get_flash_type(uart, None, None, None)
+                except (OSError, serial.SerialException):
+                    raise
+                except Exception:
+                    return BoardProbe(port, usb_serial, "error", baudrate, None)
+                flash = flash_type.name or " ".join(f"{x:02x}" for x in flash_type.id_bytes)
+            return BoardProbe(port, usb_serial, "flasher", baudrate, flash)
+    except (OSError, serial.SerialException):
+        pass
+    finally:
+        uart.tty.close()
+    return BoardProbe(port, usb_serial, "unresponsive", None, None)
+
+
+def format_boards(boards: list) -> str:
+    """Return table of discovered boards
+
+    >>> boards = [BoardProbe("/dev/ttyUSB0", "A10K2Z", "flasher", 115200, "W25Q128JV-IN/IQ/JQ")]
+    >>> boards.append(BoardProbe("/dev/ttyUSB1", None, "unresponsive", None, None))
+    >>> print(format_boards(boards))
+    PORT          USB SERIAL  STATE         BAUDRATE  FLASH
+    /dev/ttyUSB0  A10K2Z      flasher       115200    W25Q128JV-IN/IQ/JQ
+    /dev/ttyUSB1  -           unresponsive  -         -
+    """
+    header = ["PORT", "USB SERIAL", "STATE", "BAUDRATE", "FLASH"]
+    rows = [header] + [["-" if x is None else str(x) for x in board] for board in boards]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(x.ljust(width) for x, width in zip(row, widths)).rstrip() for row in rows
+    )
+
+
+def cmd_discover(
+    ports: dict, baudrate: int, qspi: Optional[str], voltage18: bool, as_json: bool
+) -> int:
+    """Probe serial `ports` (mapping of port to USB serial number) concurrently and print state
+    of boards. Boards are probed at 115200 and at `baudrate` (flasher could be left at it)."""
+    if not ports:
+        print("No serial ports are found", file=sys.stderr)
+        return 1
+    baudrates = [115200] + ([baudrate] if baudrate != 115200 else [])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        boards = list(
+            executor.map(
+                lambda port: probe_board(port, ports[port], baudrates, qspi, voltage18), ports
+            )
+        )
+    if as_json:
+        print(json.dumps([board._asdict() for board in boards], indent=2))
+    else:
+        print(format_boards(boards))
+    return 0
+
+
+JOB_COMMANDS = ["flash", "erase", "read", "protect", "unprotect"]
+
+
+def load_job(fname: str) -> list:
+    """Load job file: TOML with [[step]] tables. Every step contains command, qspi (default is
+    controller of previous step or qspi0), voltage18 and arguments of the command: image and
+    offset for flash, offset and size for erase, file, offset and size for read. Sizes and
+    offsets are integers or strings like "128K". Paths are relative to the job file."""
+    with open(fname, "rb") as f:
+        steps = tomllib.load(f).get("step", [])
+    if not steps:
+        print(f"There are no [[step]] tables in {fname}")
+        sys.exit(1)
+
+    job_dir = os.path.dirname(fname)
+    qspi = "qspi0"
+    job = []
+    for i, properties in enumerate(steps, 1):
+        step = dict(properties)
+        command = step.get("command")
+        if command not in JOB_COMMANDS:
+            print(f"Step {i}: unsupported command '{command}' (use {', '.join(JOB_COMMANDS)})")
+            sys.exit(1)
+        qspi = step.setdefault("qspi", qspi)
+        step.setdefault("voltage18", False)
+        if qspi not in ["qspi0", "qspi1"]:
+            print(f"Step {i}: unsupported QSPI controller '{qspi}'")
+            sys.exit(1)
+        if qspi == "qspi0" and step["voltage18"]:
+            print(f"Step {i}: unsupported QSPI0 settings: voltage18 is forbidden")
+            sys.exit(1)
+        for key in ["offset", "size"]:
+            if isinstance(step.get(key), str):
+                step[key] = int_size(step[key])
+        step.setdefault("offset", 0)
+        step.setdefault("size", None)
+        for key in ["image", "file"]:
+            if key in step:
+                step[key] = os.path.join(job_dir, step[key])
+        if command == "flash" and not os.path.isfile(step.get("image", "")):
+            print(f"Step {i}: image '{step.get('image')}' is not an existing regular file")
+            sys.exit(1)
+        if command == "read" and "file" not in step:
+            print(f"Step {i}: file to save data is not specified")
+            sys.exit(1)
+        job.append(step)
+    return job
+
+
+def cmd_run_job(
+    uart: UART,
+    job: list,
+    hide_progress_bar: bool,
+    flash_params: tuple,
+    state_cache: Optional[StateCache] = None,
+    index: Optional[ImageIndex] = None,
+):
+    """Run steps of job in one flasher session. QSPI controller is selected only if it differs
+    from controller of previous step, flash is detected once per controller."""
+    time_start = time.monotonic()
+    selected = None
+    flash_types: dict = {}
+    states: dict = {}
+    for i, step in enumerate(job, 1):
+        qspi = step["qspi"]
+        controller = (qspi, step["voltage18"])
+        if uart.metrics is not None:
+            uart.metrics.start(f"run:{step['command']}", step=i)
+        if controller != selected:
+            select_qspi(uart, qspi, step["voltage18"])
+            selected = controller
+        if controller not in flash_types:
+            flash_types[controller] = get_flash_type(uart, *flash_params)
+            if not print_flash_type(flash_types[controller], qspi):
+                sys.exit(1)
+            if state_cache is not None:
+                states[controller] = BoardState(state_cache, uart, qspi, flash_types[controller])
+        flash_type = flash_types[controller]
+        state = states.get(controller)
+        if uart.calibration is not None:
+            uart.calibration.select(flash_type)
+        if uart.metrics is not None:
+            uart.metrics.update(qspi=qspi, flash_type=flash_type.name)
+
+        command = step["command"]
+        print(f"Step {i}/{len(job)}: {command} on {qspi.upper()}")
+        if command == "flash":
+            cmd_flash(
+                uart, step["image"], step["offset"], hide_progress_bar, flash_type, state, index
+            )
+        elif command == "erase":
+            cmd_erase(uart, step["offset"], step["size"], hide_progress_bar, flash_type, state)
+        elif command == "read":
+            cmd_read(
+                uart, step["file"], step["offset"], step["size"], hide_progress_bar, flash_type
+            )
+        else:
+            cmd_protect(uart, flash_type, command == "protect")
+
+    print(f"Job is done: {len(job)} steps in {time.monotonic() - time_start:0.1f} s")
+
+
+def estimated_flash_type(calibration: Calibration, flash_params: tuple) -> FlashType:
+    """Return flash type of the last session (or W25Q128-like flash if there were no sessions)
+    with parameters redefined by `flash_params` (size, sector, page)"""
+    last = calibration.last_flash()
+    name, size, sector, page = last if last is not None else ("unknown", 16 * MiB, 64 * KiB, 256)
+    size, sector, page = [
+        auto if manual is None else manual
+        for manual, auto in zip(flash_params, [size, sector, page])
+    ]
+    return FlashType(name, size, sector, page, [])
+
+
+def estimate_flash(estimate: Estimate, flash_type, offset: int, size: int):
+    """Add erase, write and verify of image of `size` bytes at `offset` to estimate"""
+    estimate_erase(estimate, flash_type, offset, size)
+    estimate.write(size)
+    estimate.verify(size)
+
+
+def estimate_erase(estimate: Estimate, flash_type, offset: int, size: Optional[int]):
+    if offset < 0:
+        offset = flash_type.size + offset
+    if size is None:
+        size = flash_type.size - offset
+    first_sector = offset // flash_type.sector
+    last_sector = int(math.ceil((offset + size) / flash_type.sector)) - 1
+    estimate.erase(last_sector - first_sector + 1)
+
+
+def cmd_estimate(
+    args: argparse.Namespace,
+    calibration: Calibration,
+    flash_type,
+    job: list,
+    plan: Optional[FlashPlan] = None,
+) -> int:
+    """Print predicted duration of the command without connection to the board"""
+    calibration.select(flash_type, remember=False)
+    timings = calibration.timings(args.baudrate)
+    measured = [x for x in Timings._fields if calibration.timing(x, args.baudrate) is not None]
+    if plan is not None:
+        estimate = plan.estimate(timings, flash_type.page)
+    else:
+        estimate = Estimate(timings, flash_type.page)
+
+    images: dict = {}
+    if args.command == "flash":
+        if args.image == "-":
+            print("Duration of flashing from stdin can not be estimated")
+            return 1
+        images = {args.offset: args.image}
+    elif args.command == "flash-tl":
+        images = {0: args.bootrom_sbimg, 0x200000: args.sbl_tl_sbimg, 0xA00000: args.sbl_tl_otp}
+    elif args.command == "flash-tl-dir":
+        paths = [glob.glob(os.path.join(args.tl_images_dir, x)) for x in args.tl_images]
+        images = {k: p[0] for k, p in zip([0, 0x200000, 0xA00000], paths) if p}
+    elif args.command == "read":
+        ranges = list(args.ranges)
+        if args.fname is not None:
+            ranges.append(ReadRange(args.offset, args.size, args.fname))
+        for r in ranges:
+            offset = flash_type.size + r.offset if r.offset < 0 else r.offset
+            estimate.read(r.size if r.size is not None else flash_type.size - offset)
+    elif args.command == "erase":
+        estimate_erase(estimate, flash_type, args.offset, args.size)
+    elif args.command == "run":
+        for step in job:
+            if step["command"] == "flash":
+                estimate_flash(estimate, flash_type, step["offset"], os.stat(step["image"]).st_size)
+            elif step["command"] == "erase":
+                estimate_erase(estimate, flash_type, step["offset"], step["size"])
+            elif step["command"] == "read":
+                offset = flash_type.size + step["offset"] if step["offset"] < 0 else step["offset"]
+                size = step["size"] if step["size"] is not None else flash_type.size - offset
+                estimate.read(size)
+
+    for offset, image in images.items():
+        if not os.path.isfile(image):
+            print(f"{image} is not an existing regular file")
+            return 1
+        estimate_flash(estimate, flash_type, offset, os.stat(image).st_size)
+    if args.command in ["flash-tl", "flash-tl-dir"]:
+        estimate_erase(estimate, flash_type, 0xC10000, int_size("128K"))
+
+    if args.flasher is not None:
+        flasher_size = os.stat(args.flasher).st_size
+    else:
+        ref = importlib.resources.files("mcom03_flash_tools") / "spi-flasher-mips-ram.hex"
+        flasher_size = len(ref.read_bytes())
+    # Flasher is uploaded to BootROM at 115200 (if it is not executing yet)
+    estimate.add("upload", flasher_size * 10 / 115200)
+
+    print(
+        f"Flash: {flash_type.name} ({flash_type.size // KiB} KiB, sector {flash_type.sector} "
+        + f"bytes, page {flash_type.page} bytes), UART baudrate: {args.baudrate}"
+    )
+    print(
+        f"Timings: erase {timings.erase_sector:.3f} s/sector, program "
+        + f"{timings.page_program * 1000:.2f} ms/page, readcrc {format_rate(timings.crc_rate)}, "
+        + f"link {format_rate(timings.link_rate)}"
+    )
+    print(f"Measured: {', '.join(measured) if measured else 'none (default timings are used)'}")
+    for phase, duration in estimate.phases.items():
+        print(f"  {phase:8} {duration:8.1f} s")
+    print(f"Estimated time: {estimate.total:0.1f} s")
+    return 0
+
+
+SUPPORTED_PACKAGE_VERSIONS = ["0.0.1", "0.0.2"]
+
+
+def select_profile(toml_dict: dict, profile_name: Optional[str], action: str) -> tuple[str, dict]:
+    """Return name and actions of the profile of package description to run"""
+    profiles = toml_dict["profile"]
+    if not profile_name:
+        profile_name = list(profiles.keys())[0]
+    elif profile_name not in profiles.keys():
+        print(f"There is no profile '{profile_name}' in the package description")
+        sys.exit(1)
+    if action == "all":
+        return profile_name, profiles[profile_name]
+
+    if action not in profiles[profile_name].keys():
+        print(f"There is no action '{action}' in the profile '{profile_name}'")
+        sys.exit(1)
+    return profile_name, dict({action: profiles[profile_name][action]})
+
+
+def check_member_digest(
+    package: PackageReader,
+    name: str,
+    size: Optional[int],
+    sha256: Optional[str],
+    index: Optional[ImageIndex] = None,
+) -> Optional[str]:
+    """Return error message if package member doesn't match expected size and SHA-256"""
+    indexed = index.add_tar_member(package.path, name, package) if index is not None else None
+    if indexed is not None:
+        # SHA-256 stored in the index is not trusted, extracted payload is hashed again
+        file = open(indexed.path, "rb")
+    else:
+        _, member = package.get(name)
+        if member is None:
+            return f"There is no file '{name}' in {package.path}"
+        file = io.BufferedReader(member)
+    digest = hashlib.sha256()
+    actual_size = 0
+    with file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+            actual_size += len(chunk)
+    actual_sha256 = digest.hexdigest()
+
+    if size is not None and actual_size != size:
+        return f"Size of '{name}' is {actual_size} bytes, but {size} bytes are expected"
+    if sha256 is not None and actual_sha256 != sha256.lower():
+        return f"SHA-256 of '{name}' is {actual_sha256}, but {sha256.lower()} is expected"
+    return None
+
+
 __doc__ = """Tool to flash/read/erase QSPI0, QSPI1 memory connected to MCom-03 SoC (1892ВА018).
 Tool algorithm:
 
@@ -251,15 +1283,6 @@ def main() -> int:
     class Formatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
         pass
 
-    def to_size(value):
-        units = ["B", "KiB", "MiB", "GiB"]
-        unit_idx = 0
-        while (value // 1024) * 1024 == value and unit_idx < len(units) - 1:
-            unit_idx += 1
-            value //= 1024
-
-        return f"{value} {units[unit_idx]}"
-
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=Formatter)
     subparsers = parser.add_subparsers(dest="command")
 
@@ -277,6 +1300,34 @@ def main() -> int:
     parser_unprotect = subparsers.add_parser(
         "unprotect", help="Remove QSPI protection from writing/erasing"
     )
+    parser_run = subparsers.add_parser(
+        "run", help="Run operations listed in job file in one flasher session"
+    )
+    parser_run.add_argument(
+        "job",
+        help="TOML job file with [[step]] tables (command, qspi, voltage18, image, file, offset, "
+        + "size)",
+    )
+    parser_run.set_defaults(qspi=None, voltage18=False)
+    parser_discover = subparsers.add_parser(
+        "discover", help="Find boards on serial ports and show their state"
+    )
+    parser_discover.add_argument(
+        "ports", nargs="*", help="serial ports or glob patterns (default: all USB serial ports)"
+    )
+    parser_discover.add_argument(
+        "--flash-id",
+        choices=["qspi0", "qspi1"],
+        help="detect flash on QSPI controller of boards with executing flasher (the controller "
+        + "is selected in flasher)",
+    )
+    parser_discover.add_argument(
+        "--voltage18",
+        action="store_true",
+        help="Setup QSPI1 to 1.8V for --flash-id qspi1. Not used for QSPI0",
+    )
+    parser_discover.add_argument("--json", action="store_true", help="print result as JSON")
+    parser_discover.set_defaults(qspi=None)
 
     for p in [
         parser_flash,
@@ -299,8 +1350,47 @@ def main() -> int:
         + "128kB (128000 bytes), 4MB (4000000 bytes). If not defined then will be used all rest "
         + "of flash (after --offset)"
     )
-    parser_flash.add_argument("image", help="path binary image to flash to SPI")
-    parser_read.add_argument("fname", help="file name to save")
+    parser_flash.add_argument(
+        "image", help="path binary image to flash to SPI ('-' to read image from stdin)"
+    )
+    parser_read.add_argument(
+        "fname", nargs="?", help="file name to save ('-' to write data to stdout)"
+    )
+    parser_read.add_argument(
+        "--compress",
+        choices=["gzip", "xz", "zstd"],
+        help="compress data while reading (zstd requires 'zstandard' package)",
+    )
+    parser_read.add_argument(
+        "--sha256", action="store_true", help="calculate and print SHA-256 of read data"
+    )
+    parser_read.add_argument(
+        "--range",
+        dest="ranges",
+        metavar="OFFSET:SIZE:FILE",
+        type=parse_read_range,
+        action="append",
+        default=[],
+        help="read SIZE bytes from OFFSET to FILE. Can be specified multiple times, all ranges "
+        + "are read in one session",
+    )
+    parser_read.add_argument(
+        "--regions",
+        metavar="TOML",
+        help="TOML file with [region.<name>] tables (offset, size, negative_offset, file) "
+        + "describing ranges to read, or package description (package.toml or tl-image) which "
+        + "profile actions are read",
+    )
+    parser_read.add_argument(
+        "--profile",
+        help="The profile of a package description in --regions to be used",
+    )
+    parser_read.add_argument(
+        "--sparse",
+        action="store_true",
+        help="read only non-blank regions found by CRC (blank regions are saved as 0xFF), "
+        + "save layout of non-blank regions to FNAME.bmap",
+    )
     for p in [parser_read, parser_erase]:
         p.add_argument("size", type=int_size, nargs="?", help=help_msg)
     for p in [parser_flash, parser_read, parser_erase]:
@@ -354,15 +1444,78 @@ def main() -> int:
         "-p",
         "--port",
         default="/dev/ttyUSB0",
-        help="serial port on host the device UART0 is connected to",
+        help="serial port on host the device UART0 is connected to or pyserial URL "
+        + "(rfc2217://host:port, socket://host:port)",
     )
     parser.add_argument("-b", "--baudrate", type=int, default=115200, help="specify UART baudrate")
+    parser.add_argument(
+        "--flow-control",
+        choices=FLOW_CONTROLS,
+        default="none",
+        help="flow control of host serial port (xonxoff is disabled while binary data is read)",
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="show UART traffic")
     parser.add_argument(
         "--hide-progress-bar",
         action="store_true",
         help="do not show progress bar (progress bar is hidden in non-interactive shell)",
     )
+    parser.add_argument(
+        "--state-cache",
+        action="store_true",
+        help="remember flash layout written to the board and rewrite only changed sectors "
+        + "next time",
+    )
+    parser.add_argument(
+        "--image-index",
+        action="store_true",
+        help="keep hashes, CRC tables and extracted tar members of flashed images in local index "
+        + "to start next flashing of the same images faster",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="append JSON record with performance metrics of the operation to FILE",
+    )
+    parser.add_argument(
+        "--prom-file",
+        metavar="FILE",
+        help="update file FILE in Prometheus text format (node_exporter textfile collector) with "
+        + "counters and histograms of the operation",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record transmitted and received data of UART session with timestamps to FILE "
+        + "(can be replayed by --port replay://FILE)",
+    )
+    parser.add_argument(
+        "--uart-profile",
+        action="store_true",
+        help="print latency histograms of flasher commands and breakdown of time spent by host, "
+        + "UART link and device at exit",
+    )
+    parser.add_argument(
+        "--adaptive-baudrate",
+        action="store_true",
+        help="step baudrate down on bursts of CRC errors or stalls of read and continue from "
+        + "the current offset instead of failing (baudrate is stepped up after error-free data)",
+    )
+    parser.add_argument(
+        "--reconnect-timeout",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="wait SECONDS for USB-UART adapter (found by USB serial number) after its "
+        + "disconnect and continue the operation from the last acknowledged page or sector "
+        + "(default: 0, fail on disconnect)",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="do not connect to the board, print predicted duration of the command based on "
+        + "timings measured in previous sessions with the last used flash",
+    )
     parser.add_argument("--flash-size", type=int_size, help="redefine flash total size")
     parser.add_argument("--flash-sector", type=int_size, help="redefine flash erase sector size")
     parser.add_argument("--flash-page", type=int_size, help="redefine flash page size")
@@ -378,6 +1531,12 @@ def main() -> int:
 
     args = parser.parse_args()
 
+    stdout = None
+    if args.command == "read" and args.fname == "-":
+        # Data is written to stdout, so messages are moved to stderr
+        stdout = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
     if not sys.stdout.isatty():
         args.hide_progress_bar = True
 
@@ -386,6 +1545,12 @@ def main() -> int:
     if args.command is None:
         print("Command is not specified")
         return 1
+    elif args.command == "discover":
+        if args.flash_id != "qspi1" and args.voltage18:
+            print("--voltage18 can be used only with --flash-id qspi1")
+            return 1
+        ports = usb_serial_ports(args.ports)
+        return cmd_discover(ports, args.baudrate, args.flash_id, args.voltage18, args.json)
     elif (
         args.command == "flash-tl"
         or args.command == "flash-tl-dir"
@@ -395,87 +1560,107 @@ def main() -> int:
             print("Unsupported QSPI controller")
             return 1
 
+    if args.command == "read":
+        if args.regions is not None:
+            args.ranges += load_read_regions(args.regions, args.profile)
+        if args.fname is None and not args.ranges:
+            print("File name or --range/--regions is required")
+            return 1
+        if args.ranges and (args.sparse or args.compress or args.sha256 or args.fname == "-"):
+            print("--range/--regions can not be used with --sparse, --compress, --sha256 or '-'")
+            return 1
+
     if args.qspi == "qspi0" and args.voltage18:
         print("Unsupported QSPI0 settings: --voltage18 is forbidden")
         return 1
 
-    uart = UART(prompt="#", port=args.port, baudrate=115200, verbose=args.verbose)
-    upload_flasher(uart, "spi-flasher-mips-ram.hex", "QSPI Flasher", args.flasher)
-    if args.baudrate != 115200:
-        change_baudrate(uart, args.baudrate)
+    job: list = []
+    if args.command == "run":
+        job = load_job(args.job)
 
-    print(f"UART baudrate: {args.baudrate}")
-    response = uart.run(f"qspi {args.qspi[-1:]} {int(args.voltage18)}")
-    if response is None or "Selected" not in response:
-        raise Exception(f"Failed to select QSPI controller: {response}")
+    index = ImageIndex() if args.image_index else None
 
-    flash_type = get_flash_type(uart, args.flash_size, args.flash_sector, args.flash_page)
-    if flash_type.name is not None:
-        print(f"Found {flash_type.name} memory on {args.qspi.upper()}")
-        print(
-            f"Flash size: {to_size(flash_type.size)}, erase sector: {to_size(flash_type.sector)}, "
-            + f"page: {to_size(flash_type.page)}"
-        )
-    else:
-        ids = ", ".join([hex(x) for x in flash_type.id_bytes])
-        print(f"Unknown SPI flash on {args.qspi.upper()} (ID: {ids})")
-        print(
-            "Use --flash-size, --flash-sector and --flash-page options to specify flash parameters"
+    digest_checks = []
+    if args.command == "flash-tl-image":
+        if os.path.isfile(args.tl_image) is False:
+            print(f"{args.tl_image} is not an existing regular file")
+            return 1
+        if tarfile.is_tarfile(args.tl_image) is False:
+            print(f"{args.tl_image} is not tar file")
+            return 1
+        # Package description and images are extracted in one pass of decompression
+        package = PackageReader(args.tl_image)
+        _, package_toml = package.get("package.toml")
+        if package_toml is None:
+            package.close()
+            print(f"There is no 'package.toml' file in {args.tl_image}")
+            return 1
+        toml_dict = tomllib.loads(package_toml.read().decode())
+        version = toml_dict.get("info", {}).get("format_version", None)
+        if version not in SUPPORTED_PACKAGE_VERSIONS:
+            package.close()
+            print(f"Unsupported version ({version}) of the package description is provided")
+            print(f"The supported versions are {', '.join(SUPPORTED_PACKAGE_VERSIONS)}")
+            return 1
+        profile_name, profile = select_profile(toml_dict, args.profile, args.action)
+        for action, properties in profile.items():
+            if properties.get("command") != "flash" or version >= "0.0.2":
+                continue
+            if "sha256" in properties or "size" in properties:
+                package.close()
+                print(f"Action '{profile_name}::{action}': sha256 and size of flash action are")
+                print("supported since version 0.0.2 of the package description")
+                return 1
+        # Only members referenced by the profile are extracted further
+        package.select(
+            [x["name"] for x in profile.values() if x.get("command") == "flash" and "name" in x]
         )
-        return 1
 
-    def flash_images(images: dict, image_dir: str = ""):
-        for offset, image in images.items():
-            if image == "_":
+        # Package members are validated while flasher is uploading
+        executor = concurrent.futures.ThreadPoolExecutor()
+        for properties in profile.values() if not args.estimate else []:
+            if properties.get("command") != "flash" or properties.get("name") is None:
                 continue
-            paths = glob.glob(os.path.join(image_dir, image))
-            if len(paths) == 0:
-                print(f"Wrong path to {image}", file=sys.stderr)
-                sys.exit(1)
-            print(f"Flash {paths[0]} starting from {hex(offset)} bytes")
-            cmd_flash(
-                uart,
-                paths[0],
-                offset,
-                args.hide_progress_bar,
-                flash_type,
-            )
-        return
-
-    def get_file_from_tar(tar: tarfile.TarFile, filename: str) -> tuple[int, Any]:
-        try:
-            member = tar.getmember(filename)
-            file = tar.extractfile(member)
-        except KeyError:
-            return 0, None
-
-        if file is None:
-            return 0, None
-
-        return member.size, file
-
-    def parse_package(tar: tarfile.TarFile, toml_dict: dict):
-        profiles = toml_dict["profile"]
-        args_profile = args.profile
-        args_action = args.action
-        if not args_profile:
-            args_profile = list(profiles.keys())[0]
-        elif args_profile not in profiles.keys():
-            print(f"There is no profile '{args_profile}' in the package description")
-            sys.exit(1)
-        if args_action == "all":
-            profile = profiles[args_profile]
-        else:
-            if args_action not in profiles[args_profile].keys():
-                print(f"There is no action '{args_action}' in the profile '{args_profile}'")
-                sys.exit(1)
-            profile = dict({args_action: profiles[args_profile][args_action]})
+            if "sha256" in properties or "size" in properties:
+                digest_checks.append(
+                    executor.submit(
+                        check_member_digest,
+                        package,
+                        properties["name"],
+                        properties.get("size"),
+                        properties.get("sha256"),
+                        index,
+                    )
+                )
+        executor.shutdown(wait=False)
+
+    def open_member(package: PackageReader, name: str) -> tuple[int, Any, Optional[ImageTables]]:
+        """Return size, file object and CRC tables (if image index is used) of package member"""
+        indexed = None
+        if index is not None:
+            indexed = index.add_tar_member(args.tl_image, name, package)
+        if indexed is None:
+            size, file = package.get(name)
+            return size, file, None
+
+        tables = indexed.tables(flash_type.page, flash_type.sector)
+        return indexed.size, open(indexed.path, "rb"), tables
+
+    def plan_package(
+        package: PackageReader, profile_name: str, profile: dict
+    ) -> tuple[FlashPlan, dict]:
+        """Return plan of profile actions and file objects of package members"""
+        plan = FlashPlan(flash_type.sector)
+        files = {}
         for action, properties in profile.items():
-            print(f"Run '{args_profile}::{action}' action:")
+            print(f"Action '{profile_name}::{action}':")
             is_negative = properties.get("negative_offset", False)
             offset = properties.get("offset", 0)
             if is_negative:
-                offset = -offset
+                offset = flash_type.size - offset
+            if offset & (flash_type.sector - 1):
+                print(f"  Offset must be aligned with erase sector size ({flash_type.sector})")
+                sys.exit(1)
             desc = properties.get("description")
             command = properties.get("command")
             if command == "flash":
@@ -483,88 +1668,217 @@ def main() -> int:
                 if name is None:
                     print("  The file name isn't provided in the profile")
                     sys.exit(1)
-                size, file = get_file_from_tar(tar, name)
+                if name not in files:
+                    files[name] = open_member(package, name)
+                size, file, tables = files[name]
                 if file is None:
                     print(f"  There is no file '{name}' in {args.tl_image}")
                     sys.exit(1)
+                if offset + size > flash_type.size:
+                    print("  Image doesn't fit to flash memory")
+                    sys.exit(1)
                 print(f"  Description: {desc}\n  Offset: {hex(offset)}\n  Image: {name}")
-                cmd_flash_file(uart, offset, file, size, args.hide_progress_bar, flash_type)
+                plan.erase(offset, size)
+                extents = [(0, size)]
+                if tables is not None:
+                    extents = nonblank_extents(tables, flash_type.page, 0, size, BLANK_GAP_PAGES)
+                for start, length in extents:
+                    plan.write(offset + start, length, name, start)
             elif command == "erase":
                 size = properties.get("size")
-                print(f"  Description: {desc}\n  Offset: {hex(offset)}")
-                cmd_erase(uart, offset, size, args.hide_progress_bar, flash_type)
+                if size is None:
+                    size = flash_type.size - offset
+                if offset + size > flash_type.size:
+                    print("  Out of flash memory erase requested")
+                    sys.exit(1)
+                print(f"  Description: {desc}\n  Offset: {hex(offset)}\n  Size: {hex(size)}")
+                plan.erase(offset, size)
             else:
                 print(f"  Unsupported command '{command}' is provided in the profile")
                 sys.exit(1)
 
-    if args.command == "flash":
-        cmd_flash(uart, args.image, args.offset, args.hide_progress_bar, flash_type)
-    elif args.command == "read":
-        cmd_read(uart, args.fname, args.offset, args.size, args.hide_progress_bar, flash_type)
-    elif args.command == "erase":
-        cmd_erase(uart, args.offset, args.size, args.hide_progress_bar, flash_type)
-    elif args.command == "protect":
-        protector = get_flash_protector(flash_type, uart)
-        if protector.is_protected:
-            print("Flash is protected already")
-        else:
-            protector.protect()
-            print("Flash is protected successfully")
-    elif args.command == "unprotect":
-        protector = get_flash_protector(flash_type, uart)
-        if protector.is_protected:
-            protector.unprotect()
-            print("Flash is unprotected successfully")
-        else:
-            print("Flash is unprotected already")
-    elif args.command == "flash-tl":
-        flash_images(
-            {0: args.bootrom_sbimg, 0x200000: args.sbl_tl_sbimg, 0xA00000: args.sbl_tl_otp}
-        )
-    elif args.command == "flash-tl-dir":
-        if os.path.isdir(args.tl_images_dir) is False:
-            print(f"Path {args.tl_images_dir} is not valid directory")
-            return 1
-        if len(args.tl_images) != 3:
-            print("Wrong number of images is provided")
-            return 1
-        flash_images(
-            {0: args.tl_images[0], 0x200000: args.tl_images[1], 0xA00000: args.tl_images[2]},
-            args.tl_images_dir,
-        )
-    elif args.command == "flash-tl-image":
-        if os.path.isfile(args.tl_image) is False:
-            print(f"{args.tl_image} is not an existing regular file")
-            return 1
-        if tarfile.is_tarfile(args.tl_image) is False:
-            print(f"{args.tl_image} is not tar file")
+        return plan, {name: x[1] for name, x in files.items()}
+
+    flash_params = (args.flash_size, args.flash_sector, args.flash_page)
+    calibration = Calibration(os.path.join(default_cache_dir(), CALIBRATION_FILE))
+    if args.estimate:
+        flash_type = estimated_flash_type(calibration, flash_params)
+        plan = None
+        if args.command == "flash-tl-image":
+            plan, files = plan_package(package, profile_name, profile)
+            for file in files.values():
+                file.close()
+            package.close()
+        return cmd_estimate(args, calibration, flash_type, job, plan)
+
+    metrics = create_metrics(
+        args.metrics,
+        args.prom_file,
+        "mcom03-flash",
+        args.command,
+        port=args.port,
+        baudrate=args.baudrate,
+    )
+
+    uart = UART(
+        prompt="#",
+        port=args.port,
+        baudrate=115200,
+        verbose=args.verbose,
+        flow_control=args.flow_control,
+    )
+    uart.reconnect_timeout = args.reconnect_timeout
+    line_monitor = LineMonitor(uart)
+    atexit.register(line_monitor.report)
+    if args.trace:
+        enable_trace(uart, args.trace)
+    uart.metrics = metrics
+    if args.uart_profile:
+        enable_profiling(uart)
+    # Timings of replayed session are not real
+    if not args.port.startswith(REPLAY_PREFIX):
+        uart.calibration = calibration
+        atexit.register(calibration.save)
+    failed = False
+    try:
+        upload_flasher(uart, "spi-flasher-mips-ram.hex", FLASHER_MSG, args.flasher)
+        if args.baudrate != 115200:
+            change_baudrate(uart, args.baudrate)
+        if args.adaptive_baudrate:
+            uart.adaptive = AdaptiveBaudrate(args.baudrate)
+
+        print(f"UART baudrate: {args.baudrate}")
+        if args.command == "run":
+            state_cache = StateCache() if args.state_cache else None
+            cmd_run_job(uart, job, args.hide_progress_bar, flash_params, state_cache, index)
+            if args.baudrate != 115200:
+                change_baudrate(uart, 115200)
+            line_monitor.update()
+            if metrics is not None:
+                metrics.finish()
+            return 0
+
+        select_qspi(uart, args.qspi, args.voltage18)
+        flash_type = get_flash_type(uart, *flash_params)
+        if not print_flash_type(flash_type, args.qspi):
             return 1
-        with tarfile.open(args.tl_image, "r") as tar:
-            _, package_toml = get_file_from_tar(tar, "package.toml")
-            if package_toml is None:
-                print(f"There is no 'package.toml' file in {args.tl_image}")
+        if metrics is not None:
+            metrics.update(qspi=args.qspi, flash_type=flash_type.name)
+        if uart.calibration is not None:
+            uart.calibration.select(flash_type)
+
+        if digest_checks:
+            errors = [x for x in (check.result() for check in digest_checks) if x is not None]
+            if errors:
+                for error in errors:
+                    print(error)
+                print(f"Package {args.tl_image} is corrupted, flash is not changed")
                 return 1
-            toml_dict = tomllib.load(package_toml)
-            supported_version = "0.0.1"
-            version = toml_dict.get("info", {}).get("format_version", None)
-            if version != supported_version:
-                print(f"Unsupported version ({version}) of the package description is provided")
-                print(f"The supported version is {supported_version}")
+            print(f"Checksums of {len(digest_checks)} package member(s) are valid")
+
+        state = None
+        if args.state_cache:
+            state = BoardState(StateCache(), uart, args.qspi, flash_type)
+
+        def flash_images(images: dict, image_dir: str = ""):
+            for offset, image in images.items():
+                if image == "_":
+                    continue
+                paths = glob.glob(os.path.join(image_dir, image))
+                if len(paths) == 0:
+                    print(f"Wrong path to {image}", file=sys.stderr)
+                    sys.exit(1)
+                print(f"Flash {paths[0]} starting from {hex(offset)} bytes")
+                cmd_flash(
+                    uart,
+                    paths[0],
+                    offset,
+                    args.hide_progress_bar,
+                    flash_type,
+                    state,
+                    index,
+                )
+            return
+
+        if args.command == "flash":
+            cmd_flash(
+                uart, args.image, args.offset, args.hide_progress_bar, flash_type, state, index
+            )
+        elif args.command == "read" and args.ranges:
+            if args.fname is not None:
+                offset = args.offset if args.offset >= 0 else flash_type.size + args.offset
+                size = args.size if args.size is not None else flash_type.size - offset
+                args.ranges.append(ReadRange(offset, size, args.fname))
+            cmd_read_ranges(uart, args.ranges, args.hide_progress_bar, flash_type)
+        elif args.command == "read":
+            cmd_read(
+                uart,
+                args.fname,
+                args.offset,
+                args.size,
+                args.hide_progress_bar,
+                flash_type,
+                args.sparse,
+                args.compress,
+                args.sha256,
+                stdout,
+            )
+        elif args.command == "erase":
+            cmd_erase(uart, args.offset, args.size, args.hide_progress_bar, flash_type, state)
+        elif args.command == "protect" or args.command == "unprotect":
+            cmd_protect(uart, flash_type, args.command == "protect")
+        elif args.command == "flash-tl":
+            flash_images(
+                {0: args.bootrom_sbimg, 0x200000: args.sbl_tl_sbimg, 0xA00000: args.sbl_tl_otp}
+            )
+        elif args.command == "flash-tl-dir":
+            if os.path.isdir(args.tl_images_dir) is False:
+                print(f"Path {args.tl_images_dir} is not valid directory")
                 return 1
-            parse_package(tar, toml_dict)
-    else:
-        print("Unknown command")
-        return 1
-
-    if args.command == "flash-tl" or args.command == "flash-tl-dir":
-        # The tl software uses 2 pages to store its non-volatile settings at 0xC10000 offset.
-        # They have to be cleaned after flashing new tl images.
-        cmd_erase(uart, 0xC10000, int_size("128K"), args.hide_progress_bar, flash_type)
-
-    if args.baudrate != 115200:
-        change_baudrate(uart, 115200)
+            if len(args.tl_images) != 3:
+                print("Wrong number of images is provided")
+                return 1
+            flash_images(
+                {0: args.tl_images[0], 0x200000: args.tl_images[1], 0xA00000: args.tl_images[2]},
+                args.tl_images_dir,
+            )
+        elif args.command == "flash-tl-image":
+            plan, files = plan_package(package, profile_name, profile)
+            cmd_flash_plan(uart, plan, files, args.hide_progress_bar, flash_type, state)
+            for file in files.values():
+                file.close()
+        else:
+            print("Unknown command")
+            return 1
 
-    return 0
+        if args.command == "flash-tl" or args.command == "flash-tl-dir":
+            # The tl software uses 2 pages to store its non-volatile settings at 0xC10000 offset.
+            # They have to be cleaned after flashing new tl images.
+            cmd_erase(uart, 0xC10000, int_size("128K"), args.hide_progress_bar, flash_type, state)
+
+        if args.baudrate != 115200:
+            change_baudrate(uart, 115200)
+
+        line_monitor.update()
+        if metrics is not None:
+            metrics.finish()
+        return 0
+    except VerificationError as e:
+        failed = True
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        # Flasher is left at default baudrate on early return and on error, so the next run
+        # finds it. Error of this is not reported if the session has already failed.
+        failed = failed or sys.exc_info()[0] is not None
+        if uart.tty.baudrate != 115200:
+            try:
+                change_baudrate(uart, 115200)
+            except Exception:
+                if not failed:
+                    raise
+        if args.command == "flash-tl-image":
+            package.close()
 
 
 if __name__ == "__main__":
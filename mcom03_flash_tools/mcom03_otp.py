@@ -18,6 +18,8 @@ except ModuleNotFoundError:  # Python < 3.11
     import tomli as tomllib  # type: ignore
 
 from mcom03_flash_tools import UART, __version__, upload_flasher
+from mcom03_flash_tools.metrics import create_metrics, measure
+from mcom03_flash_tools.trace import enable_trace
 
 BitField = namedtuple("BitField", ["hi", "lo", "name", "func_status"])
 Record = namedtuple("Record", ["word_addr", "words_count", "name", "func_status", "bitfields"])
@@ -86,7 +88,8 @@ def check_status_letter(uart: UART, letters: list[str], err_msg: str):
 
 
 def program(uart: Optional[UART], data: bytes, addr: int):
-    print(f"Programming {len(data)} bytes ({data.hex(' ')}) to OTP from address {addr:#x}...")
+    message = uart.message if uart is not None else print
+    message(f"Programming {len(data)} bytes ({data.hex(' ')}) to OTP from address {addr:#x}...")
     if (len(data) // 4 + addr) > OTP_WORDS_COUNT:
         print("Data doesn't fit to OTP memory", file=sys.stderr)
         sys.exit(1)
@@ -100,19 +103,20 @@ def program(uart: Optional[UART], data: bytes, addr: int):
     if uart is None:
         return  # with --dry-run argument
 
-    response = uart.run(f"program {addr}")
-    if "Ready" not in response:
-        raise Exception(f"Flasher error: {response}")
+    with measure(uart, "program", len(data)):
+        response = uart.run(f"program {addr}")
+        if "Ready" not in response:
+            raise Exception(f"Flasher error: {response}")
 
-    size = len(data)
-    crc = binascii.crc_hqx(data, 0xFFFF)
-    uart.tty.write(size.to_bytes(2, "little"))
-    uart.tty.write(crc.to_bytes(2, "little"))
-    check_status_letter(uart, ["R"], "Size and CRC receive confirmation")
-    uart.tty.write(data)
-    check_status_letter(uart, ["R"], "Program confirmation")
-    uart.wait_for_string(uart.prompt)
-    print("Done")
+        size = len(data)
+        crc = binascii.crc_hqx(data, 0xFFFF)
+        uart.tty.write(size.to_bytes(2, "little"))
+        uart.tty.write(crc.to_bytes(2, "little"))
+        check_status_letter(uart, ["R"], "Size and CRC receive confirmation")
+        uart.tty.write(data)
+        check_status_letter(uart, ["R"], "Program confirmation")
+        uart.wait_for_string(uart.prompt)
+    message("Done")
 
 
 def get_bitfield_value(bitfield: BitField, record_value: int) -> int:
@@ -239,7 +243,8 @@ def read_otp(uart: Optional[UART], addr: int, count: int, flags: int):
         return OTP_Data(bytes(count * 4), addr)  # with --dry-run argument
 
     cells = []
-    response = uart.run(f"read {addr} {count} {flags}")
+    with measure(uart, "read", count * 4):
+        response = uart.run(f"read {addr} {count} {flags}")
     for line in response.split("\n"):
         if not line:
             continue
@@ -456,6 +461,14 @@ def cmd_program_toml(uart: Optional[UART], toml_file_obj: io.BufferedReader, fna
             cmd_program_record_bytes(uart, record_name, record_value)
 
 
+def run_bist(uart: UART, is_bisr: bool, addr: int, count: int) -> str:
+    """Run BIST (or BISR if `is_bisr` is True) for OTP region. Return response of flasher."""
+    cmd = "bisr" if is_bisr else "bist"
+    with measure(uart, cmd, count * 4):
+        result = uart.run(f"{cmd} {addr} {count}")
+    return result if result is not None else ""
+
+
 def cmd_bist(uart: Optional[UART], is_bisr: bool, addr: int, count: Optional[int]):
     if count is None:
         count = OTP_WORDS_COUNT - addr
@@ -468,8 +481,7 @@ def cmd_bist(uart: Optional[UART], is_bisr: bool, addr: int, count: Optional[int
         sys.exit(1)
 
     if uart is not None:
-        cmd = "bisr" if is_bisr else "bist"
-        result = uart.run(f"{cmd} {addr} {count}")
+        result = run_bist(uart, is_bisr, addr, count)
     else:
         result = "Ok"
 
@@ -755,6 +767,23 @@ def main() -> int:
     parser.add_argument(
         "-n", "--dry-run", action="store_true", help="Only print messages but do not access to OTP"
     )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="append JSON record with performance metrics of the operation to FILE",
+    )
+    parser.add_argument(
+        "--prom-file",
+        metavar="FILE",
+        help="update file FILE in Prometheus text format (node_exporter textfile collector) with "
+        + "counters and histograms of the operation",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record transmitted and received data of UART session with timestamps to FILE "
+        + "(can be replayed by --port replay://FILE)",
+    )
     parser.add_argument("--version", action="version", version=__version__)
 
     args = parser.parse_args()
@@ -797,6 +826,16 @@ def main() -> int:
         uart = None
     else:
         uart = UART(prompt="#", port=args.port, baudrate=115200, verbose=args.verbose)
+        if args.trace:
+            enable_trace(uart, args.trace)
+        uart.metrics = create_metrics(
+            args.metrics,
+            args.prom_file,
+            "mcom03-otp",
+            args.command,
+            port=args.port,
+            baudrate=115200,
+        )
         upload_flasher(uart, "otp-flasher-mips-ram.hex", "OTP Flasher", args.flasher)
 
     if args.command == "program-integer":
@@ -816,6 +855,8 @@ def main() -> int:
     else:
         raise Exception(f"Unknown command {args.command}")  # Unreachable error
 
+    if uart is not None and uart.metrics is not None:
+        uart.metrics.finish()
     return 0
 
 
@@ -0,0 +1,313 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import atexit
+import contextlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Optional
+
+try:
+    import fcntl
+except ModuleNotFoundError:  # not available on Windows
+    fcntl = None  # type: ignore
+
+# Upper bounds of buckets of phase duration histogram in seconds
+DURATION_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+# Suffixes of sample names of metric family by its type
+SAMPLE_SUFFIXES = {"counter": ["_total"], "histogram": ["_bucket", "_sum", "_count"], "gauge": [""]}
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Serialize read-modify-write of file `path` shared by concurrent instances of the tools
+    by lock of `path`.lock (not locked where fcntl is not available)"""
+    with open(path + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def summarize(samples: list[float]) -> dict:
+    """Return distribution of durations
+
+    >>> summarize([0.3, 0.1, 0.2, 0.4])
+    {'count': 4, 'min': 0.1, 'max': 0.4, 'mean': 0.25, 'p50': 0.3, 'p90': 0.4}
+    """
+    values = sorted(round(x, 6) for x in samples)
+    return {
+        "count": len(values),
+        "min": values[0],
+        "max": values[-1],
+        "mean": round(sum(values) / len(values), 6),
+        "p50": values[len(values) // 2],
+        "p90": values[min(len(values) - 1, len(values) * 9 // 10)],
+    }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    """
+    >>> _number(1792414035.0), _number(0.25)
+    ('1792414035', '0.25')
+    """
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(labels: dict) -> str:
+    """
+    >>> _labels({"port": "/dev/ttyUSB0", "le": 0.5})
+    '{port="/dev/ttyUSB0",le="0.5"}'
+    """
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class TextfileExporter:
+    """Exporter of metrics to Prometheus text file for node_exporter textfile collector.
+    Counters and histograms are accumulated over runs: existing file is parsed, updated and
+    replaced atomically. Order of samples is kept, so histogram buckets stay sorted. Concurrent
+    updates of the same file are serialized by lock file. Metric names are prefixed by name of
+    the tool (mcom03_flash, mcom03_otp, mcom03_eeprom), so the tools can share one file."""
+
+    HELP = {
+        "jobs": ("counter", "Operations by result"),
+        "bytes_written": ("counter", "Bytes written to flash"),
+        "bytes_read": ("counter", "Bytes read from flash"),
+        "crc_retries": ("counter", "Pages resent after CRC error reported by flasher"),
+        "verify_failures": ("counter", "Failed CRC verifications of written data"),
+        "read_stalls": ("counter", "Stalls of data stream of read"),
+        "reconnects": ("counter", "Reconnects of USB-UART adapter after disconnect"),
+        "baudrate_changes": ("counter", "Baudrate changes by error rate"),
+        "uart_errors": ("counter", "Received characters lost or damaged (counted by driver)"),
+        "phase_duration_seconds": ("histogram", "Duration of operation phases"),
+        "throughput_bytes_per_second": ("gauge", "Throughput of the last operation"),
+        "last_run_timestamp_seconds": ("gauge", "Time of the last operation"),
+    }
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> dict:
+        samples: dict = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    m = re.match(r"^(\w+)(\{.*\})? (\S+)$", line.strip())
+                    if m:
+                        samples[(m.group(1), m.group(2) or "")] = float(m.group(3))
+        except OSError:
+            pass
+        return samples
+
+    def _family(self, sample: str) -> Optional[tuple[str, str]]:
+        """Return prefix and name of metric family of sample (None for unknown sample)
+
+        >>> exporter = TextfileExporter("metrics.prom")
+        >>> exporter._family("mcom03_otp_jobs_total"), exporter._family("mcom03_flash_jobs")
+        (('mcom03_otp', 'jobs'), None)
+        >>> exporter._family("mcom03_flash_phase_duration_seconds_bucket")
+        ('mcom03_flash', 'phase_duration_seconds')
+        """
+        for name, (kind, _) in self.HELP.items():
+            for suffix in SAMPLE_SUFFIXES[kind]:
+                if sample.endswith(f"_{name}{suffix}"):
+                    return sample[: -len(f"_{name}{suffix}")], name
+        return None
+
+    def _save(self, samples: dict):
+        families: dict = {}
+        for key in samples:
+            prefix_name = self._family(key[0])
+            if prefix_name is not None:
+                families.setdefault(prefix_name, []).append(key)
+
+        lines = []
+        for prefix in sorted({x[0] for x in families}):
+            for name, (kind, text) in self.HELP.items():
+                keys = families.get((prefix, name))
+                if not keys:
+                    continue
+                # Name of counter family is the name of its sample (Prometheus text format)
+                family = f"{prefix}_{name}_total" if kind == "counter" else f"{prefix}_{name}"
+                lines.append(f"# HELP {family} {text}")
+                lines.append(f"# TYPE {family} {kind}")
+                lines += [f"{key[0]}{key[1]} {_number(samples[key])}" for key in keys]
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".prom-")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+
+    def _update(self, samples: dict, record: dict):
+        labels = {
+            "port": record.get("port", ""),
+            "flash_type": record.get("flash_type") or "",
+            "command": record.get("operation", ""),
+        }
+
+        prefix = record.get("tool", "mcom03-flash").replace("-", "_")
+
+        def inc(name: str, value: float = 1, **extra):
+            key = (f"{prefix}_{name}", _labels({**labels, **extra}))
+            samples[key] = samples.get(key, 0) + value
+
+        def set_value(name: str, value: float, **extra):
+            samples[(f"{prefix}_{name}", _labels({**labels, **extra}))] = value
+
+        inc("jobs_total", result=record.get("result", ""))
+        inc("bytes_written_total", record["bytes"].get("write", 0))
+        inc("bytes_read_total", record["bytes"].get("read", 0))
+        inc("crc_retries_total", record["counters"].get("retransmissions", 0))
+        inc("verify_failures_total", record["counters"].get("verify_failures", 0))
+        inc("read_stalls_total", record["counters"].get("read_stalls", 0))
+        inc("reconnects_total", record["counters"].get("reconnects", 0))
+        for direction in ["down", "up"]:
+            value = record["counters"].get(f"baudrate_{direction}", 0)
+            inc("baudrate_changes_total", value, direction=direction)
+        for kind in ["overrun", "buf_overrun", "frame", "parity"]:
+            inc("uart_errors_total", record["counters"].get(f"uart_{kind}", 0), kind=kind)
+        for phase, duration in record["phases"].items():
+            for bound in DURATION_BUCKETS:
+                inc("phase_duration_seconds_bucket", duration <= bound, phase=phase, le=bound)
+            inc("phase_duration_seconds_bucket", 1, phase=phase, le="+Inf")
+            inc("phase_duration_seconds_sum", duration, phase=phase)
+            inc("phase_duration_seconds_count", 1, phase=phase)
+        for phase, throughput in record["throughput"].items():
+            if throughput["effective"] is not None:
+                set_value("throughput_bytes_per_second", throughput["effective"], phase=phase)
+        set_value("last_run_timestamp_seconds", round(record["time"]))
+
+    def export(self, record: dict):
+        with file_lock(self.path):
+            samples = self._load()
+            self._update(samples, record)
+            self._save(samples)
+
+
+class Metrics:
+    """Collector of performance metrics. Every operation is saved as one JSON line appended to
+    `path` and exported to file `prom_path` in Prometheus text format (node_exporter textfile
+    collector) when the operation is finished.
+
+    Phases (upload, baudrate, select, detect, erase, write, verify, read, ...) are accumulated by
+    `measure()` in functions doing UART exchange, so they are collected for any command which uses
+    these functions. `info` is added to every record (port, baudrate, flash type, ...).
+    """
+
+    def __init__(self, path: Optional[str], tool: str, prom_path: Optional[str] = None, **info):
+        self.path = path
+        self.exporter = TextfileExporter(prom_path) if prom_path else None
+        self.info = dict(tool=tool, **info)
+        self.record: Optional[dict] = None
+
+    def start(self, operation: str, **info):
+        """Start new operation. Previous operation (if any) is finished successfully."""
+        if self.record is not None:
+            self.finish()
+        self.record = {"time": time.time(), "operation": operation, **info}
+        self.phases: dict[str, float] = {}
+        self.cpu: dict[str, float] = {}
+        self.sizes: dict[str, int] = {}
+        self.counters: dict[str, int] = {}
+        self.samples: dict[str, list[float]] = {}
+        self.commands: dict[str, list[float]] = {}
+        self._time_start = time.monotonic()
+        self._cpu_start = time.process_time()
+
+    def update(self, **info):
+        self.info.update(info)
+
+    def add(self, phase: str, duration: float, cpu: float = 0.0, size: int = 0):
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+        self.cpu[phase] = self.cpu.get(phase, 0.0) + cpu
+        if size:
+            self.sizes[phase] = self.sizes.get(phase, 0) + size
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def sample(self, name: str, value: float):
+        self.samples.setdefault(name, []).append(value)
+
+    def command(self, name: str, duration: float):
+        """Save round-trip time of flasher command"""
+        self.commands.setdefault(name, []).append(duration)
+
+    def finish(self, result: str = "ok"):
+        if self.record is None:
+            return
+
+        record = {**self.info, **self.record}
+        record["result"] = result
+        record["duration"] = round(time.monotonic() - self._time_start, 6)
+        record["cpu"] = round(time.process_time() - self._cpu_start, 6)
+        record["phases"] = {k: round(v, 6) for k, v in self.phases.items()}
+        record["phases_cpu"] = {k: round(v, 6) for k, v in self.cpu.items()}
+        record["bytes"] = self.sizes
+        line_rate = self.info.get("baudrate", 0) / 10
+        record["throughput"] = {
+            phase: {
+                "effective": round(size / self.phases[phase]) if self.phases[phase] else None,
+                "line_rate": line_rate if phase in ["write", "read"] else None,
+            }
+            for phase, size in self.sizes.items()
+        }
+        record["counters"] = self.counters
+        record["samples"] = {k: summarize(v) for k, v in self.samples.items()}
+        record["commands"] = {k: summarize(v) for k, v in self.commands.items()}
+        self.record = None
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.exporter is not None:
+            self.exporter.export(record)
+
+    def close(self):
+        """Save unfinished operation as failed (called at exit)"""
+        self.finish("error")
+
+
+@contextlib.contextmanager
+def measure(uart, phase: str, size: int = 0, sample: Optional[str] = None):
+    """Add duration and CPU time of the block to the `phase` of metrics attached to `uart`.
+    If `sample` is specified then duration is also saved to distribution of `sample`."""
+    metrics = uart.metrics if uart is not None else None
+    if metrics is None or metrics.record is None:
+        yield
+        return
+
+    time_start = time.monotonic()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - time_start
+        metrics.add(phase, duration, time.process_time() - cpu_start, size)
+        if sample is not None:
+            metrics.sample(sample, duration)
+
+
+def count(uart, name: str, value: int = 1):
+    if uart is not None and uart.metrics is not None and uart.metrics.record is not None:
+        uart.metrics.count(name, value)
+
+
+def create_metrics(
+    path: Optional[str], prom_path: Optional[str], tool: str, operation: str, **info
+) -> Optional[Metrics]:
+    """Return metrics collector started for `operation` if any output file is specified.
+    Unfinished operation is saved as failed at exit."""
+    if not path and not prom_path:
+        return None
+
+    metrics = Metrics(path, tool, prom_path, **info)
+    metrics.start(operation)
+    atexit.register(metrics.close)
+    return metrics
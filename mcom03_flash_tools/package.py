@@ -0,0 +1,221 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import io
+import tarfile
+import tempfile
+import threading
+from collections.abc import Iterable
+from typing import Optional
+
+CHUNK_SIZE = 1024 * 1024
+# Decompression runs ahead of readers of a member by at most this number of bytes
+READ_AHEAD = 8 * CHUNK_SIZE
+
+
+def read_member(path: str, name: str) -> Optional[bytes]:
+    """Return data of small member of tar package (optionally compressed) or None if there is
+    no such member. The package is decompressed only till the member."""
+    with tarfile.open(path, "r|*") as tar:
+        for tarinfo in tar:
+            if tarinfo.isfile() and tarinfo.name == name:
+                f = tar.extractfile(tarinfo)
+                return f.read() if f is not None else b""
+    return None
+
+
+class _SpooledMember:
+    """Data of tar member which is being extracted by background thread. Extracted data is kept
+    in temporary file, because the member is read several times (digest check, write, verify)."""
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.file = tempfile.TemporaryFile()
+        self.available = 0
+        self.requested = 0
+        self.done = False
+        self.error: Optional[Exception] = None
+
+
+class MemberReader(io.RawIOBase):
+    """Seekable reader of tar member. Read blocks only if requested data is not extracted yet."""
+
+    def __init__(self, package: "PackageReader", member: _SpooledMember):
+        self._package = package
+        self._member = member
+        self._pos = 0
+        self.name = member.name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self._package._readinto(self._member, self._pos, b)
+        self._pos += n
+        return n
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._member.size
+        self._pos = max(pos, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+class PackageReader:
+    """Reader of tar package (optionally compressed). Members are decompressed in one sequential
+    pass by background thread, so reading of a member does not seek in compressed stream and
+    sending data to UART does not wait for decompression of already extracted data. The pass is
+    started on first request of a member. Only members from `names` (all if None) are extracted,
+    the pass is stopped when all of them are extracted. `names` can be set by select() during the
+    pass, e.g. after reading of package description from the same pass. Decompression is paused
+    when it is READ_AHEAD bytes ahead of readers of current member, unless a reader waits for
+    other data."""
+
+    def __init__(self, path: str, names: Optional[Iterable[str]] = None):
+        self.path = path
+        self._names = set(names) if names is not None else None
+        self._members: dict[str, _SpooledMember] = {}
+        self._done = False
+        self._stop = False
+        self._waiting = 0
+        self._error: Optional[Exception] = None
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop extraction and remove extracted data"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        for member in self._members.values():
+            member.file.close()
+
+    def select(self, names: Iterable[str]):
+        """Extract only members from `names`. Data of other already extracted members is
+        removed."""
+        with self._cond:
+            self._names = set(names)
+            for name in [x for x in self._members if x not in self._names]:
+                member = self._members.pop(name)
+                if member.done:
+                    member.file.close()
+            self._cond.notify_all()
+
+    def _wanted(self, name: str) -> bool:
+        return self._names is None or name in self._names
+
+    def _append(self, member: _SpooledMember, data: bytes) -> bool:
+        """Append data to member, wait for readers if decompression is too far ahead. Return
+        False if extraction is stopped or the member is not selected anymore."""
+        with self._cond:
+            while (
+                not self._stop
+                and self._wanted(member.name)
+                and self._waiting == 0
+                and member.available - member.requested >= READ_AHEAD
+            ):
+                self._cond.wait()
+            if self._stop or not self._wanted(member.name):
+                return False
+            member.file.seek(member.available)
+            member.file.write(data)
+            member.available += len(data)
+            self._cond.notify_all()
+        return True
+
+    def _finish(self, member: _SpooledMember, error: Optional[Exception] = None):
+        with self._cond:
+            member.done = True
+            member.error = error
+            if self._members.get(member.name) is not member:
+                # The member is dropped by select()
+                member.file.close()
+            self._cond.notify_all()
+
+    def _extract(self):
+        member = None
+        try:
+            with tarfile.open(self.path, "r|*") as tar:
+                for tarinfo in tar:
+                    with self._cond:
+                        if self._stop:
+                            break
+                        if self._names is not None and self._names <= self._members.keys():
+                            break
+                        if not tarinfo.isfile() or not self._wanted(tarinfo.name):
+                            continue
+                        if tarinfo.name in self._members:
+                            continue
+                        member = _SpooledMember(tarinfo.name, tarinfo.size)
+                        self._members[tarinfo.name] = member
+                        self._cond.notify_all()
+                    f = tar.extractfile(tarinfo)
+                    if f is not None:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):  # noqa: B023
+                            if not self._append(member, chunk):
+                                break
+                    if self._stop:
+                        break
+                    self._finish(member)
+                    member = None
+        except Exception as e:
+            self._error = e
+        finally:
+            if member is not None:
+                self._finish(member, self._error or Exception("Package reader is closed"))
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _readinto(self, member: _SpooledMember, pos: int, b) -> int:
+        with self._cond:
+            member.requested = max(member.requested, pos + len(b))
+            self._cond.notify_all()
+            self._waiting += 1
+            try:
+                while member.available <= pos and not member.done:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            if member.error is not None:
+                raise member.error
+            length = min(len(b), member.available - pos)
+            if length <= 0:
+                return 0
+            member.file.seek(pos)
+            return member.file.readinto(memoryview(b)[:length])
+
+    def get(self, name: str) -> tuple[int, Optional[MemberReader]]:
+        """Return size and reader of member. Return (0, None) if there is no such member or it
+        is not in `names`."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._extract, daemon=True)
+                self._thread.start()
+            self._waiting += 1
+            while name not in self._members and not self._done:
+                self._cond.wait()
+            self._waiting -= 1
+            member = self._members.get(name)
+        if member is None:
+            if self._error is not None:
+                raise self._error
+            return 0, None
+
+        return member.size, MemberReader(self, member)
@@ -0,0 +1,164 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import binascii
+import io
+from collections import namedtuple
+from typing import Optional
+
+from mcom03_flash_tools.calibration import Estimate, Timings
+from mcom03_flash_tools.state_cache import sector_runs
+
+# Flash range [start, end) filled by data of package member `name` starting from `pos`
+Extent = namedtuple("Extent", "start end name pos")
+
+
+def _readinto_full(f_obj, b) -> int:
+    view = memoryview(b)
+    size = 0
+    while size < len(view):
+        n = f_obj.readinto(view[size:])
+        if not n:
+            break
+        size += n
+    return size
+
+
+class FlashPlan:
+    """Flash layout after applying package profile actions. Every action erases sectors it
+    touches, so the layout is described by set of erased sectors and data extents written after
+    erase. Data overwritten or erased by later actions is dropped.
+
+    >>> plan = FlashPlan(4)
+    >>> plan.flash(0, 6, "a")
+    >>> plan.flash(8, 3, "b")
+    >>> plan.erase(4, 1)
+    >>> plan.extents
+    [Extent(start=0, end=4, name='a', pos=0), Extent(start=8, end=11, name='b', pos=0)]
+    >>> sector_runs(plan.sectors)
+    [(0, 3)]
+    >>> plan.flash(4, 4, "c")
+    >>> [[x.name for x in session] for session in plan.write_sessions()]
+    [['a', 'c', 'b']]
+    """
+
+    def __init__(self, sector: int):
+        self.sector = sector
+        self.sectors: set[int] = set()
+        self.extents: list[Extent] = []
+
+    def _cut(self, start: int, end: int):
+        extents = []
+        for x in self.extents:
+            if x.end <= start or x.start >= end:
+                extents.append(x)
+                continue
+            if x.start < start:
+                extents.append(Extent(x.start, start, x.name, x.pos))
+            if x.end > end:
+                extents.append(Extent(end, x.end, x.name, x.pos + end - x.start))
+        self.extents = extents
+
+    def erase(self, offset: int, size: int):
+        if size <= 0:
+            return
+        first_sector = offset // self.sector
+        last_sector = (offset + size - 1) // self.sector
+        self.sectors.update(range(first_sector, last_sector + 1))
+        self._cut(first_sector * self.sector, (last_sector + 1) * self.sector)
+
+    def write(self, offset: int, size: int, name: str, pos: int = 0):
+        """Add data written to already erased range"""
+        if size <= 0:
+            return
+        self._cut(offset, offset + size)
+        self.extents.append(Extent(offset, offset + size, name, pos))
+        self.extents.sort()
+
+    def flash(self, offset: int, size: int, name: str):
+        self.erase(offset, size)
+        self.write(offset, size, name)
+
+    def keep_sectors(self, sectors: set[int]):
+        """Exclude sectors which already contain expected data from erase and write"""
+        self.sectors -= sectors
+        for run_start, run_count in sector_runs(list(sectors)):
+            self._cut(run_start * self.sector, (run_start + run_count) * self.sector)
+
+    def write_sessions(self) -> list[list[Extent]]:
+        """Return extents grouped to contiguous ranges which are written by one write command"""
+        sessions: list[list[Extent]] = []
+        for x in self.extents:
+            if sessions and sessions[-1][-1].end == x.start:
+                sessions[-1].append(x)
+            else:
+                sessions.append([x])
+        return sessions
+
+    def content(self, start: int, end: int, files: dict) -> bytearray:
+        """Return expected flash data of range [start, end). `files` maps member names to
+        seekable file objects."""
+        data = bytearray(b"\xff" * (end - start))
+        view = memoryview(data)
+        for x in self.extents:
+            if x.end <= start or x.start >= end:
+                continue
+            range_start = max(x.start, start)
+            range_end = min(x.end, end)
+            f_obj = files[x.name]
+            f_obj.seek(x.pos + range_start - x.start)
+            _readinto_full(f_obj, view[range_start - start : range_end - start])
+        return data
+
+    def crcs(self, files: dict) -> tuple[dict[int, int], list[int]]:
+        """Return expected CRC16 of every erased sector and of every contiguous run of erased
+        sectors (in order of `sector_runs`)"""
+        sector_crcs = {}
+        run_crcs = []
+        for run_start, run_count in sector_runs(list(self.sectors)):
+            crc = 0xFFFF
+            for i in range(run_start, run_start + run_count):
+                data = self.content(i * self.sector, (i + 1) * self.sector, files)
+                sector_crcs[i] = binascii.crc_hqx(data, 0xFFFF)
+                crc = binascii.crc_hqx(data, crc)
+            run_crcs.append(crc)
+        return sector_crcs, run_crcs
+
+    def estimate(self, timings: Timings, page: int, verify_size: Optional[int] = None) -> Estimate:
+        """Return predicted duration of plan execution
+
+        >>> from mcom03_flash_tools.calibration import default_timings
+        >>> plan = FlashPlan(65536)
+        >>> plan.flash(0, 115200, "a")
+        >>> round(plan.estimate(default_timings(115200), 256).total, 1)
+        11.2
+        """
+        if verify_size is None:
+            verify_size = len(self.sectors) * self.sector
+        estimate = Estimate(timings, page)
+        estimate.erase(len(self.sectors))
+        estimate.write(sum(x.end - x.start for x in self.extents))
+        estimate.verify(verify_size)
+        return estimate
+
+
+class PlanReader(io.RawIOBase):
+    """Reader of data of one write session: extents of several members are read as one
+    contiguous stream"""
+
+    def __init__(self, plan: FlashPlan, session: list[Extent], files: dict):
+        self._plan = plan
+        self._files = files
+        self._start = session[0].start
+        self._end = session[-1].end
+        self._pos = self._start
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        size = min(len(b), self._end - self._pos)
+        if size <= 0:
+            return 0
+        b[:size] = self._plan.content(self._pos, self._pos + size, self._files)
+        self._pos += size
+        return size
@@ -0,0 +1,192 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import atexit
+import sys
+import time
+from typing import Optional
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+HISTOGRAM_WIDTH = 40
+
+
+def bucket_index(latency: float) -> int:
+    """
+    >>> bucket_index(0.0001), bucket_index(0.001), bucket_index(0.0011), bucket_index(10)
+    (0, 1, 2, 13)
+    """
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+
+def format_latency(seconds: float) -> str:
+    """
+    >>> format_latency(0.0005), format_latency(0.02), format_latency(2)
+    ('0.5 ms', '20 ms', '2 s')
+    """
+    return f"{seconds * 1000:.3g} ms" if seconds < 1 else f"{seconds:.3g} s"
+
+
+class _Operation:
+    def __init__(self, name: str, start: float):
+        self.name = name
+        self.start = start
+        self.sent = start
+        self.send = 0.0
+        self.io = 0.0
+        self.first_byte: Optional[float] = None
+
+
+class CommandStats:
+    """Accumulated latencies of one command type"""
+
+    def __init__(self):
+        self.count = 0
+        self.send = 0.0
+        self.first_byte = 0.0
+        self.completion = 0.0
+        self.host = 0.0
+        self.latencies: list[float] = []
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, send: float, first_byte: float, completion: float, host: float):
+        self.count += 1
+        self.send += send
+        self.first_byte += first_byte
+        self.completion += completion
+        self.host += host
+        self.latencies.append(completion)
+        self.histogram[bucket_index(completion)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Profiler:
+    """Profiler of UART exchange. Operation is a command sent by UART.run() or a data frame
+    written directly to serial port (named "<last command>:data", e.g. "write:data"). For every
+    operation it records time spent in sending, latency of the first received byte, completion
+    latency and time spent by host code (completion excluding time blocked in serial port)."""
+
+    def __init__(self):
+        self.time_start = time.perf_counter()
+        self.stats: dict[str, CommandStats] = {}
+        self.label = "(none)"
+        self.current: Optional[_Operation] = None
+
+    def start(self, name: str):
+        """Start operation of command `name` (called before command is sent)"""
+        self.finish()
+        self.label = name
+        self.current = _Operation(name, time.perf_counter())
+
+    def finish(self):
+        """Finish current operation (called when expected response is received)"""
+        op = self.current
+        if op is None:
+            return
+
+        self.current = None
+        completion = time.perf_counter() - op.start
+        first_byte = op.first_byte if op.first_byte is not None else completion - op.send
+        host = max(completion - op.send - op.io, 0.0)
+        stats = self.stats.setdefault(op.name, CommandStats())
+        stats.add(op.send, first_byte, completion, host)
+
+    def on_write(self, start: float, end: float):
+        if self.current is None:
+            self.current = _Operation(f"{self.label}:data", start)
+        self.current.send += end - start
+        self.current.sent = end
+
+    def on_read(self, start: float, end: float, size: int):
+        op = self.current
+        if op is None:
+            return
+        op.io += end - start
+        if size and op.first_byte is None:
+            op.first_byte = end - op.sent
+
+    def report(self, file=None):
+        """Print breakdown of wall-clock time and latency histograms (to stderr by default, so
+        the report is not mixed with data read to stdout)"""
+        file = file or sys.stderr
+        wall = time.perf_counter() - self.time_start
+        in_commands = sum(x.completion for x in self.stats.values())
+        print("UART profile:", file=file)
+        print(
+            f"  wall-clock {wall:.3f} s: UART operations {in_commands:.3f} s, "
+            + f"host outside of operations {wall - in_commands:.3f} s",
+            file=file,
+        )
+        header = (
+            f"  {'command':14} {'count':>7} {'total s':>9} {'send s':>8} {'1st byte s':>10} "
+            + f"{'device s':>9} {'host s':>8} {'p50':>9} {'p90':>9} {'max':>9}"
+        )
+        print(header, file=file)
+        for name, x in sorted(self.stats.items(), key=lambda item: -item[1].completion):
+            device = max(x.completion - x.send - x.host, 0.0)
+            print(
+                f"  {name:14} {x.count:7} {x.completion:9.3f} {x.send:8.3f} {x.first_byte:10.3f} "
+                + f"{device:9.3f} {x.host:8.3f} {format_latency(x.percentile(0.5)):>9} "
+                + f"{format_latency(x.percentile(0.9)):>9} {format_latency(max(x.latencies)):>9}",
+                file=file,
+            )
+
+        for name, x in sorted(self.stats.items()):
+            print(f"  {name} latency histogram:", file=file)
+            peak = max(x.histogram)
+            for i, counter in enumerate(x.histogram):
+                if not counter:
+                    continue
+                if i < len(LATENCY_BUCKETS):
+                    bound = "<= " + format_latency(LATENCY_BUCKETS[i])
+                else:
+                    bound = "> " + format_latency(LATENCY_BUCKETS[-1])
+                bar = "#" * max(1, counter * HISTOGRAM_WIDTH // peak)
+                print(f"    {bound:>10} {counter:7} {bar}", file=file)
+
+
+class ProfiledSerial:
+    """Proxy of serial port which reports time spent in write() and read() to profiler"""
+
+    def __init__(self, tty, profiler: Profiler):
+        object.__setattr__(self, "_tty", tty)
+        object.__setattr__(self, "_profiler", profiler)
+
+    def __getattr__(self, name):
+        return getattr(self._tty, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._tty, name, value)
+
+    def write(self, data):
+        start = time.perf_counter()
+        result = self._tty.write(data)
+        self._profiler.on_write(start, time.perf_counter())
+        return result
+
+    def read(self, size=1):
+        start = time.perf_counter()
+        data = self._tty.read(size)
+        self._profiler.on_read(start, time.perf_counter(), len(data))
+        return data
+
+    def readinto(self, b):
+        start = time.perf_counter()
+        size = self._tty.readinto(b)
+        self._profiler.on_read(start, time.perf_counter(), size or 0)
+        return size
+
+
+def enable_profiling(uart) -> Profiler:
+    """Attach profiler to UART and print its report at exit. Serial port of UART is replaced by
+    proxy."""
+    profiler = Profiler()
+    uart.tty = ProfiledSerial(uart.tty, profiler)
+    uart.profiler = profiler
+    atexit.register(profiler.report)
+    return profiler
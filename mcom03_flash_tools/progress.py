@@ -0,0 +1,249 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import sys
+import threading
+import time
+from collections.abc import Callable
+from typing import Optional
+
+# Minimal interval between redraws of progress bars in seconds
+RENDER_INTERVAL = 0.1
+BAR_WIDTH = 20
+# Rate is averaged over this period in seconds
+RATE_WINDOW = 3.0
+
+
+def format_bar(percentage: float, width: int = BAR_WIDTH) -> str:
+    """Return bar of `width` symbols filled to `percentage` with 1/8 symbol precision
+
+    >>> format_bar(50, 4), format_bar(100, 4), format_bar(0, 4)
+    ('██  ', '████', '    ')
+    """
+    symbols = [""] + [chr(0x258F - x) for x in range(7)]
+    count = min(width * percentage / 100, width)
+    count_full = int(count)
+    bar = chr(0x2588) * count_full
+    bar += symbols[int((count - count_full) * 8)]
+    return bar + " " * (width - len(bar))
+
+
+def format_rate(rate: float) -> str:
+    """
+    >>> format_rate(512), format_rate(90 * 1024), format_rate(3.5 * 1024 * 1024)
+    ('512 B/s', '90.0 KiB/s', '3.50 MiB/s')
+    """
+    if rate >= 1024 * 1024:
+        return f"{rate / 1024 / 1024:.2f} MiB/s"
+    if rate >= 1024:
+        return f"{rate / 1024:.1f} KiB/s"
+    return f"{rate:.0f} B/s"
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    """
+    >>> format_eta(75), format_eta(3725), format_eta(None)
+    ('1:15', '1:02:05', '--:--')
+    """
+    if seconds is None:
+        return "--:--"
+    minutes, sec = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{sec:02}" if hours else f"{minutes}:{sec:02}"
+
+
+class Progress:
+    """State of one progress bar. `total` is None for data of unknown size. update() and
+    advance() only save the state, redraws are done by reporter not more often than its
+    interval."""
+
+    def __init__(self, reporter: "ProgressReporter", label: str, total: Optional[int]):
+        self.reporter = reporter
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.time_start = time.monotonic()
+        self._samples = [(self.time_start, 0)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, done: int):
+        self.done = done
+        self.reporter.changed()
+
+    def advance(self, count: int):
+        self.update(self.done + count)
+
+    def close(self):
+        self.reporter.remove(self)
+
+    @property
+    def percentage(self) -> Optional[float]:
+        if not self.total:
+            return None
+        return self.done / self.total * 100
+
+    def _sample(self):
+        now = time.monotonic()
+        self._samples.append((now, self.done))
+        while len(self._samples) > 2 and now - self._samples[1][0] > RATE_WINDOW:
+            self._samples.pop(0)
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second over the last RATE_WINDOW seconds (till the last redraw)"""
+        (time_first, done_first), (time_last, done_last) = self._samples[0], self._samples[-1]
+        return (
+            (done_last - done_first) / (time_last - time_first) if time_last > time_first else 0.0
+        )
+
+    @property
+    def eta(self) -> Optional[float]:
+        rate = self.rate
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def format(self) -> str:
+        self._sample()
+        rate = format_rate(self.rate)
+        label = f"{self.label:8} " if self.label else ""
+        if self.total is None:
+            return f"{label}{self.done / 1024:10.2f} KiB {rate:>11}"
+        percentage = self.percentage or 0.0
+        return (
+            f"{label}[{format_bar(percentage)}] {percentage:5.1f}% {rate:>11} "
+            + f"ETA {format_eta(self.eta)}"
+        )
+
+
+class TerminalSink:
+    """Sink drawing progress bars on terminal. One bar is redrawn in place by carriage return,
+    several bars are drawn on separate lines with cursor movement."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lines = 0
+
+    def __call__(self, bars: list):
+        # Move to the first line of previous drawing
+        out = f"\x1b[{self.lines - 1}F" if self.lines > 1 else "\r"
+        lines = [bar.format() for bar in bars]
+        drawn = max(len(lines), self.lines)
+        lines += [""] * (drawn - len(lines))
+        out += "\n".join(line + "\x1b[K" for line in lines)
+        # Return from cleared lines to the last bar (or to the first line if there are no bars)
+        extra = drawn - max(len(bars), 1)
+        if extra > 0:
+            out += f"\x1b[{extra}F"
+        if not bars:
+            out += "\r"
+        self.lines = len(bars)
+        self.stream.write(out)
+        self.stream.flush()
+
+
+class ProgressReporter:
+    """Reporter of progress bars. `sink` is called with list of active bars on every redraw and
+    with empty list when all bars are closed (TerminalSink by default). Redraws are done not more
+    often than `interval` seconds: by render thread if `thread` is True, otherwise on demand in
+    update() of bars."""
+
+    def __init__(
+        self,
+        sink: Optional[Callable[[list], None]] = None,
+        interval: float = RENDER_INTERVAL,
+        thread: bool = False,
+    ):
+        self.sink = sink if sink is not None else TerminalSink()
+        self.interval = interval
+        self.bars: list[Progress] = []
+        self.next_render = 0.0
+        self.lock = threading.RLock()
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        if thread:
+            self.thread = threading.Thread(target=self._render_loop, daemon=True)
+            self.thread.start()
+
+    def bar(self, label: str = "", total: Optional[int] = None) -> Progress:
+        progress = Progress(self, label, total)
+        with self.lock:
+            self.bars.append(progress)
+        self.render()
+        return progress
+
+    def changed(self):
+        if self.thread is None and time.monotonic() >= self.next_render:
+            self.render()
+
+    def render(self):
+        with self.lock:
+            self.next_render = time.monotonic() + self.interval
+            self.sink(list(self.bars))
+
+    def remove(self, progress: Progress):
+        with self.lock:
+            if progress not in self.bars:
+                return
+            self.bars.remove(progress)
+            self.render()
+
+    def _render_loop(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                if self.bars:
+                    self.render()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            self.bars.clear()
+            self.render()
+
+
+class _HiddenProgress:
+    """Progress bar which is not shown"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def update(self, done: int):
+        pass
+
+    def advance(self, count: int):
+        pass
+
+    def close(self):
+        pass
+
+
+# Reporter set by set_reporter() and terminal reporter (created on the first use)
+_reporters: dict[str, Optional[ProgressReporter]] = {"custom": None, "terminal": None}
+
+
+def set_reporter(reporter: Optional[ProgressReporter]):
+    """Set reporter for progress bars of all operations (e.g. with callback sink for library
+    usage). Bars are passed to this reporter even if progress bar is hidden in the tools."""
+    _reporters["custom"] = reporter
+
+
+def progress_bar(label: str, total: Optional[int], hidden: bool = False):
+    """Return progress bar of reporter set by set_reporter() or of terminal reporter (if
+    `hidden` is False)"""
+    reporter = _reporters["custom"]
+    if reporter is None:
+        if hidden:
+            return _HiddenProgress()
+        reporter = _reporters["terminal"]
+        if reporter is None:
+            reporter = _reporters["terminal"] = ProgressReporter()
+    return reporter.bar(label, total)
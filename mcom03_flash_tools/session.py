@@ -0,0 +1,331 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import binascii
+import io
+import time
+from collections import namedtuple
+from collections.abc import Callable
+from typing import Optional
+
+from mcom03_flash_tools import (
+    UART,
+    FlashType,
+    get_flash_protector,
+    get_flash_type,
+    read_crc,
+    read_into,
+    upload_flasher,
+)
+from mcom03_flash_tools.mcom03_flash import change_baudrate, erase_sector, flash, select_qspi
+from mcom03_flash_tools.mcom03_otp import OTP_WORDS_COUNT, program, read_otp, run_bist
+from mcom03_flash_tools.metrics import measure
+
+# Result of session operation. `phases` maps phase names (erase, write, verify, ...) to durations
+# in seconds, `data` is read data (for read operations only).
+OperationResult = namedtuple(
+    "OperationResult", "operation offset size duration phases data", defaults=[None]
+)
+
+Progress = Optional[Callable[[int, int], None]]
+
+
+def _discard(text: str):
+    pass
+
+
+class _Session:
+    """Common part of sessions: UART connection and flasher upload. Status messages of
+    operations (flasher upload, reconnect, ...) are passed to `on_message` callback, they are
+    not printed. UART passed by caller is not closed by the session."""
+
+    flasher_name = ""
+    flasher_msg = ""
+
+    def __init__(
+        self,
+        port: str = "/dev/ttyUSB0",
+        flasher: Optional[str] = None,
+        verbose: bool = False,
+        uart: Optional[UART] = None,
+        on_message: Optional[Callable[[str], None]] = None,
+    ):
+        self.port = port
+        self.flasher = flasher
+        self.verbose = verbose
+        self.on_message = on_message
+        self.uart: Optional[UART] = None
+        self.upload_time = 0.0
+        self._caller_uart = uart
+        self._caller_on_message: Optional[Callable[[str], None]] = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        """Connect to the board and upload flasher (if it is not executing already)"""
+        if self.uart is None:
+            if self._caller_uart is not None:
+                self.uart = self._caller_uart
+                self._caller_on_message = self.uart.on_message
+            else:
+                self.uart = UART(prompt="#", port=self.port, baudrate=115200, verbose=self.verbose)
+            self.uart.on_message = self.on_message or _discard
+        time_start = time.monotonic()
+        upload_flasher(self.uart, self.flasher_name, self.flasher_msg, self.flasher)
+        self.upload_time = time.monotonic() - time_start
+
+    def close(self):
+        if self.uart is None:
+            return
+        if self.uart is self._caller_uart:
+            self.uart.on_message = self._caller_on_message
+        else:
+            self.uart.tty.close()
+        self.uart = None
+
+    def _uart(self) -> UART:
+        if self.uart is None:
+            raise RuntimeError("Session is not opened")
+        return self.uart
+
+
+class FlasherSession(_Session):
+    """Session of QSPI flasher. The flasher is uploaded and baudrate is changed once, then any
+    count of operations can be done. Errors are reported by exceptions: ValueError for wrong
+    arguments, Exception for flasher errors. Methods return OperationResult with durations of
+    operation phases. Example::
+
+        with FlasherSession("/dev/ttyUSB0", baudrate=921600) as session:
+            session.select("qspi0")
+            session.flash(0, data)
+            dump = session.read(0, len(data)).data
+    """
+
+    flasher_name = "spi-flasher-mips-ram.hex"
+    flasher_msg = "QSPI Flasher"
+
+    def __init__(
+        self,
+        port: str = "/dev/ttyUSB0",
+        baudrate: int = 115200,
+        flasher: Optional[str] = None,
+        verbose: bool = False,
+        uart: Optional[UART] = None,
+        on_message: Optional[Callable[[str], None]] = None,
+    ):
+        super().__init__(port, flasher, verbose, uart, on_message)
+        self.baudrate = baudrate
+        self.qspi: Optional[str] = None
+        self.voltage18 = False
+        self._flash_type: Optional[FlashType] = None
+
+    def open(self):
+        super().open()
+        if self.baudrate != 115200:
+            change_baudrate(self._uart(), self.baudrate)
+
+    def close(self):
+        try:
+            if self.uart is not None and self.baudrate != 115200:
+                change_baudrate(self.uart, 115200)
+        finally:
+            super().close()
+
+    @property
+    def flash_type(self) -> FlashType:
+        if self._flash_type is None:
+            raise RuntimeError("QSPI controller is not selected")
+        return self._flash_type
+
+    def select(
+        self,
+        qspi: str,
+        voltage18: bool = False,
+        flash_size: Optional[int] = None,
+        flash_sector: Optional[int] = None,
+        flash_page: Optional[int] = None,
+    ) -> FlashType:
+        """Select QSPI controller and detect flash type. Flash parameters can be redefined."""
+        if qspi not in ["qspi0", "qspi1"]:
+            raise ValueError(f"Unsupported QSPI controller '{qspi}'")
+        if qspi == "qspi0" and voltage18:
+            raise ValueError("Unsupported QSPI0 settings: voltage18 is forbidden")
+
+        uart = self._uart()
+        select_qspi(uart, qspi, voltage18)
+        flash_type = get_flash_type(uart, flash_size, flash_sector, flash_page)
+        if flash_type.name is None:
+            ids = ", ".join([hex(x) for x in flash_type.id_bytes])
+            raise ValueError(f"Unknown SPI flash on {qspi.upper()} (ID: {ids})")
+
+        self.qspi = qspi
+        self.voltage18 = voltage18
+        self._flash_type = flash_type
+        return flash_type
+
+    def _check_range(self, offset: int, size: int) -> int:
+        if offset < 0:
+            offset = self.flash_type.size + offset
+        if offset < 0 or size < 0 or offset + size > self.flash_type.size:
+            raise ValueError(f"Range {offset:#x}+{size:#x} is out of flash memory")
+        return offset
+
+    def erase(self, offset: int, size: int, progress: Progress = None) -> OperationResult:
+        """Erase sectors of range. `offset` must be aligned to sector size."""
+        offset = self._check_range(offset, size)
+        sector = self.flash_type.sector
+        if offset & (sector - 1):
+            raise ValueError(f"Offset must be aligned with erase sector size ({sector})")
+
+        uart = self._uart()
+        count = (size + sector - 1) // sector
+        time_start = time.monotonic()
+        for i in range(count):
+            erase_sector(uart, offset + i * sector)
+            if progress is not None:
+                progress((i + 1) * sector, count * sector)
+        duration = time.monotonic() - time_start
+        return OperationResult("erase", offset, count * sector, duration, {"erase": duration})
+
+    def verify(self, offset: int, data: bytes) -> OperationResult:
+        """Compare CRC of flash region with CRC of `data`. Raise Exception on mismatch."""
+        offset = self._check_range(offset, len(data))
+        time_start = time.monotonic()
+        crc = binascii.crc_hqx(data, 0xFFFF)
+        uart = self._uart()
+        with measure(uart, "verify", len(data)):
+            actual_crc = read_crc(uart, offset, len(data))
+        if actual_crc != crc:
+            raise Exception(f"Verification failed. Expected CRC {crc:#x}, but read {actual_crc:#x}")
+        duration = time.monotonic() - time_start
+        return OperationResult("verify", offset, len(data), duration, {"verify": duration})
+
+    def flash(
+        self, offset: int, data: bytes, progress: Progress = None, check: bool = True
+    ) -> OperationResult:
+        """Erase sectors covering the range, write `data` and verify it (if `check` is True)"""
+        offset = self._check_range(offset, len(data))
+        time_start = time.monotonic()
+        phases = dict(self.erase(offset, len(data)).phases)
+        write_start = time.monotonic()
+        if data:
+            uart = self._uart()
+            page = self.flash_type.page
+            flash(uart, offset, io.BytesIO(data), len(data), True, page, progress=progress)
+        phases["write"] = time.monotonic() - write_start
+        if check:
+            phases["verify"] = self.verify(offset, data).duration
+        duration = time.monotonic() - time_start
+        return OperationResult("flash", offset, len(data), duration, phases)
+
+    def read(self, offset: int, size: int, progress: Progress = None) -> OperationResult:
+        """Read flash region. Data is returned in `data` field of the result."""
+        offset = self._check_range(offset, size)
+        buf = bytearray(size)
+        time_start = time.monotonic()
+        if size:
+            read_into(self._uart(), offset, buf, True, progress)
+        duration = time.monotonic() - time_start
+        return OperationResult("read", offset, size, duration, {"read": duration}, bytes(buf))
+
+    def is_protected(self) -> bool:
+        return get_flash_protector(self.flash_type, self._uart()).is_protected
+
+    def protect(self, enable: bool = True) -> OperationResult:
+        """Enable (or disable if `enable` is False) write/erase protection of flash"""
+        time_start = time.monotonic()
+        protector = get_flash_protector(self.flash_type, self._uart())
+        if enable and not protector.is_protected:
+            protector.protect()
+        elif not enable and protector.is_protected:
+            protector.unprotect()
+        duration = time.monotonic() - time_start
+        operation = "protect" if enable else "unprotect"
+        return OperationResult(operation, 0, 0, duration, {operation: duration})
+
+    def unprotect(self) -> OperationResult:
+        return self.protect(False)
+
+    def eeprom_read(
+        self,
+        addr: int = 0x57,
+        regaddr: int = 0,
+        length: int = 2,
+        datasize: int = 0,
+        bus: int = 0,
+        speed: int = 0,
+        mode: str = "text",
+    ) -> str:
+        """Read data from I2C EEPROM. Return response of flasher."""
+        uart = self._uart()
+        uart.run(f"i2c_dev {bus} {speed}")
+        with measure(uart, "read", datasize):
+            response = uart.run(f"i2c_read {addr} {regaddr} {length} {datasize} {mode}")
+        if response is None:
+            raise Exception("No response to i2c_read command")
+        return response
+
+    def eeprom_write(
+        self,
+        data: str,
+        addr: int = 0x57,
+        regaddr: int = 0,
+        length: int = 2,
+        bus: int = 0,
+        speed: int = 0,
+    ):
+        """Write ASCII string (with terminating zero byte) to I2C EEPROM"""
+        if not data.isascii():
+            raise ValueError("String must contain ASCII symbols only")
+
+        uart = self._uart()
+        uart.run(f"i2c_dev {bus} {speed}")
+        with measure(uart, "write", len(data) + 1):
+            uart.run(f"i2c_write {addr} {regaddr} {length} {len(data) + 1}")
+            uart.tty.write((data + "\0").encode())
+            success, response = uart.wait_for_string("Done\n")
+        if not success:
+            raise Exception(f"Wrong response while writing: {response}")
+
+
+class OTPSession(_Session):
+    """Session of OTP flasher. Example::
+
+    with OTPSession("/dev/ttyUSB0") as session:
+        serial = session.read(3, 1)[0].data
+    """
+
+    flasher_name = "otp-flasher-mips-ram.hex"
+    flasher_msg = "OTP Flasher"
+
+    @staticmethod
+    def _check_range(addr: int, count: int):
+        if addr < 0 or count <= 0 or addr + count > OTP_WORDS_COUNT:
+            raise ValueError(f"Wrong address or count. Total count of words is {OTP_WORDS_COUNT}")
+
+    def read(self, addr: int = 0, count: Optional[int] = None, flags: int = 0):
+        """Read OTP words. Return OTP_Data."""
+        if count is None:
+            count = OTP_WORDS_COUNT - addr
+        self._check_range(addr, count)
+        return read_otp(self._uart(), addr, count, flags)
+
+    def program(self, addr: int, data: bytes):
+        """Program data (aligned to word size) starting from word `addr`"""
+        if not data or len(data) % 4:
+            raise ValueError("Data size must be non-zero and aligned by 4 bytes")
+        self._check_range(addr, len(data) // 4)
+        program(self._uart(), data, addr)
+
+    def bist(self, addr: int = 0, count: Optional[int] = None, repair: bool = False):
+        """Run BIST (or BISR if `repair` is True) for OTP region"""
+        if count is None:
+            count = OTP_WORDS_COUNT - addr
+        self._check_range(addr, count)
+        result = run_bist(self._uart(), repair, addr, count)
+        if result.strip() != "Ok":
+            raise Exception(f"{'BISR' if repair else 'BIST'} failed: {result}")
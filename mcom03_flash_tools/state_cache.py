@@ -0,0 +1,193 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import binascii
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+from mcom03_flash_tools import UART, FlashType, KiB, blank_crc, default_cache_dir, read_crc
+from mcom03_flash_tools.metrics import file_lock, measure
+
+# Region which CRC is a part of board fingerprint
+FINGERPRINT_REGION = 4 * KiB
+# Count of sectors which are read back to confirm the cached layout
+SPOT_CHECK_SECTORS = 4
+MAX_ENTRIES = 64
+
+
+def image_sector_crcs(f_obj, f_size: int, offset: int, sector: int) -> dict[int, int]:
+    """Return CRC16 of every sector touched by image as it will be after erase and write.
+    Bytes of sector which are not covered by image are erased (0xFF). Position of `f_obj` is
+    restored after calculation.
+
+    >>> import io
+    >>> crcs = image_sector_crcs(io.BytesIO(b"\\x00" * 6), 6, 4, 4)
+    >>> crcs == {1: binascii.crc_hqx(b"\\x00" * 4, 0xFFFF), 2: binascii.crc_hqx(b"\\x00" * 2 + \
+                 b"\\xff" * 2, 0xFFFF)}
+    True
+    """
+    pos = f_obj.tell()
+    crcs = {}
+    head = offset % sector
+    first_sector = offset // sector
+    last_sector = (offset + f_size - 1) // sector
+    for i in range(first_sector, last_sector + 1):
+        data = f_obj.read(sector - head)
+        crc = binascii.crc_hqx(b"\xff" * head, 0xFFFF)
+        crc = binascii.crc_hqx(data, crc)
+        crcs[i] = binascii.crc_hqx(b"\xff" * (sector - head - len(data)), crc)
+        head = 0
+    f_obj.seek(pos)
+    return crcs
+
+
+def sector_runs(sectors: list[int]) -> list[tuple[int, int]]:
+    """Return list of (first sector, sectors count) for contiguous sectors
+
+    >>> sector_runs([5, 1, 2, 3, 7, 8])
+    [(1, 3), (5, 1), (7, 2)]
+    >>> sector_runs([])
+    []
+    """
+    runs: list[tuple[int, int]] = []
+    for sector in sorted(sectors):
+        if runs and runs[-1][0] + runs[-1][1] == sector:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((sector, 1))
+    return runs
+
+
+def board_fingerprint(uart: UART, flash_type: FlashType) -> str:
+    """Return string identifying board: flash ID bytes and CRC of the flash beginning"""
+    ids = "".join(f"{x:02x}" for x in flash_type.id_bytes)
+    with measure(uart, "fingerprint", FINGERPRINT_REGION):
+        crc = read_crc(uart, 0, FINGERPRINT_REGION)
+    return f"{ids}-{crc:04x}"
+
+
+class StateCache:
+    """On-disk cache of per-sector CRC layout of flash written to boards.
+
+    Entries are keyed by board fingerprint and QSPI controller. The least recently used entries
+    are evicted when count of entries exceeds `max_entries`. The cache can be shared by
+    concurrent instances of the tools: entries changed by this instance are merged into the file
+    under lock.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = MAX_ENTRIES):
+        self.path = path or os.path.join(default_cache_dir(), "state.json")
+        self.max_entries = max_entries
+        self.entries = self._load()
+        # Keys of entries changed and removed since the last save
+        self.changed: set[str] = set()
+        self.removed: set[str] = set()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        with file_lock(self.path):
+            entries = self._load()
+            for key in self.removed:
+                entries.pop(key, None)
+            entries.update({key: self.entries[key] for key in self.changed if key in self.entries})
+            while len(entries) > self.max_entries:
+                oldest = min(entries, key=lambda key: entries[key]["used"])
+                del entries[oldest]
+
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".state-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.changed.clear()
+        self.removed.clear()
+
+    def get(self, key: str, sector: int) -> Optional[dict[int, int]]:
+        entry = self.entries.get(key)
+        if entry is None or entry["sector"] != sector:
+            return None
+        entry["used"] = time.time()
+        self.changed.add(key)
+        return {int(k): v for k, v in entry["sectors"].items()}
+
+    def update(self, key: str, flash_type: FlashType, sectors: dict[int, int]):
+        self.entries[key] = {
+            "flash": flash_type.name,
+            "sector": flash_type.sector,
+            "used": time.time(),
+            "sectors": {str(k): v for k, v in sorted(sectors.items())},
+        }
+        self.changed.add(key)
+        self.removed.discard(key)
+        self.save()
+
+    def remove(self, key: str):
+        """Remove entry (the file is changed by the next save)"""
+        self.entries.pop(key, None)
+        self.changed.discard(key)
+        self.removed.add(key)
+
+    def invalidate(self, key: str):
+        self.remove(key)
+        self.save()
+
+
+class BoardState:
+    """Cached flash layout of the board connected to `uart`"""
+
+    def __init__(self, cache: StateCache, uart: UART, qspi: str, flash_type: FlashType):
+        self.cache = cache
+        self.uart = uart
+        self.qspi = qspi
+        self.flash_type = flash_type
+        self.key = self._make_key()
+
+    def _make_key(self) -> str:
+        return f"{board_fingerprint(self.uart, self.flash_type)}:{self.qspi}"
+
+    def unchanged_sectors(self, expected: dict[int, int]) -> set[int]:
+        """Return sectors which already contain expected data according to the cache.
+        Cached layout is confirmed by reading CRC of several sectors. If any of them differs then
+        cache entry is invalidated and empty set is returned."""
+        cached = self.cache.get(self.key, self.flash_type.sector)
+        if cached is None:
+            return set()
+
+        unchanged = sorted(x for x, crc in expected.items() if cached.get(x) == crc)
+        step = max(len(unchanged) // SPOT_CHECK_SECTORS, 1)
+        sector = self.flash_type.sector
+        for i in unchanged[::step][:SPOT_CHECK_SECTORS]:
+            with measure(self.uart, "spot_check", sector):
+                crc = read_crc(self.uart, i * sector, sector)
+            if crc != expected[i]:
+                print("Cached flash layout is stale, it is dropped")
+                self.invalidate()
+                return set()
+
+        return set(unchanged)
+
+    def invalidate(self):
+        self.cache.invalidate(self.key)
+
+    def record(self, sectors: dict[int, int]):
+        """Save CRC of written sectors. Fingerprint is recalculated since written data could
+        change it."""
+        cached = self.cache.get(self.key, self.flash_type.sector) or {}
+        cached.update(sectors)
+        self.cache.remove(self.key)
+        self.key = self._make_key()
+        self.cache.update(self.key, self.flash_type, cached)
+
+    def record_erase(self, first_sector: int, count: int):
+        blank = blank_crc(self.flash_type.sector)
+        self.record({x: blank for x in range(first_sector, first_sector + count)})
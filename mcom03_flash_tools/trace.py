@@ -0,0 +1,249 @@
+# Copyright 2026 RnD Center "ELVEES", JSC
+
+import atexit
+import queue
+import struct
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+from typing import Optional
+
+# Trace file starts with MAGIC and contains records: RECORD header (direction, time in
+# nanoseconds from start of the session, size of data) followed by data
+MAGIC = b"MC03TRC1"
+RECORD = struct.Struct("<BQI")
+TX = 0
+RX = 1
+# Received chunks separated by less than this interval (and not by transmission) are merged
+COALESCE_NS = 1_000_000
+REPLAY_PREFIX = "replay://"
+
+TraceRecord = namedtuple("TraceRecord", "direction time data")
+
+
+def read_trace(path: str) -> list:
+    """Return list of TraceRecord from trace file"""
+    records = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception(f"{path} is not a UART trace")
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                break
+            if len(header) != RECORD.size:
+                raise Exception(f"Trace {path} is truncated")
+            direction, timestamp, size = RECORD.unpack(header)
+            data = f.read(size)
+            if len(data) != size:
+                raise Exception(f"Trace {path} is truncated")
+            records.append(TraceRecord(direction, timestamp, data))
+    return records
+
+
+class TraceRecorder:
+    """Recorder of transmitted and received bytes with timestamps. Serial port hooks only put
+    chunks to the queue, merging and writing to the file are done in a background thread."""
+
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.time_start = time.perf_counter_ns()
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def record(self, direction: int, data):
+        if data:
+            self.queue.put((direction, time.perf_counter_ns() - self.time_start, bytes(data)))
+
+    def _writer(self):
+        pending: Optional[list] = None
+        last = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            direction, timestamp, data = item
+            if pending is not None and pending[0] == direction and timestamp - last < COALESCE_NS:
+                pending[2] += data
+            else:
+                if pending is not None:
+                    self._write_record(*pending)
+                pending = [direction, timestamp, bytearray(data)]
+            last = timestamp
+
+        if pending is not None:
+            self._write_record(*pending)
+        self.file.close()
+
+    def _write_record(self, direction: int, timestamp: int, data: bytes):
+        self.file.write(RECORD.pack(direction, timestamp, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class TracedSerial:
+    """Proxy of serial port which passes transmitted and received data to recorder"""
+
+    def __init__(self, tty, recorder: TraceRecorder):
+        object.__setattr__(self, "_tty", tty)
+        object.__setattr__(self, "_recorder", recorder)
+
+    def __getattr__(self, name):
+        return getattr(self._tty, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._tty, name, value)
+
+    def write(self, data):
+        self._recorder.record(TX, data)
+        return self._tty.write(data)
+
+    def read(self, size=1):
+        data = self._tty.read(size)
+        self._recorder.record(RX, data)
+        return data
+
+    def readinto(self, b):
+        size = self._tty.readinto(b) or 0
+        self._recorder.record(RX, memoryview(b)[:size])
+        return size
+
+
+def enable_trace(uart, path: str) -> TraceRecorder:
+    """Record UART session to trace file `path`. The file is completed at exit."""
+    recorder = TraceRecorder(path)
+    uart.tty = TracedSerial(uart.tty, recorder)
+    atexit.register(recorder.close)
+    return recorder
+
+
+def parse_replay_url(url: str) -> tuple:
+    """Return path and speed of replay from port name
+
+    >>> parse_replay_url("replay://session.trace")
+    ('session.trace', 1.0)
+    >>> parse_replay_url("replay:///tmp/session.trace?speed=0")
+    ('/tmp/session.trace', 0.0)
+    """
+    path, _, query = url[len(REPLAY_PREFIX) :].partition("?")
+    params = urllib.parse.parse_qs(query)
+    speed = float(params.get("speed", ["1"])[0])
+    if speed < 0:
+        raise ValueError("Replay speed must not be negative")
+    return path, speed
+
+
+class ReplaySerial:
+    """Serial port which serves received data from trace file. Transmitted data must be equal to
+    data of the trace, otherwise Exception is raised. Received data becomes available with
+    delay from the preceding transmission as in the trace divided by `speed`
+    (0 means without delays).
+
+    Input buffer is not cleared by reset_input_buffer(), because the trace contains only data
+    which has been read by the tool."""
+
+    def __init__(self, path: str, speed: float = 1.0, timeout: Optional[float] = 0.5):
+        self.port = REPLAY_PREFIX + path
+        self.records = read_trace(path)
+        self.speed = speed
+        self.timeout = timeout
+        self.baudrate = 115200
+        self.index = 0
+        self.offset = 0
+        self.anchor_trace = 0
+        self.anchor_time = time.perf_counter()
+
+    @classmethod
+    def from_url(cls, url: str, timeout: Optional[float] = 0.5) -> "ReplaySerial":
+        path, speed = parse_replay_url(url)
+        return cls(path, speed, timeout)
+
+    def _record(self) -> Optional[TraceRecord]:
+        return self.records[self.index] if self.index < len(self.records) else None
+
+    def _advance(self, size: int):
+        self.offset += size
+        record = self.records[self.index]
+        if self.offset == len(record.data):
+            if record.direction == TX:
+                self.anchor_trace = record.time
+                self.anchor_time = time.perf_counter()
+            self.index += 1
+            self.offset = 0
+
+    def _due(self, record: TraceRecord) -> float:
+        if not self.speed:
+            return 0.0
+        return self.anchor_time + (record.time - self.anchor_trace) / 1e9 / self.speed
+
+    def _sleep(self, seconds: float):
+        if self.speed and seconds > 0:
+            time.sleep(seconds)
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        pos = 0
+        while pos < len(data):
+            record = self._record()
+            if record is None or record.direction != TX:
+                raise Exception(f"Replay diverged: unexpected transmission {data[pos:][:32]!r}")
+            expected = record.data[self.offset : self.offset + len(data) - pos]
+            if data[pos : pos + len(expected)] != expected:
+                raise Exception(
+                    f"Replay diverged: transmitted {data[pos:][:32]!r}, "
+                    + f"expected {expected[:32]!r}"
+                )
+            pos += len(expected)
+            self._advance(len(expected))
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        if self.timeout is None:
+            deadline = float("inf")
+        else:
+            deadline = time.perf_counter() + self.timeout / (self.speed or 1)
+        out = bytearray()
+        while len(out) < size:
+            record = self._record()
+            if record is None or record.direction != RX:
+                # Nothing is received until the next transmission, so wait as serial port does
+                if deadline != float("inf"):
+                    self._sleep(deadline - time.perf_counter())
+                break
+            delay = self._due(record) - time.perf_counter()
+            if delay > 0:
+                self._sleep(min(delay, deadline - time.perf_counter()))
+                if self._due(record) > time.perf_counter():
+                    break
+            chunk = record.data[self.offset : self.offset + size - len(out)]
+            out += chunk
+            self._advance(len(chunk))
+        return bytes(out)
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    @property
+    def in_waiting(self) -> int:
+        record = self._record()
+        if record is None or record.direction != RX or self._due(record) > time.perf_counter():
+            return 0
+        return len(record.data) - self.offset
+
+    def reset_input_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass